@@ -0,0 +1,432 @@
+"""
+Offline benchmark for the bot's command handlers.
+
+Drives the real handlers in main.py against stand-in voice clients, a fake
+yt_dlp with configurable latency and a synthetic music library, so no Discord
+connection, network access or FFmpeg is needed. Reports command latencies,
+gaps between tracks and memory per guild at increasing guild counts.
+The stand-in sources spawn no processes, so the FFmpeg governor is only
+enforced with --ffmpeg-limit; its admissions are reported separately.
+
+    python benchmark.py --guilds 1,10,100,1000 --files 5000 --output results.json
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import discord
+
+# ---------------------------------------------
+# FAKE YT-DLP
+# ---------------------------------------------
+class FakeYoutubeDL:
+    """Answers extract_info like yt-dlp would, after a configurable delay."""
+    latency = 0.2         # Seconds per extraction
+    playlist_size = 250   # Entries in every playlist
+    duration = 180        # Reported length of every video
+
+    def __init__(self, opts: Dict):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @staticmethod
+    def _video_id(seed: str) -> str:
+        return f"{abs(hash(seed)) % 10**11:011d}"
+
+    def _video(self, video_id: str) -> Dict:
+        return {'id': video_id, 'title': f"Video {video_id}", 'duration': self.duration,
+                'webpage_url': f"https://www.youtube.com/watch?v={video_id}"}
+
+    def extract_info(self, url: str, download: bool = False) -> Dict:
+        time.sleep(self.latency)
+        if not self.opts.get('extract_flat'):
+            video_id = self._video_id(url)
+            expire = int(time.time()) + 6 * 3600
+            return {'url': f"https://rr1---sn-bench.googlevideo.com/videoplayback?expire={expire}"
+                           f"&id={video_id}&itag=251&mime=audio/webm", 'duration': self.duration}
+        if 'list=' in url:
+            start, end = 1, self.playlist_size
+            if self.opts.get('playlist_items'):
+                start, end = (int(n) for n in self.opts['playlist_items'].split('-'))
+            end = min(end, self.playlist_size)
+            return {'entries': [self._video(self._video_id(f"{url}#{i}")) for i in range(start, end + 1)]}
+        return self._video(self._video_id(url))
+
+def install_fake_yt_dlp():
+    module = types.ModuleType('yt_dlp')
+    module.YoutubeDL = FakeYoutubeDL
+    sys.modules['yt_dlp'] = module
+
+# ---------------------------------------------
+# FAKE DISCORD OBJECTS
+# ---------------------------------------------
+FRAME = b'\1' * 3840  # 20ms of 48kHz stereo PCM
+FRAME_LENGTH = 0.02
+
+class FakeSource(discord.AudioSource):
+    """
+    Replaces the FFmpeg sources; spawn_latency stands in for process start-up
+    and the source runs dry after track_seconds worth of frames.
+    """
+    spawn_latency = 0.005
+    track_seconds = 0.5
+
+    def __init__(self, *args, **kwargs):
+        time.sleep(self.spawn_latency)
+        self.frames_left = int(self.track_seconds / FRAME_LENGTH)
+
+    def read(self) -> bytes:
+        if self.frames_left <= 0:
+            return b''
+        self.frames_left -= 1
+        return FRAME
+
+    def is_opus(self) -> bool:
+        return False
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+class FakeVoiceClient:
+    """
+    Stands in for discord.VoiceClient. play() starts a player thread that
+    reads a frame every 20ms until the source runs dry or stop() is called,
+    then cleans the source up and calls after() from that thread, like the
+    real player does.
+    """
+
+    def __init__(self, guild: 'FakeGuild', channel):
+        self.guild = guild
+        self.channel = channel
+        self._connected = True
+        self._playing = False
+        self._paused = False
+        self._stop_event: Optional[threading.Event] = None
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._playing and not self._paused
+
+    def is_paused(self) -> bool:
+        return self._playing and self._paused
+
+    def play(self, source, after=None):
+        self._playing = True
+        self._paused = False
+        self._stop_event = threading.Event()
+        threading.Thread(target=self._run, args=(source, after, self._stop_event), daemon=True).start()
+
+    def _run(self, source, after, stop_event: threading.Event):
+        while not stop_event.is_set():
+            if not self._paused and not source.read():
+                break
+            stop_event.wait(FRAME_LENGTH)
+        if self._stop_event is stop_event:
+            self._playing = False
+        source.cleanup()
+        if after:
+            after(None)
+
+    def stop(self):
+        self._playing = False
+        if self._stop_event:
+            self._stop_event.set()
+
+    def pause(self):
+        self._paused = True
+
+    def resume(self):
+        self._paused = False
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force: bool = False):
+        self._connected = False
+        self.stop()
+        self.guild.voice_client = None
+
+class FakeVoiceChannel:
+    def __init__(self, guild: 'FakeGuild'):
+        self.guild = guild
+        self.name = f"voice-{guild.id}"
+        self.members = []
+
+    async def connect(self) -> FakeVoiceClient:
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.voice_client: Optional[FakeVoiceClient] = None
+
+class FakeContext:
+    """The parts of commands.Context the handlers use."""
+
+    def __init__(self, guild: FakeGuild, voice_channel: FakeVoiceChannel):
+        self.guild = guild
+        self.channel = types.SimpleNamespace(id=guild.id)
+        self.author = types.SimpleNamespace(voice=types.SimpleNamespace(channel=voice_channel), bot=False)
+        self.messages_sent = 0
+
+    @property
+    def voice_client(self) -> Optional[FakeVoiceClient]:
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs) -> FakeMessage:
+        self.messages_sent += 1
+        return FakeMessage()
+
+# ---------------------------------------------
+# SYNTHETIC LIBRARY
+# ---------------------------------------------
+WORDS = ['love', 'night', 'blue', 'fire', 'river', 'dream', 'city', 'light', 'heart', 'rain',
+         'summer', 'ghost', 'gold', 'road', 'star', 'wild', 'echo', 'shadow', 'ocean', 'time']
+
+def build_library(root: str, n_files: int, per_album: int = 12, albums_per_artist: int = 4):
+    rng = random.Random(0)
+    for i in range(n_files):
+        artist, album = i // (per_album * albums_per_artist), (i // per_album) % albums_per_artist
+        directory = os.path.join(root, f"Artist {artist:04d}", f"Album {album}")
+        os.makedirs(directory, exist_ok=True)
+        title = ' '.join(rng.choice(WORDS) for _ in range(3)).title()
+        open(os.path.join(directory, f"{i % per_album + 1:02d} {title} {i}.mp3"), 'wb').close()
+
+# ---------------------------------------------
+# BENCHMARK
+# ---------------------------------------------
+ADMISSION_OUTCOMES = ('admitted', 'degraded', 'queued', 'preempted', 'refused')
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+    return {'count': len(ordered), 'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'max_ms': ordered[-1] * 1000}
+
+class Benchmark:
+    def __init__(self, main, args, song: str):
+        self.main = main
+        self.args = args
+        self.song = song
+        self.gaps: List[float] = []  # Track gaps the mixers measured during the current scale
+
+    def make_guilds(self, n: int, offset: int) -> List[FakeContext]:
+        contexts = []
+        for i in range(n):
+            guild = FakeGuild(offset + i)
+            contexts.append(FakeContext(guild, FakeVoiceChannel(guild)))
+        return contexts
+
+    async def timed(self, coro) -> float:
+        started = time.perf_counter()
+        await coro
+        return time.perf_counter() - started
+
+    async def yt_play_until_audible(self, ctx: FakeContext, url: str) -> float:
+        """Time from !yt_play until a video plays, with the library playlist cleared and skipped past."""
+        state = self.main.get_guild_state(ctx.guild.id)
+        await self.main.clear.callback(ctx)
+        started = time.perf_counter()
+        await self.main.yt_play.callback(ctx, url=url)
+        deadline = started + self.args.timeout
+        skipped = False
+        while not isinstance(state.now_playing, self.main.YouTubeTrack):
+            if time.perf_counter() > deadline:
+                raise asyncio.TimeoutError
+            # The first page joins the queue behind the library track that is still playing
+            if not skipped and state.queue.video_count and state.mixer:
+                state.mixer.skip()
+                skipped = True
+            await asyncio.sleep(0.005)
+        return time.perf_counter() - started
+
+    async def stop_all(self, contexts: List[FakeContext]):
+        for ctx in contexts:
+            if ctx.voice_client:
+                await self.main.stop.callback(ctx)
+        self.main.guild_states.clear()
+        await asyncio.sleep(self.args.track_seconds)
+
+    async def run_scale(self, n: int) -> Dict:
+        main = self.main
+        contexts = self.make_guilds(n, offset=n * 10_000)
+        result: Dict = {'guilds': n}
+        self.gaps.clear()
+        admissions = self.admissions()
+
+        latencies = await asyncio.gather(*(self.timed(main.dj_play.callback(ctx, filename=None))
+                                           for ctx in contexts))
+        result['dj_play'] = percentiles(list(latencies))
+
+        named = await asyncio.gather(*(self.timed(main.dj_play.callback(ctx, filename=self.song))
+                                       for ctx in contexts))
+        result['dj_play_song'] = percentiles(list(named))
+
+        before = sum(ctx.messages_sent for ctx in contexts)
+        listed = await asyncio.gather(*(self.timed(main.dj_list.callback(ctx)) for ctx in contexts))
+        result['dj_list'] = percentiles(list(listed))
+        result['dj_list']['messages_per_call'] = (sum(ctx.messages_sent for ctx in contexts) - before) / n
+
+        await asyncio.sleep(self.args.play_seconds)
+
+        urls = [f"https://www.youtube.com/playlist?list=PLbench{n}x{i % self.args.playlists}" for i in range(n)]
+        audible = await asyncio.gather(*(self.yt_play_until_audible(ctx, url) for ctx, url in zip(contexts, urls)),
+                                       return_exceptions=True)
+        result['yt_play_to_audio'] = percentiles([t for t in audible if isinstance(t, float)])
+        result['yt_play_timeouts'] = sum(1 for t in audible if not isinstance(t, float))
+
+        await asyncio.sleep(self.args.play_seconds)
+        result['track_gap'] = percentiles(list(self.gaps))
+        await self.stop_all(contexts)
+        result['ffmpeg_admissions'] = {outcome: count - admissions[outcome]
+                                       for outcome, count in self.admissions().items()}
+
+        result['memory_per_guild_kib'] = await self.measure_memory(n)
+        return result
+
+    @staticmethod
+    def admissions() -> Dict[str, float]:
+        import governor
+        counter = governor.FFMPEG_ADMISSIONS
+        return {outcome: counter.value(outcome) for outcome in ADMISSION_OUTCOMES}
+
+    async def measure_memory(self, n: int) -> float:
+        """Memory held per guild with a full DJ queue and a loaded YouTube queue."""
+        main = self.main
+        contexts = self.make_guilds(n, offset=n * 10_000 + 5_000)
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        for ctx in contexts:
+            await main.dj_play.callback(ctx, filename=None)
+        url = f"https://www.youtube.com/playlist?list=PLbenchmem{n}"
+        for ctx in contexts:
+            state = main.get_guild_state(ctx.guild.id)
+            async for page in main.get_youtube_info(url, guild_id=ctx.guild.id):
+                state.queue.extend(main.YouTubeTrack.from_entry(v) for v in page)
+        used = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+        await self.stop_all(contexts)
+        return used / n / 1024
+
+def print_result(result: Dict):
+    print(f"\n=== {result['guilds']} guild(s) ===")
+    for name in ('dj_play', 'dj_play_song', 'dj_list', 'yt_play_to_audio', 'track_gap'):
+        stats = result.get(name) or {}
+        if not stats:
+            print(f"{name:<18} no samples")
+            continue
+        line = f"{name:<18} n={stats['count']:<5} p50={stats['p50_ms']:8.1f}ms p95={stats['p95_ms']:8.1f}ms " \
+               f"max={stats['max_ms']:8.1f}ms"
+        if 'messages_per_call' in stats:
+            line += f"  messages/call={stats['messages_per_call']:.0f}"
+        print(line)
+    if result['yt_play_timeouts']:
+        print(f"yt_play timeouts:  {result['yt_play_timeouts']}")
+    print("ffmpeg admissions  " + ' '.join(f"{outcome}={count:.0f}"
+                                           for outcome, count in result['ffmpeg_admissions'].items()))
+    print(f"memory/guild       {result['memory_per_guild_kib']:.1f} KiB")
+
+async def run(args) -> List[Dict]:
+    workdir = tempfile.mkdtemp(prefix='musicbot-bench-')
+    os.chdir(workdir)  # Every database the bot opens lands here
+    install_fake_yt_dlp()
+    FakeYoutubeDL.latency = args.yt_latency
+    FakeYoutubeDL.playlist_size = args.playlist_size
+    FakeYoutubeDL.duration = args.track_seconds
+
+    import main
+    import mixer
+    import governor
+    import executors
+    import library as library_module
+
+    # The fake yt_dlp only exists in this process, so extraction runs on threads
+    executors.extraction_pool._executor_factory = lambda: ThreadPoolExecutor(
+        max_workers=executors.EXTRACTION_WORKERS, thread_name_prefix='extraction')
+
+    FakeSource.spawn_latency = args.spawn_latency
+    FakeSource.track_seconds = args.track_seconds
+    main.create_normalized_audio_source = FakeSource
+    main.create_youtube_audio_source = FakeSource
+    if args.ffmpeg_limit:
+        governor.ffmpeg_governor.max_processes = args.ffmpeg_limit
+        governor.PRELOAD_HEADROOM = max(1, args.ffmpeg_limit // 4)
+    else:
+        # Nothing is spawned: measure the handlers, not refusals by a limit sized for real processes
+        governor.ffmpeg_governor.max_processes = governor.ffmpeg_governor.guild_limit = sys.maxsize
+    main.bot.loop = asyncio.get_running_loop()
+
+    music_dir = os.path.join(workdir, 'music')
+    build_library(music_dir, args.files)
+    main.MUSIC_DIRECTORY = music_dir
+    main.library = library_module.LibraryIndex(music_dir, main.ALLOWED_EXTENSIONS, 'library.db')
+    started = time.perf_counter()
+    main.library.refresh()
+    print(f"Indexed {main.library.track_count} synthetic files in {time.perf_counter() - started:.2f}s ({workdir})")
+    main.library_loaded.set()
+
+    # An exact name, so the handler never waits for a search result to be picked
+    song = args.song or os.path.splitext(os.path.basename(main.library.path_of(1)))[0]
+    bench = Benchmark(main, args, song)
+    observe_gap = mixer.TRACK_GAP_SECONDS.observe
+
+    def record_gap(value: float, *labels):
+        bench.gaps.append(value)
+        observe_gap(value, *labels)
+    mixer.TRACK_GAP_SECONDS.observe = record_gap
+    results = []
+    for n in args.guilds:
+        result = await bench.run_scale(n)
+        print_result(result)
+        results.append(result)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=lambda s: [int(n) for n in s.split(',')], default=[1, 10, 100, 1000],
+                        help='Comma-separated simulated guild counts')
+    parser.add_argument('--files', type=int, default=5000, help='Files in the synthetic library')
+    parser.add_argument('--song', help='Exact song name for the named dj_play (default: first indexed file)')
+    parser.add_argument('--yt-latency', type=float, default=0.2, help='Seconds per fake yt-dlp extraction')
+    parser.add_argument('--playlist-size', type=int, default=250, help='Entries per fake playlist')
+    parser.add_argument('--playlists', type=int, default=10, help='Distinct playlists shared by the guilds')
+    parser.add_argument('--spawn-latency', type=float, default=0.005, help='Seconds to "spawn" an audio source')
+    parser.add_argument('--track-seconds', type=float, default=0.5, help='Length of every simulated track')
+    parser.add_argument('--play-seconds', type=float, default=2.0, help='Playback time between phases')
+    parser.add_argument('--ffmpeg-limit', type=int, default=0,
+                        help='Enforce the FFmpeg governor with this many slots (default: unlimited)')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Seconds to wait for audio to start')
+    parser.add_argument('--output', help='Write the results as JSON, for comparing releases')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)  # run() changes into a scratch directory
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': {k: v for k, v in vars(args).items() if k != 'output'}, 'results': results},
+                      f, indent=2)
+
+if __name__ == "__main__":
+    main()
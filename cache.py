@@ -0,0 +1,136 @@
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class PersistentCache:
+    """
+    Small JSON key/value store in SQLite with per-entry TTLs.
+    Safe to share between threads; the database is opened on first use.
+    """
+
+    def __init__(self, db_path: str, table: str):
+        self.db_path = db_path
+        self.table = table
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table}_leases ("
+                "key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+            # Expired rows are only ever cleaned up here, once per process
+            with conn:
+                conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+                conn.execute(f"DELETE FROM {self.table}_leases WHERE expires_at <= ?", (time.time(),))
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Cache read failed for {key}: {e}")
+            return None
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any, ttl: float):
+        self.put_many({key: value}, ttl)
+
+    def put_many(self, items: Dict[str, Any], ttl: float):
+        """Writes several entries in a single transaction."""
+        if not items:
+            return
+        expires_at = time.time() + ttl
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.executemany(
+                        f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                        ((k, json.dumps(v), expires_at) for k, v in items.items()))
+        except sqlite3.Error as e:
+            logger.warning(f"Cache write failed for {len(items)} entries: {e}")
+
+    def delete(self, key: str):
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Cache delete failed for {key}: {e}")
+
+    def try_lease(self, key: str, ttl: float) -> bool:
+        """
+        Claims the right to compute key, across every process sharing this
+        database. Returns False while another holder's lease is still valid.
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute(f"DELETE FROM {self.table}_leases WHERE key = ? AND expires_at <= ?", (key, now))
+                    cursor = conn.execute(
+                        f"INSERT OR IGNORE INTO {self.table}_leases (key, expires_at) VALUES (?, ?)",
+                        (key, now + ttl))
+                    return cursor.rowcount == 1
+        except sqlite3.Error as e:
+            logger.warning(f"Lease failed for {key}: {e}")
+            return True  # Better to duplicate work than to stall
+
+    def release_lease(self, key: str):
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute(f"DELETE FROM {self.table}_leases WHERE key = ?", (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Lease release failed for {key}: {e}")
+
+class SingleFlight:
+    """
+    Collapses concurrent awaits for the same key into one execution.
+    The first caller starts the coroutine; callers arriving while it is in
+    flight await the same result (or exception). The shared work is only
+    cancelled once every caller waiting on it has been cancelled.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, list] = {}  # key -> [task, waiter count]
+
+    async def do(self, key: str, coro_fn: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(coro_fn())
+            entry = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda t: self._calls.pop(key, None)
+                                   if self._calls.get(key, [None])[0] is t else None)
+
+        task = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # Callers arriving before the cancellation lands start afresh instead of joining it
+                if self._calls.get(key) is entry:
+                    del self._calls[key]
+                task.cancel()
@@ -0,0 +1,285 @@
+import os
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import subprocess
+from typing import Optional, Set
+
+import discord
+
+from executors import Priority, io_pool
+from governor import FFMPEG_THREADS, THREAD_OPTIONS, FFmpegSlot, ffmpeg_governor, lower_priority
+from metrics import Counter, Gauge, register, stage
+from relay import audio_relay
+from youtube import FFMPEG_OPTS, get_stream_url, is_opus_stream, video_cache_key
+
+logger = logging.getLogger(__name__)
+
+# --- Download Cache ---
+# Opt-in: YouTube videos played often enough are downloaded once as Opus and
+# from then on played from disk, without extraction or a network stream.
+DOWNLOAD_CACHE_ENABLED = os.getenv('YT_DOWNLOAD_CACHE', '0').lower() in ('1', 'true', 'yes', 'on')
+DOWNLOAD_MIN_PLAYS = int(os.getenv('YT_DOWNLOAD_MIN_PLAYS', 3))       # Plays within PLAY_WINDOW before a download
+DOWNLOAD_CACHE_BYTES = int(os.getenv('YT_DOWNLOAD_CACHE_MB', 2048)) * 1024 * 1024
+DOWNLOAD_CACHE_DIR = 'download_cache'
+DOWNLOAD_DB_PATH = 'download_cache.db'  # Play counts, shared by every bot process on this host
+PLAY_WINDOW = 7 * 24 * 3600  # Plays older than this no longer count towards a download
+DOWNLOAD_TIMEOUT = 600       # Seconds allowed per download
+DOWNLOAD_LEASE_TTL = DOWNLOAD_TIMEOUT + 60  # Another process's download is presumed dead after this
+MAX_DURATION = 3 * 3600      # Longer videos (mixes, streams) are never downloaded
+OPUS_BITRATE = '128k'        # Only for streams that are not Opus already, which are copied as-is
+DOWNLOAD_SLOT_OWNER = 0      # Downloads hold FFmpeg governor slots under this pseudo guild ID
+DOWNLOAD_ADMIT_INTERVAL = 5  # Seconds between attempts to get a slot while the governor is full
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    key TEXT PRIMARY KEY,
+    plays INTEGER NOT NULL,
+    window_start REAL NOT NULL,
+    downloading REAL
+);
+"""
+
+def create_cached_audio_source(path: str, start_at: float = 0.0) -> discord.AudioSource:
+    """Plays a downloaded copy: already 48kHz Opus, so it is remuxed without re-encoding."""
+    before_options = f'{THREAD_OPTIONS} -ss {start_at:.2f}' if start_at else THREAD_OPTIONS
+    with stage('ffmpeg_spawn'):
+        return discord.FFmpegOpusAudio(path, codec='opus', before_options=before_options)
+
+class DownloadCache:
+    """
+    Counts YouTube plays and downloads videos that reach DOWNLOAD_MIN_PLAYS
+    within PLAY_WINDOW into cache_dir, one at a time at background priority.
+    Files are named after the video ID, so every process finds the same
+    copy; each use bumps its modification time and the least recently used
+    are evicted once the directory exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, db_path: str, max_bytes: int, min_plays: int):
+        self.cache_dir = cache_dir
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.size_bytes = 0
+        self.files = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._worker: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._worker is not None
+
+    async def start(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._queue = asyncio.Queue()
+        await io_pool.run(Priority.BACKGROUND, None, self._evict)
+        self._worker = asyncio.create_task(self._run())
+        logger.info(f"YouTube download cache: {self.files} tracks, {self.size_bytes / 1048576:.0f} MiB.")
+
+    # ---------------------------------------------
+    # LOOKUP
+    # ---------------------------------------------
+    def path_for(self, video_url: str) -> str:
+        key = video_cache_key(video_url)
+        name = key if key.replace('-', '').replace('_', '').isalnum() else hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + '.opus')
+
+    def has(self, video_url: str) -> bool:
+        return self.running and os.path.exists(self.path_for(video_url))
+
+    def lookup(self, video_url: str) -> Optional[str]:
+        """The downloaded copy of a video, marked as recently used, or None."""
+        if not self.running:
+            return None
+        path = self.path_for(video_url)
+        try:
+            os.utime(path)
+        except OSError:
+            DOWNLOAD_CACHE_LOOKUPS.inc('miss')
+            return None
+        DOWNLOAD_CACHE_LOOKUPS.inc('hit')
+        return path
+
+    def discard(self, video_url: str):
+        """Removes a copy that failed to play, so the video is streamed (and counted) afresh."""
+        try:
+            os.remove(self.path_for(video_url))
+        except OSError:
+            pass
+
+    # ---------------------------------------------
+    # PLAY COUNTS
+    # ---------------------------------------------
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def _count_play(self, key: str) -> bool:
+        """Records a play. Returns True if this process should download the video now."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT plays, window_start FROM plays WHERE key = ?", (key,)).fetchone()
+                if row is None or now - row[1] > PLAY_WINDOW:
+                    plays = 1
+                    conn.execute("INSERT OR REPLACE INTO plays (key, plays, window_start, downloading) "
+                                 "VALUES (?, 1, ?, NULL)", (key, now))
+                else:
+                    plays = row[0] + 1
+                    conn.execute("UPDATE plays SET plays = ? WHERE key = ?", (plays, key))
+                if plays < self.min_plays:
+                    return False
+                # Lease the download so only one process fetches it
+                claimed = conn.execute(
+                    "UPDATE plays SET downloading = ? WHERE key = ? AND (downloading IS NULL OR downloading < ?)",
+                    (now, key, now - DOWNLOAD_LEASE_TTL)).rowcount
+                return claimed == 1
+        finally:
+            conn.close()
+
+    def _release(self, key: str, downloaded: bool):
+        conn = self._connect()
+        try:
+            with conn:
+                if downloaded:
+                    conn.execute("DELETE FROM plays WHERE key = ?", (key,))
+                else:
+                    conn.execute("UPDATE plays SET downloading = NULL WHERE key = ?", (key,))
+        finally:
+            conn.close()
+
+    def record_play(self, video_url: str, duration: Optional[float]):
+        """Counts a play of a streamed video, queueing its download once it is played often enough."""
+        if not self.running or (duration and duration > MAX_DURATION) or video_url in self._queued:
+            return
+        if os.path.exists(self.path_for(video_url)):
+            return
+        task = asyncio.create_task(self._record_play(video_url))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _record_play(self, video_url: str):
+        key = video_cache_key(video_url)
+        try:
+            if not await io_pool.run(Priority.BACKGROUND, None, self._count_play, key):
+                return
+        except sqlite3.Error as e:
+            return logger.warning(f"Could not count play of {key}: {e}")
+        if os.path.exists(self.path_for(video_url)):
+            return await io_pool.run(Priority.BACKGROUND, None, self._release, key, True)
+        self._queued.add(video_url)
+        self._queue.put_nowait(video_url)
+
+    # ---------------------------------------------
+    # DOWNLOADS
+    # ---------------------------------------------
+    async def _run(self):
+        while True:
+            video_url = await self._queue.get()
+            key = video_cache_key(video_url)
+            downloaded = False
+            try:
+                downloaded = await self._download(video_url)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Download of {key} failed: {e}")
+            finally:
+                self._queued.discard(video_url)
+            try:
+                await io_pool.run(Priority.BACKGROUND, None, self._release, key, downloaded)
+                if downloaded:
+                    await io_pool.run(Priority.BACKGROUND, None, self._evict)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning(f"Download cache bookkeeping failed: {e}")
+
+    async def _download(self, video_url: str) -> bool:
+        stream_url = await get_stream_url(video_url, Priority.BACKGROUND)
+        if not stream_url:
+            return False
+        opus = is_opus_stream(stream_url)
+        if audio_relay.running:
+            # Shares the buffer of a server playing it right now instead of fetching it twice
+            stream_url = audio_relay.url_for(stream_url)
+        path = self.path_for(video_url)
+        tmp_path = path + '.part'
+        codec = ['-c:a', 'copy'] if opus else ['-ac', '2', '-ar', '48000', '-c:a', 'libopus', '-b:a', OPUS_BITRATE]
+        cmd = (['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-y']
+               + FFMPEG_OPTS['before_options'].split() + ['-i', stream_url, '-vn', '-threads', str(FFMPEG_THREADS)]
+               + codec + ['-f', 'opus', tmp_path])
+        slot = await self._acquire_slot()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, preexec_fn=lower_priority)
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), DOWNLOAD_TIMEOUT)
+            except BaseException:
+                proc.kill()
+                await proc.wait()
+                self._remove(tmp_path)
+                raise
+        finally:
+            slot.release()
+        if proc.returncode != 0:
+            self._remove(tmp_path)
+            raise RuntimeError(f"ffmpeg exited with {proc.returncode}: {stderr.decode(errors='replace')[-300:]}")
+        os.replace(tmp_path, path)
+        logger.info(f"Downloaded {video_cache_key(video_url)} to the download cache.")
+        return True
+
+    @staticmethod
+    async def _acquire_slot() -> FFmpegSlot:
+        """Waits for room under the FFmpeg governor, with the same limits as a preload."""
+        while True:
+            slot = ffmpeg_governor.try_acquire(DOWNLOAD_SLOT_OWNER, Priority.BACKGROUND)
+            if slot is not None:
+                return slot
+            await asyncio.sleep(DOWNLOAD_ADMIT_INTERVAL)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Deletes the least recently played copies (and abandoned partial ones) beyond max_bytes."""
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith('.part'):
+                if now - stat.st_mtime > DOWNLOAD_LEASE_TTL:
+                    self._remove(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+        self.size_bytes, self.files = total, len(entries) - evicted
+
+DOWNLOAD_CACHE_LOOKUPS = register(Counter(
+    'musicbot_download_cache_lookups_total', 'YouTube tracks played from the download cache or streamed',
+    ['result']))
+
+download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_DB_PATH, DOWNLOAD_CACHE_BYTES, DOWNLOAD_MIN_PLAYS)
+
+register(Gauge('musicbot_download_cache_bytes', 'Disk used by downloaded YouTube tracks', [],
+               lambda: {(): float(download_cache.size_bytes)}))
@@ -0,0 +1,177 @@
+import os
+import heapq
+import asyncio
+import logging
+import itertools
+import multiprocessing
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from enum import IntEnum
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# --- Pool Configuration ---
+EXTRACTION_WORKERS = int(os.getenv('EXTRACTION_WORKERS', 4))      # yt-dlp processes
+IO_WORKERS = int(os.getenv('IO_WORKERS', 4))                      # filesystem / database threads
+GUILD_EXTRACTION_LIMIT = int(os.getenv('GUILD_EXTRACTION_LIMIT', 2))  # non-playback jobs per guild
+
+class Priority(IntEnum):
+    """Lower runs first."""
+    PLAYBACK = 0     # Stream for the track that is about to play
+    INTERACTIVE = 1  # A user is waiting on the result (single video/search lookup)
+    PREFETCH = 2     # Look-ahead for upcoming tracks
+    BACKGROUND = 3   # Playlist expansion, maintenance
+
+class _Job:
+    __slots__ = ('priority', 'seq', 'guild_id', 'key', 'fn', 'args', 'future')
+
+    def __init__(self, priority, seq, guild_id, key, fn, args, future):
+        self.priority = priority
+        self.seq = seq
+        self.guild_id = guild_id
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.future = future
+
+    def __lt__(self, other: '_Job') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class PriorityPool:
+    """
+    Bounded, prioritized front-end for a concurrent.futures executor.
+
+    Jobs wait in a priority queue on the event loop and are only handed to
+    the executor when a worker is free, so a burst of low-priority work can
+    never sit in front of a playback job. Each guild may have at most
+    guild_limit non-playback jobs running at once. Must only be used from
+    the event loop thread.
+    """
+
+    def __init__(self, name: str, executor_factory: Callable[[], Executor],
+                 max_workers: int, guild_limit: Optional[int] = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.guild_limit = guild_limit
+        self._executor_factory = executor_factory
+        self._executor: Optional[Executor] = None
+        self._queue: List[_Job] = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._guild_running: Counter = Counter()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    async def run(self, priority: Priority, guild_id: Optional[Hashable], fn: Callable, *args,
+                  key: Optional[Hashable] = None) -> Any:
+        return await self.submit(priority, guild_id, fn, *args, key=key)
+
+    def submit(self, priority: Priority, guild_id: Optional[Hashable], fn: Callable, *args,
+               key: Optional[Hashable] = None) -> asyncio.Future:
+        """Queues a job without waiting for it (fire-and-forget callers may ignore the future)."""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, _Job(priority, next(self._seq), guild_id, key, fn, args, future))
+        self._dispatch()
+        return future
+
+    def promote(self, key: Hashable, priority: Priority):
+        """Raises the priority of a still-queued job, e.g. a prefetch that is now needed for playback."""
+        for job in self._queue:
+            if job.key == key and job.priority > priority:
+                job.priority = priority
+                heapq.heapify(self._queue)
+                self._dispatch()
+                return
+
+    def _over_guild_limit(self, job: _Job) -> bool:
+        return (self.guild_limit is not None and job.guild_id is not None
+                and job.priority != Priority.PLAYBACK
+                and self._guild_running[job.guild_id] >= self.guild_limit)
+
+    def _dispatch(self):
+        deferred = []
+        while self._running < self.max_workers and self._queue:
+            job = heapq.heappop(self._queue)
+            if job.future.done():  # Cancelled while queued
+                continue
+            if self._over_guild_limit(job):
+                deferred.append(job)
+                continue
+            self._start(job)
+        for job in deferred:
+            heapq.heappush(self._queue, job)
+
+    def _start(self, job: _Job):
+        if self._executor is None:
+            self._executor = self._executor_factory()
+        self._running += 1
+        if job.guild_id is not None:
+            self._guild_running[job.guild_id] += 1
+
+        inner = asyncio.wrap_future(self._executor.submit(job.fn, *job.args))
+        inner.add_done_callback(lambda f: self._finish(job, f))
+
+    def _finish(self, job: _Job, inner: asyncio.Future):
+        self._running -= 1
+        if job.guild_id is not None:
+            self._guild_running[job.guild_id] -= 1
+            if self._guild_running[job.guild_id] <= 0:
+                del self._guild_running[job.guild_id]
+
+        if not job.future.done():
+            if inner.cancelled():
+                job.future.cancel()
+            elif inner.exception() is not None:
+                job.future.set_exception(inner.exception())
+            else:
+                job.future.set_result(inner.result())
+        self._dispatch()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+# yt-dlp extraction is CPU heavy (signature deciphering runs in Python), so it
+# gets its own processes. 'spawn' avoids forking a process that has threads.
+extraction_pool = PriorityPool(
+    'extraction',
+    lambda: ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context('spawn')),
+    EXTRACTION_WORKERS,
+    guild_limit=GUILD_EXTRACTION_LIMIT)
+
+io_pool = PriorityPool(
+    'io',
+    lambda: ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='io'),
+    IO_WORKERS)
+
+def run_in_processes(fn: Callable, jobs: Iterable[Tuple[Any, tuple]], workers: int,
+                     initializer: Optional[Callable] = None) -> Iterator[Tuple[Any, Future]]:
+    """
+    Runs fn(*args) for every (tag, args) in jobs in a dedicated process pool,
+    for batch work such as analyzing new library files, and yields (tag,
+    future) as they complete. Only a bounded window of jobs is submitted at a
+    time, so jobs may be a lazy iterable of any length. The pool is spawned
+    like extraction_pool: callers run this on a thread of a threaded process.
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer,
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        in_flight: Dict[Future, Any] = {}
+        remaining = iter(jobs)
+        while True:
+            for tag, args in remaining:
+                in_flight[pool.submit(fn, *args)] = tag
+                if len(in_flight) >= workers * 2:
+                    break
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield in_flight.pop(future), future
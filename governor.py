@@ -0,0 +1,299 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import discord
+
+from executors import Priority
+from metrics import Counter, Gauge, LabelValues, register
+
+logger = logging.getLogger(__name__)
+
+# --- FFmpeg Limits ---
+# Every playing or preloaded track is one FFmpeg process. These bound how many
+# run at once and how much of the host they may take.
+FFMPEG_MAX_PROCESSES = int(os.getenv('FFMPEG_MAX_PROCESSES', max(8, (os.cpu_count() or 2) * 4)))
+FFMPEG_GUILD_LIMIT = int(os.getenv('FFMPEG_GUILD_LIMIT', 3))  # Current + preloaded track, plus slack for a seek
+FFMPEG_NICE = int(os.getenv('FFMPEG_NICE', 5))                # Added niceness of playback processes
+FFMPEG_BACKGROUND_NICE = int(os.getenv('FFMPEG_BACKGROUND_NICE', 15))  # Loudness analysis and transcoding
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', 1))
+# Load average per CPU above which new tracks are started in their cheapest form
+FFMPEG_DEGRADE_LOAD = float(os.getenv('FFMPEG_DEGRADE_LOAD', 0.9))
+
+PRELOAD_HEADROOM = max(1, FFMPEG_MAX_PROCESSES // 4)  # Slots preloads leave free for tracks about to play
+DEGRADE_FRACTION = 0.8  # Also degrade once this share of FFMPEG_MAX_PROCESSES is in use
+ADMIT_NOTICE_DELAY = 2  # Seconds a track about to play waits for a free slot before its server is told
+LOAD_SAMPLE_INTERVAL = 2  # Seconds the load average reading is reused for
+
+THREAD_OPTIONS = f'-threads {FFMPEG_THREADS}'
+
+class FFmpegBusy(Exception):
+    """No FFmpeg slot could be had within the limits."""
+
+def lower_priority(niceness: int = FFMPEG_BACKGROUND_NICE):
+    """Process pool initializer: the FFmpeg processes a worker runs inherit its niceness."""
+    try:
+        os.nice(niceness)
+    except (AttributeError, OSError):
+        pass
+
+class FFmpegSlot:
+    """Admission for one FFmpeg process, returned to the governor when its source is cleaned up."""
+    __slots__ = ('governor', 'guild_id', 'degraded', 'preempt', '_released')
+
+    def __init__(self, governor: 'FFmpegGovernor', guild_id: int, degraded: bool):
+        self.governor = governor
+        self.guild_id = guild_id
+        self.degraded = degraded  # Start the track in its cheapest form
+        # Set while the process only serves a preload: stops it (releasing this
+        # slot) and returns True, or False once the track has started playing
+        self.preempt: Optional[Callable[[], bool]] = None
+        self._released = False
+
+    def attach(self, source: discord.AudioSource) -> 'GovernedSource':
+        return GovernedSource(source, self)
+
+    def allow_preemption(self, preempt: Callable[[], bool]):
+        """Lets a track about to play take this slot over while it is only preloading."""
+        self.preempt = preempt
+        with self.governor._lock:
+            if self._released:
+                return
+            self.governor._preemptible[self] = None
+            waiting = self.governor._waiters[0].guild_id if self.governor._waiters else None
+        if waiting is not None:
+            # Admitted before a track started waiting: that track goes first
+            self.governor._preempt(waiting)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.governor._release(self)
+
+class _Waiter:
+    """A track about to play, queued for the next slot released."""
+    __slots__ = ('guild_id', 'loop', 'future')
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.loop = asyncio.get_running_loop()
+        self.future: asyncio.Future = self.loop.create_future()
+
+    def grant(self, slot: FFmpegSlot):
+        # Slots are released from voice player threads too
+        self.loop.call_soon_threadsafe(self._resolve, slot)
+
+    def _resolve(self, slot: FFmpegSlot):
+        if self.future.done():
+            slot.release()  # Withdrawn meanwhile: on to the next waiter
+        else:
+            self.future.set_result(slot)
+
+class GovernedSource(discord.AudioSource):
+    """Wraps a spawned FFmpeg source: lowers its priority and frees its slot on cleanup."""
+
+    def __init__(self, source: discord.AudioSource, slot: FFmpegSlot):
+        self.source = source
+        self.slot = slot
+        # Same attribute discord.py uses, so instrumentation can find the process through the wrapper
+        self._process = getattr(source, '_process', None)
+        if self._process is not None and FFMPEG_NICE:
+            try:
+                os.setpriority(os.PRIO_PROCESS, self._process.pid, FFMPEG_NICE)
+            except (AttributeError, OSError):
+                pass
+
+    def read(self) -> bytes:
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        try:
+            self.source.cleanup()
+        finally:
+            self.slot.release()
+
+class FFmpegGovernor:
+    """
+    Admission control for the FFmpeg processes spawned for playing and
+    preloaded tracks and for the YouTube download cache, counted per guild
+    and capped globally and per guild. Loudness analysis, transcoding and tag
+    reading are not counted here; they run niced, in pools of a fixed size.
+    Tracks about to play may stop a preload to take its slot, or else queue
+    and are handed released slots in the order they asked; preloads and
+    downloads are refused instead, and leave some global headroom. Under CPU
+    pressure, admissions are marked degraded so callers skip expensive filters.
+    """
+
+    def __init__(self, max_processes: int = FFMPEG_MAX_PROCESSES, guild_limit: int = FFMPEG_GUILD_LIMIT,
+                 degrade_load: float = FFMPEG_DEGRADE_LOAD):
+        self.max_processes = max_processes
+        self.guild_limit = guild_limit
+        self.degrade_load = degrade_load
+        self._lock = threading.Lock()  # Slots are released from voice player threads
+        self._live: Dict[int, int] = {}  # guild_id -> processes
+        self._preemptible: Dict[FFmpegSlot, None] = {}  # Preload slots, oldest first
+        self._waiters: Deque[_Waiter] = deque()  # Tracks about to play, oldest first
+        self._total = 0
+        self._load = 0.0
+        self._load_sampled = 0.0
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    def live(self, guild_id: int) -> int:
+        return self._live.get(guild_id, 0)
+
+    def cpu_load(self) -> float:
+        """One-minute load average per CPU (0 where the platform has none)."""
+        now = time.monotonic()
+        if now - self._load_sampled > LOAD_SAMPLE_INTERVAL:
+            self._load_sampled = now
+            try:
+                self._load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            except (AttributeError, OSError):
+                self._load = 0.0
+        return self._load
+
+    @property
+    def under_pressure(self) -> bool:
+        return self._total >= self.max_processes * DEGRADE_FRACTION or self.cpu_load() >= self.degrade_load
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _admit(self, guild_id: int, limit: int) -> Optional[FFmpegSlot]:
+        """Takes a slot for guild_id if there is room under limit. Called with the lock held."""
+        if self._total >= limit or self._live.get(guild_id, 0) >= self.guild_limit:
+            return None
+        self._total += 1
+        self._live[guild_id] = self._live.get(guild_id, 0) + 1
+        return FFmpegSlot(self, guild_id, False)
+
+    def _admitted(self, slot: FFmpegSlot) -> FFmpegSlot:
+        slot.degraded = self.under_pressure
+        FFMPEG_ADMISSIONS.inc('degraded' if slot.degraded else 'admitted')
+        return slot
+
+    def try_acquire(self, guild_id: int, priority: Priority) -> Optional[FFmpegSlot]:
+        limit = self.max_processes if priority == Priority.PLAYBACK else self.max_processes - PRELOAD_HEADROOM
+        with self._lock:
+            slot = self._admit(guild_id, limit)
+        return slot and self._admitted(slot)
+
+    async def acquire(self, guild_id: int, priority: Priority,
+                      on_wait: Optional[Callable[[], None]] = None) -> FFmpegSlot:
+        """
+        Admits one FFmpeg process for guild_id. Other priorities raise
+        FFmpegBusy when there is no room; PLAYBACK waits its turn for a
+        released slot instead (calling on_wait if that takes longer than
+        ADMIT_NOTICE_DELAY) and only raises once withdrawn.
+        """
+        slot = self.try_acquire(guild_id, priority)
+        if slot is not None:
+            return slot
+        if priority != Priority.PLAYBACK:
+            FFMPEG_ADMISSIONS.inc('refused')
+            raise FFmpegBusy(f"FFmpeg limit reached ({self._total} running, "
+                             f"{self.live(guild_id)} in guild {guild_id})")
+        # A stopped preload's slot goes to the oldest waiter, which may be this one
+        self._preempt(guild_id)
+        waiter = _Waiter(guild_id)
+        with self._lock:
+            slot = self._admit(guild_id, self.max_processes)
+            if slot is None:
+                self._waiters.append(waiter)
+        if slot is not None:
+            return self._admitted(slot)
+        FFMPEG_ADMISSIONS.inc('queued')
+        try:
+            try:
+                slot = await asyncio.wait_for(asyncio.shield(waiter.future), ADMIT_NOTICE_DELAY)
+            except asyncio.TimeoutError:
+                if on_wait is not None:
+                    on_wait()
+                slot = await waiter.future
+        except BaseException:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            if not waiter.future.done():
+                waiter.future.cancel()
+            elif not waiter.future.cancelled() and waiter.future.exception() is None:
+                waiter.future.result().release()  # Granted just as the wait was given up
+            raise
+        return self._admitted(slot)
+
+    def withdraw(self, guild_id: int):
+        """Ends the wait of guild_id's tracks for a slot; their acquire raises FFmpegBusy."""
+        with self._lock:
+            withdrawn = [waiter for waiter in self._waiters if waiter.guild_id == guild_id]
+            for waiter in withdrawn:
+                self._waiters.remove(waiter)
+        for waiter in withdrawn:
+            if not waiter.future.done():
+                waiter.future.set_exception(FFmpegBusy(f"Withdrawn from the FFmpeg queue in guild {guild_id}"))
+
+    def _preempt(self, guild_id: int) -> bool:
+        """Stops one preload to free a slot for guild_id. Returns True if one was stopped."""
+        # At its own limit a guild can only give up its own preload; otherwise the oldest anywhere goes
+        own_only = self.live(guild_id) >= self.guild_limit
+        with self._lock:
+            candidates = list(self._preemptible)
+        for slot in candidates:
+            if own_only and slot.guild_id != guild_id:
+                continue
+            with self._lock:
+                self._preemptible.pop(slot, None)
+            if slot.preempt is not None and slot.preempt():
+                FFMPEG_ADMISSIONS.inc('preempted')
+                slot.release()  # Normally already released by the stopped source's cleanup
+                return True
+        return False
+
+    def _release(self, slot: FFmpegSlot):
+        with self._lock:
+            self._preemptible.pop(slot, None)
+            self._total -= 1
+            remaining = self._live.get(slot.guild_id, 0) - 1
+            if remaining > 0:
+                self._live[slot.guild_id] = remaining
+            else:
+                self._live.pop(slot.guild_id, None)
+            granted = self._grant()
+        for waiter, new_slot in granted:
+            waiter.grant(new_slot)
+
+    def _grant(self) -> List[Tuple[_Waiter, FFmpegSlot]]:
+        """Admits the oldest waiters there is room for. Called with the lock held."""
+        granted = []
+        for waiter in list(self._waiters):
+            if self._total >= self.max_processes:
+                break
+            slot = self._admit(waiter.guild_id, self.max_processes)
+            if slot is not None:
+                self._waiters.remove(waiter)
+                granted.append((waiter, slot))
+        return granted
+
+    def live_by_guild(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return {(str(guild_id),): count for guild_id, count in self._live.items()}
+
+FFMPEG_ADMISSIONS = register(Counter(
+    'musicbot_ffmpeg_admissions_total', 'FFmpeg spawn requests by outcome', ['result']))
+
+ffmpeg_governor = FFmpegGovernor()
+
+register(Gauge('musicbot_ffmpeg_processes', 'Running playback FFmpeg processes', ['guild'],
+               ffmpeg_governor.live_by_guild))
+register(Gauge('musicbot_ffmpeg_pressure', 'Whether new tracks start degraded (1) because of CPU or process load',
+               [], lambda: {(): float(ffmpeg_governor.under_pressure)}))
@@ -0,0 +1,622 @@
+import os
+import random
+import sqlite3
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from search import SearchIndex
+from metadata import TrackTags
+from seek_index import SeekIndex, find_seek_point
+from similarity import TrackFeatures
+
+logger = logging.getLogger(__name__)
+
+ID_SNAPSHOT_CACHE_SIZE = 16  # Directories whose track ID lists are kept for sharing between guilds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    dir TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seek_index (
+    id INTEGER PRIMARY KEY,
+    mtime REAL NOT NULL,
+    duration REAL,
+    points BLOB NOT NULL,
+    size INTEGER
+);
+CREATE TABLE IF NOT EXISTS track_tags (
+    id INTEGER PRIMARY KEY,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    codec TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+class LibraryIndex:
+    """
+    In-memory index of the local music library, persisted to SQLite.
+
+    The index is loaded once from disk and then refreshed incrementally: only
+    directories whose mtime changed since the last scan are re-listed, so a
+    rescan of an unchanged tree costs one stat() per directory. All queries
+    are answered from memory and never touch the filesystem.
+    """
+
+    def __init__(self, root: str, extensions: Iterable[str], db_path: str):
+        self.root = os.path.abspath(root)
+        self.extensions = {ext.lower() for ext in extensions}
+        self.db_path = db_path
+
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+
+        # All paths are stored relative to root ('' is the root itself)
+        self._dir_mtimes: Dict[str, float] = {}
+        self._dir_children: Dict[str, List[str]] = {}
+        self._dir_tracks: Dict[str, List[int]] = {}
+        self._paths: Dict[int, str] = {}
+        self._by_stem: Dict[str, List[int]] = {}
+        self._next_id = 1
+        self.search_index = SearchIndex()
+        # Durations of tracks whose seek index has been built (None if probing failed);
+        # the seek points themselves stay on disk until a seek needs them
+        self._durations: Dict[int, Optional[float]] = {}
+        # (mtime, size) of each file when its tags were read, to notice files changed in place
+        self._file_stats: Dict[int, Tuple[float, Optional[int]]] = {}
+        self._tags: Dict[int, TrackTags] = {}
+        self._by_artist: Dict[str, List[int]] = {}
+        self._by_album: Dict[str, List[int]] = {}
+        self.generation = 0  # Bumped on every persisted change, so other processes can notice
+
+        # Immutable per-directory ID lists, shared by every queue that plays that directory
+        self._id_snapshots: "OrderedDict[str, array]" = OrderedDict()
+
+    # ---------------------------------------------
+    # PATH HELPERS
+    # ---------------------------------------------
+    def _abs(self, rel: str) -> str:
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def _rel(self, path: str) -> Optional[str]:
+        path = os.path.abspath(path)
+        if os.path.commonpath([self.root, path]) != self.root:
+            return None
+        rel = os.path.relpath(path, self.root)
+        return '' if rel == '.' else rel
+
+    @staticmethod
+    def _parent(rel: str) -> Optional[str]:
+        return os.path.dirname(rel) if rel else None
+
+    @staticmethod
+    def _stem(rel: str) -> str:
+        return os.path.splitext(os.path.basename(rel))[0].lower()
+
+    # ---------------------------------------------
+    # IN-MEMORY MUTATION (caller holds self._lock)
+    # ---------------------------------------------
+    def _add_track(self, track_id: int, rel: str, rel_dir: str):
+        self._id_snapshots.clear()
+        self._paths[track_id] = rel
+        self._dir_tracks.setdefault(rel_dir, []).append(track_id)
+        self._by_stem.setdefault(self._stem(rel), []).append(track_id)
+        self._next_id = max(self._next_id, track_id + 1)
+        self._index_for_search(track_id)
+
+    def _index_for_search(self, track_id: int):
+        rel = self._paths[track_id]
+        rel_dir = os.path.dirname(rel)
+        tags = self._tags.get(track_id)
+        self.search_index.add(
+            track_id,
+            title=os.path.splitext(os.path.basename(rel))[0],
+            tags=(tags.title, tags.artist, tags.album) if tags else (),
+            context=rel_dir.split(os.sep) if rel_dir else ())
+
+    def _unlink_tags(self, track_id: int):
+        tags = self._tags.pop(track_id, None)
+        if tags is None:
+            return
+        for key, groups in ((tags.artist, self._by_artist), (tags.album, self._by_album)):
+            ids = groups.get(key.lower()) if key else None
+            if ids:
+                ids.remove(track_id)
+                if not ids:
+                    del groups[key.lower()]
+
+    def _set_tags(self, track_id: int, tags: TrackTags):
+        self._unlink_tags(track_id)
+        self._tags[track_id] = tags
+        for key, groups in ((tags.artist, self._by_artist), (tags.album, self._by_album)):
+            if key:
+                groups.setdefault(key.lower(), []).append(track_id)
+
+    def _drop_track(self, track_id: int):
+        rel = self._paths.pop(track_id, None)
+        if rel is None:
+            return
+        self._id_snapshots.clear()
+        self.search_index.remove(track_id)
+        self._durations.pop(track_id, None)
+        self._file_stats.pop(track_id, None)
+        self._unlink_tags(track_id)
+        stem = self._stem(rel)
+        ids = self._by_stem.get(stem)
+        if ids:
+            ids.remove(track_id)
+            if not ids:
+                del self._by_stem[stem]
+
+    def _link_dir(self, rel_dir: str):
+        parent = self._parent(rel_dir)
+        if parent is None:
+            return
+        children = self._dir_children.setdefault(parent, [])
+        name = os.path.basename(rel_dir)
+        if name not in children:
+            children.append(name)
+            children.sort()
+
+    def _drop_dir(self, rel_dir: str):
+        for track_id in self._dir_tracks.pop(rel_dir, []):
+            self._drop_track(track_id)
+        self._dir_mtimes.pop(rel_dir, None)
+        self._dir_children.pop(rel_dir, None)
+        parent = self._parent(rel_dir)
+        if parent is not None and parent in self._dir_children:
+            name = os.path.basename(rel_dir)
+            if name in self._dir_children[parent]:
+                self._dir_children[parent].remove(name)
+
+    # ---------------------------------------------
+    # PERSISTENCE & REFRESH
+    # ---------------------------------------------
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        if 'size' not in {row[1] for row in conn.execute("PRAGMA table_info(seek_index)")}:
+            conn.execute("ALTER TABLE seek_index ADD COLUMN size INTEGER")  # Indexes from older versions
+        return conn
+
+    @staticmethod
+    def _read_generation(conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def stored_generation(self) -> int:
+        """Generation of the index on disk, which may be ahead of this process's copy."""
+        conn = self._connect()
+        try:
+            return self._read_generation(conn)
+        finally:
+            conn.close()
+
+    def load(self):
+        """Loads the persisted index from disk into memory."""
+        conn = self._connect()
+        try:
+            # sqlite3 opens no transaction for SELECTs by itself: without this, each query
+            # could see a different side of a concurrent refresh by another process
+            conn.execute("BEGIN")
+            generation = self._read_generation(conn)
+            dirs = conn.execute("SELECT path, mtime FROM dirs").fetchall()
+            tracks = conn.execute("SELECT id, path, dir FROM tracks ORDER BY path").fetchall()
+            durations = conn.execute("SELECT id, duration, mtime, size FROM seek_index").fetchall()
+            tags = conn.execute("SELECT id, title, artist, album, codec FROM track_tags").fetchall()
+            conn.rollback()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self.generation = generation
+            for rel_dir, mtime in dirs:
+                self._dir_mtimes[rel_dir] = mtime
+                self._dir_children.setdefault(rel_dir, [])
+                self._link_dir(rel_dir)
+            for track_id, rel, rel_dir in tracks:
+                self._add_track(track_id, rel, rel_dir)
+            self._durations = {t: d for t, d, _, _ in durations if t in self._paths}
+            self._file_stats = {t: (m, size) for t, _, m, size in durations if t in self._paths}
+            for track_id, *fields in tags:
+                if track_id in self._paths:
+                    self._set_tags(track_id, TrackTags(*fields))
+                    self._index_for_search(track_id)
+        logger.info(f"Loaded library index: {len(tracks)} tracks in {len(dirs)} directories.")
+
+    def reload(self) -> bool:
+        """
+        Replaces the in-memory index with the one on disk if another process
+        has refreshed it since. The new index is built aside and swapped in,
+        so queries keep being answered while it loads. Returns True if swapped.
+        """
+        if self.stored_generation() == self.generation:
+            return False
+        fresh = LibraryIndex(self.root, self.extensions, self.db_path)
+        fresh.load()
+        with self._lock:
+            self._dir_mtimes = fresh._dir_mtimes
+            self._dir_children = fresh._dir_children
+            self._dir_tracks = fresh._dir_tracks
+            self._paths = fresh._paths
+            self._by_stem = fresh._by_stem
+            self._next_id = fresh._next_id
+            self.search_index = fresh.search_index
+            self._durations = fresh._durations
+            self._file_stats = fresh._file_stats
+            self._tags = fresh._tags
+            self._by_artist = fresh._by_artist
+            self._by_album = fresh._by_album
+            self.generation = fresh.generation
+            self._id_snapshots.clear()
+        return True
+
+    def _scan_dir(self, rel_dir: str) -> Tuple[List[str], List[str]]:
+        subdirs, files = [], []
+        with os.scandir(self._abs(rel_dir)) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in self.extensions:
+                        files.append(entry.name)
+                except OSError:
+                    continue
+        return sorted(subdirs), sorted(files)
+
+    def refresh(self) -> Tuple[int, int]:
+        """
+        Brings the index up to date with the filesystem.
+        Returns (tracks_added, tracks_removed).
+        """
+        with self._refresh_lock:
+            with self._lock:
+                known_mtimes = dict(self._dir_mtimes)
+                known_children = {d: list(c) for d, c in self._dir_children.items()}
+
+            # Walk the tree, only re-listing directories whose mtime changed
+            seen = set()
+            changed: Dict[str, Tuple[float, List[str], List[str]]] = {}
+            stack = ['']
+            while stack:
+                rel_dir = stack.pop()
+                try:
+                    mtime = os.stat(self._abs(rel_dir)).st_mtime
+                except OSError:
+                    continue
+                seen.add(rel_dir)
+
+                if known_mtimes.get(rel_dir) == mtime:
+                    subdirs = known_children.get(rel_dir, [])
+                else:
+                    try:
+                        subdirs, files = self._scan_dir(rel_dir)
+                    except OSError as e:
+                        logger.warning(f"Could not scan {self._abs(rel_dir)}: {e}")
+                        continue
+                    changed[rel_dir] = (mtime, subdirs, files)
+                stack.extend(os.path.join(rel_dir, d) if rel_dir else d for d in subdirs)
+
+            removed_dirs = [d for d in known_mtimes if d not in seen]
+            if not changed and not removed_dirs:
+                return 0, 0
+
+            added_rows, removed_ids = [], []
+            with self._lock:
+                for rel_dir in removed_dirs:
+                    removed_ids.extend(self._dir_tracks.get(rel_dir, []))
+                    self._drop_dir(rel_dir)
+
+                for rel_dir, (mtime, subdirs, files) in changed.items():
+                    self._dir_mtimes[rel_dir] = mtime
+                    self._dir_children[rel_dir] = subdirs
+                    self._link_dir(rel_dir)
+
+                    existing = {self._paths[t]: t for t in self._dir_tracks.get(rel_dir, [])}
+                    current = {os.path.join(rel_dir, f) if rel_dir else f for f in files}
+                    for rel, track_id in existing.items():
+                        if rel not in current:
+                            self._drop_track(track_id)
+                            removed_ids.append(track_id)
+                    self._dir_tracks[rel_dir] = [t for r, t in existing.items() if r in current]
+                    for rel in sorted(current - existing.keys()):
+                        track_id = self._next_id
+                        self._add_track(track_id, rel, rel_dir)
+                        added_rows.append((track_id, rel, rel_dir))
+                    self._dir_tracks[rel_dir].sort(key=self._paths.__getitem__)
+
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany("DELETE FROM dirs WHERE path = ?", ((d,) for d in removed_dirs))
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)",
+                        ((d, m) for d, (m, _, _) in changed.items()))
+                    conn.executemany("DELETE FROM tracks WHERE id = ?", ((t,) for t in removed_ids))
+                    conn.executemany("DELETE FROM seek_index WHERE id = ?", ((t,) for t in removed_ids))
+                    conn.executemany("DELETE FROM track_tags WHERE id = ?", ((t,) for t in removed_ids))
+                    conn.executemany("INSERT INTO tracks (id, path, dir) VALUES (?, ?, ?)", added_rows)
+                    self.generation = self._read_generation(conn) + 1
+                    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)",
+                                 (self.generation,))
+            finally:
+                conn.close()
+
+            logger.info(f"Library refreshed: {len(added_rows)} added, {len(removed_ids)} removed, "
+                        f"{len(changed)} directories rescanned.")
+            return len(added_rows), len(removed_ids)
+
+    # ---------------------------------------------
+    # QUERIES
+    # ---------------------------------------------
+    @property
+    def track_count(self) -> int:
+        return len(self._paths)
+
+    def is_directory(self, path: str) -> bool:
+        rel = self._rel(path)
+        return rel is not None and rel in self._dir_mtimes
+
+    def find_by_name(self, name: str, search_path: Optional[str] = None) -> List[str]:
+        """Returns absolute paths of tracks whose filename (without extension) matches name."""
+        prefix = self._rel(search_path) if search_path else ''
+        if prefix is None:
+            return []
+        with self._lock:
+            rels = [self._paths[t] for t in self._by_stem.get(name.lower(), [])]
+        return [self._abs(r) for r in sorted(rels) if not prefix or r.startswith(prefix + os.sep)]
+
+    def resolve(self, path: str) -> Optional[str]:
+        """
+        Resolves a path relative to the library root (extension optional)
+        to the absolute path of an indexed track.
+        """
+        rel = self._rel(os.path.join(self.root, path))
+        if not rel:
+            return None
+        rel_dir = os.path.dirname(rel)
+        with self._lock:
+            for track_id in self._dir_tracks.get(rel_dir, []):
+                candidate = self._paths[track_id]
+                if candidate == rel or os.path.splitext(candidate)[0] == rel:
+                    return self._abs(candidate)
+        return None
+
+    def track_id(self, path: str) -> Optional[int]:
+        """Returns the ID of the indexed track at path."""
+        rel = self._rel(path)
+        if not rel:
+            return None
+        with self._lock:
+            for track_id in self._dir_tracks.get(os.path.dirname(rel), []):
+                if self._paths[track_id] == rel:
+                    return track_id
+        return None
+
+    def path_of(self, track_id: int) -> Optional[str]:
+        """Returns the absolute path of a track, or None if it has since been removed."""
+        rel = self._paths.get(track_id)
+        return self._abs(rel) if rel is not None else None
+
+    def track_ids_under(self, path: str) -> Sequence[int]:
+        """
+        Returns the IDs of every track at or below the given directory as a
+        compact array. The array is shared between callers and must not be modified.
+        """
+        rel = self._rel(path)
+        if rel is None:
+            return array('q')
+        with self._lock:
+            ids = self._id_snapshots.get(rel)
+            if ids is None:
+                ids = array('q', (t for d, _ in self._walk(rel) for t in self._dir_tracks.get(d, [])))
+                self._id_snapshots[rel] = ids
+                while len(self._id_snapshots) > ID_SNAPSHOT_CACHE_SIZE:
+                    self._id_snapshots.popitem(last=False)
+            else:
+                self._id_snapshots.move_to_end(rel)
+            return ids
+
+    def search(self, query: str, limit: int = 10) -> List[str]:
+        """Returns absolute paths of the best fuzzy/prefix matches for query, best first."""
+        with self._lock:
+            return [self._abs(self._paths[track_id])
+                    for track_id, _ in self.search_index.search(query, limit)]
+
+    def _walk(self, rel_dir: str):
+        """Yields (rel_dir, depth) in pre-order over the in-memory tree."""
+        stack = [(rel_dir, 0)]
+        while stack:
+            current, depth = stack.pop()
+            yield current, depth
+            children = self._dir_children.get(current, [])
+            for name in reversed(children):
+                stack.append((os.path.join(current, name) if current else name, depth + 1))
+
+    def songs_under(self, path: str) -> List[str]:
+        """Returns absolute paths of every track at or below the given directory."""
+        rel = self._rel(path)
+        if rel is None:
+            return []
+        with self._lock:
+            return [self._abs(self._paths[t])
+                    for d, _ in self._walk(rel)
+                    for t in self._dir_tracks.get(d, [])]
+
+    # ---------------------------------------------
+    # METADATA & SEEK INDEX
+    # ---------------------------------------------
+    def tracks_needing_ingest(self) -> List[Tuple[int, str]]:
+        """
+        Returns (track ID, absolute path) of every track whose tags have not
+        been read yet, or whose file's mtime or size changed since they were.
+        Stats every file: files rewritten in place (e.g. retagged) leave
+        their directory's mtime alone.
+        """
+        with self._lock:
+            paths = list(self._paths.items())
+            known = dict(self._file_stats)
+        missing = []
+        for track_id, rel in paths:
+            path = self._abs(rel)
+            stored = known.get(track_id)
+            if stored is None:
+                missing.append((track_id, path))
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed meanwhile: the next refresh drops it
+            mtime, size = stored
+            if stat.st_mtime != mtime or (size is not None and stat.st_size != size):
+                missing.append((track_id, path))
+        return missing
+
+    def store_metadata(self, rows: List[Tuple[int, SeekIndex, TrackTags]]):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO seek_index (id, mtime, duration, points, size) VALUES (?, ?, ?, ?, ?)",
+                    ((t, i.mtime, i.duration, i.points, i.size) for t, i, _ in rows))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO track_tags (id, title, artist, album, codec) VALUES (?, ?, ?, ?, ?)",
+                    ((t, *tags) for t, _, tags in rows))
+        finally:
+            conn.close()
+        with self._lock:
+            for track_id, index, tags in rows:
+                if track_id in self._paths:
+                    self._durations[track_id] = index.duration
+                    self._file_stats[track_id] = (index.mtime, index.size)
+                    self._set_tags(track_id, tags)
+                    self._index_for_search(track_id)
+
+    def tags(self, track_id: int) -> Optional[TrackTags]:
+        return self._tags.get(track_id)
+
+    def display_name(self, track_id: int) -> str:
+        """'Artist - Title' from the file's tags, or its file name until they have been read."""
+        tags = self._tags.get(track_id)
+        if tags and tags.title:
+            return f"{tags.artist} - {tags.title}" if tags.artist else tags.title
+        path = self.path_of(track_id)
+        return os.path.basename(path) if path else 'Unknown'
+
+    def is_playable(self, track_id: int) -> bool:
+        """False only for files known to hold no readable audio (despite their extension)."""
+        tags = self._tags.get(track_id)
+        return tags is None or tags.codec is not None
+
+    def total_duration(self, track_ids: Iterable[int]) -> Tuple[float, int]:
+        """Returns (summed duration, number of tracks whose duration is unknown)."""
+        total, unknown = 0.0, 0
+        durations = self._durations
+        for track_id in track_ids:
+            duration = durations.get(track_id)
+            if duration:
+                total += duration
+            else:
+                unknown += 1
+        return total, unknown
+
+    def _tracks_by(self, groups: Dict[str, List[int]], name: str) -> Tuple[Optional[str], List[int]]:
+        key = name.strip().lower()
+        with self._lock:
+            if key not in groups:
+                # Fall back to the shortest name containing the query ('beatles' -> 'the beatles')
+                matches = [k for k in groups if key in k]
+                if not matches:
+                    return None, []
+                key = min(matches, key=len)
+            ids = sorted(groups[key], key=self._paths.__getitem__)
+            tags = self._tags[ids[0]]
+        return (tags.artist if groups is self._by_artist else tags.album), ids
+
+    def tracks_by_artist(self, name: str) -> Tuple[Optional[str], List[int]]:
+        """Returns (artist as tagged, track IDs) for the best matching artist."""
+        return self._tracks_by(self._by_artist, name)
+
+    def tracks_by_album(self, name: str) -> Tuple[Optional[str], List[int]]:
+        """Returns (album as tagged, track IDs) for the best matching album."""
+        return self._tracks_by(self._by_album, name)
+
+    def duration(self, track_id: int) -> Optional[float]:
+        return self._durations.get(track_id)
+
+    def artist_key(self, track_id: int) -> Optional[str]:
+        """What artist-spread shuffling groups by: the tagged artist, else the track's folder."""
+        tags = self._tags.get(track_id)
+        if tags and tags.artist:
+            return tags.artist.lower()
+        rel = self._paths.get(track_id)
+        return os.path.dirname(rel) if rel is not None else None
+
+    def random_track(self) -> Optional[int]:
+        ids = self.track_ids_under(self.root)
+        return random.choice(ids) if ids else None
+
+    def similarity_features(self, gain_db: Callable[[str], Optional[float]]) -> List[TrackFeatures]:
+        """Features of every playable track, in path order. gain_db looks up a file's loudness gain."""
+        with self._lock:
+            rows = sorted((rel, t, self._tags.get(t), self._durations.get(t)) for t, rel in self._paths.items())
+        features = []
+        for rel, track_id, tags, duration in rows:
+            if tags is not None and tags.codec is None:
+                continue  # No readable audio
+            title = tags.title if tags and tags.title else os.path.splitext(os.path.basename(rel))[0]
+            features.append(TrackFeatures(track_id, os.path.dirname(rel), tags.artist if tags else None,
+                                          tags.album if tags else None, title, tags.codec if tags else None,
+                                          duration, gain_db(self._abs(rel))))
+        return features
+
+    def seek_point(self, track_id: int, position: float) -> Optional[Tuple[float, int]]:
+        """
+        Returns the indexed (seconds, byte offset) closest before position, or
+        None if the track has no usable index (not built yet, or the file changed since).
+        """
+        path = self.path_of(track_id)
+        if path is None:
+            return None
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT mtime, points FROM seek_index WHERE id = ?", (track_id,)).fetchone()
+        finally:
+            conn.close()
+        try:
+            if row is None or not row[1] or os.stat(path).st_mtime != row[0]:
+                return None
+        except OSError:
+            return None
+        return find_seek_point(row[1], position)
+
+    def dir_page(self, path: str, start: int, count: int) -> Optional[Tuple[List[str], List[str], int]]:
+        """
+        Returns one page of a directory listing: (subfolder names, track file
+        names, total entries), folders first. Only the requested slice is built.
+        """
+        rel = self._rel(path)
+        if rel is None or rel not in self._dir_mtimes:
+            return None
+        with self._lock:
+            children = self._dir_children.get(rel, [])
+            tracks = self._dir_tracks.get(rel, [])
+            folders = children[start:start + count]
+            track_start = max(0, start - len(children))
+            track_count = count - len(folders)
+            names = [os.path.basename(self._paths[t]) for t in tracks[track_start:track_start + track_count]]
+            return folders, names, len(children) + len(tracks)
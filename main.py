@@ -1,8 +1,13 @@
 import os
-import random
+import sys
+import json
+import time
+import hashlib
 import asyncio
 import logging
-from typing import Optional, List, Dict
+import itertools
+import subprocess
+from typing import Callable, Optional, List, Dict, Sequence, Tuple
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
@@ -10,6 +15,7 @@ from dotenv import load_dotenv
 # ---------------------------------------------
 # SETUP & CONFIG
 # ---------------------------------------------
+STARTED_AT = time.monotonic()  # For the time-to-ready report where /proc is unavailable
 load_dotenv()
 BOT_TOKEN = os.getenv('DISCORD_TOKEN')
 
@@ -17,39 +23,213 @@ logger = logging.getLogger('discord')
 
 MUSIC_DIRECTORY = "[your audio path here]"
 ALLOWED_EXTENSIONS = {'.mp3', '.wav', '.flac', '.ogg', '.m4a'}
-
-from youtube import create_youtube_audio_source, get_youtube_info, get_stream_url
+LIBRARY_INDEX_PATH = "library.db"
+LIBRARY_RESCAN_INTERVAL = 300  # Seconds between incremental library rescans
+NORMALIZED_CACHE_DIR = "normalized_cache"
+NORMALIZE_TRANSCODE = False  # Also store pre-normalized Opus copies (a second copy of the library on disk)
+NORMALIZE_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+STATE_STORE_PATH = "guild_state.db"
+STATE_FLUSH_INTERVAL = 5  # Seconds between write-behind snapshots of guild queues
+SIMILARITY_INDEX_PATH = "similarity.db"
+COMMAND_SYNC_PATH = "command_sync.json"  # Hash of the slash commands last synced, per application
+AUDIO_RELAY = True  # Stream YouTube audio through a local buffering relay shared by all guilds
+
+# --- Sharding ---
+# SHARD_COUNT > 0 runs an AutoShardedBot; SHARD_PROCESSES > 1 splits the shards
+# across that many processes, launched and supervised by this script. SHARD_IDS
+# is set by the launcher for each child. Processes share the on-disk caches.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', 0))
+SHARD_PROCESSES = int(os.getenv('SHARD_PROCESSES', 1))
+SHARD_IDS = [int(i) for i in os.getenv('SHARD_IDS', '').split(',') if i.strip()]
+# Only one process rescans the library, normalizes files and syncs slash commands
+IS_PRIMARY = not SHARD_IDS or 0 in SHARD_IDS
+SHARD_RESTART_DELAY = 5  # Seconds before restarting a crashed shard process (doubles per crash)
+
+# --- Metrics ---
+# Prometheus text endpoint; 0 disables it. Shard processes add their first shard ID to the port.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+from youtube import create_youtube_audio_source, get_youtube_info, get_stream_url, invalidate_stream_url, warm_up
+from library import LibraryIndex
+from queues import Track, TrackQueue, YouTubeTrack, track_kind
+from state_store import GuildStateStore
+from executors import Priority, extraction_pool, io_pool
+from normalize import NormalizationCache
+from relay import audio_relay
+from views import LibraryBrowser, QueueBrowser
+from mixer import GuildMixer
+from similarity import RecentTracks, SimilarityIndex
+from governor import THREAD_OPTIONS, FFmpegBusy, ffmpeg_governor
+from downloads import DOWNLOAD_CACHE_ENABLED, DOWNLOAD_CACHE_LOOKUPS, create_cached_audio_source, download_cache
+import metrics
+import metadata
+
+library = LibraryIndex(MUSIC_DIRECTORY, ALLOWED_EXTENSIONS, LIBRARY_INDEX_PATH)
+normalizer = NormalizationCache(NORMALIZED_CACHE_DIR, transcode=NORMALIZE_TRANSCODE)
+state_store = GuildStateStore(STATE_STORE_PATH)
+similarity = SimilarityIndex(SIMILARITY_INDEX_PATH)
+library_loaded = asyncio.Event()
+library_task: Optional[asyncio.Task] = None
+normalize_task: Optional[asyncio.Task] = None
+metadata_task: Optional[asyncio.Task] = None
+similarity_task: Optional[asyncio.Task] = None
+state_task: Optional[asyncio.Task] = None
+metrics_runner = None
 
 # Prevent premature task termination by the Python garbage collector
 background_tasks = set()
 
-def create_normalized_audio_source(file_path: str) -> discord.FFmpegPCMAudio:
-    options = {
-        'options': '-af "dynaudnorm=f=200:g=15:p=0.95"'
-    }
-    return discord.FFmpegPCMAudio(file_path, **options)
+def create_normalized_audio_source(file_path: str, start_at: float = 0.0,
+                                   seek_point: Optional[Tuple[float, int]] = None,
+                                   degraded: bool = False) -> discord.AudioSource:
+    """
+    Creates a loudness-normalized source for a library file, starting start_at
+    seconds in. seek_point is the file's indexed (seconds, byte offset) before
+    start_at: FFmpeg then skips straight to that byte and only decodes the few
+    seconds that remain, instead of estimating or decoding its way there.
+    When degraded (the host is under load), files without an offline loudness
+    pass play unnormalized rather than through dynaudnorm.
+    """
+    before_options = f'-ss {start_at:.2f}' if start_at else ''
+
+    # Prefer the offline loudness pass: a pre-normalized copy or a static gain
+    # costs far less than running dynaudnorm in real time
+    rendition = normalizer.lookup(file_path)
+    with metrics.stage('ffmpeg_spawn'):
+        if rendition and rendition.opus_path and os.path.exists(rendition.opus_path):
+            # Already 48kHz Opus: remux straight through without decoding/re-encoding
+            return discord.FFmpegOpusAudio(rendition.opus_path, codec='opus',
+                                           before_options=f'{THREAD_OPTIONS} {before_options}')
+
+        options = ''
+        if start_at and seek_point:
+            point_time, byte_offset = seek_point
+            before_options = f'-skip_initial_bytes {byte_offset}'
+            options = f'-ss {start_at - point_time:.3f} '
+        before_options = f'{THREAD_OPTIONS} {before_options}'
+        if rendition:
+            return discord.FFmpegPCMAudio(file_path, before_options=before_options,
+                                          options=options + f'-af "volume={rendition.gain_db}dB"')
+        if degraded:
+            return discord.FFmpegPCMAudio(file_path, before_options=before_options, options=options)
+
+        options = {
+            'before_options': before_options,
+            'options': options + '-af "dynaudnorm=f=200:g=15:p=0.95"'
+        }
+        return discord.FFmpegPCMAudio(file_path, **options)
 
 MAX_QUEUE_SIZE = 100
+SEARCH_RESULT_LIMIT = 10
+SEARCH_SELECTION_TIMEOUT = 30  # Seconds to wait for a search result to be picked
+YT_PREFETCH_COUNT = 3  # Upcoming YouTube entries whose stream URLs are resolved ahead of time
+PRELOAD_LEAD = 10      # Seconds before the current track (or its crossfade) ends to spawn FFmpeg for the next one
+CROSSFADE_SECONDS = 0.0  # Default overlap between consecutive tracks; 0 plays them back to back
+MAX_CROSSFADE_SECONDS = 12
+RADIO_HISTORY = 50     # Recently played library tracks the radio avoids repeating
+RADIO_RANDOM_TRIES = 5 # Random picks tried for one not played recently, when the similarity index has none
+RADIO_MAX_PICKS = 5    # Failing radio picks in a row before playback stops
 
 # ---------------------------------------------
 # STATE MANAGEMENT
 # ---------------------------------------------
 class GuildState:
-    def __init__(self):
-        self.is_playing_dj = False
-        self.is_paused_dj = False
-        self.dj_queue: List[str] = []
-        
-        self.yt_queue: List[Dict] = []
-        self.yt_now_playing: Optional[Dict] = None 
-        
-        self.is_switching_sources = False
+    __slots__ = ('guild_id', 'text_channel_id', 'queue', 'now_playing', 'queue_generation', 'is_starting',
+                 'yt_prefetch_tasks', 'mixer', 'preload_task', 'crossfade', 'radio', 'radio_pick', 'history',
+                 'track_started_at', 'track_paused_at', 'track_offset', 'resume_point', 'pending_seek')
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.text_channel_id: Optional[int] = None  # Where playback messages go
+        self.queue = TrackQueue()  # Library tracks and YouTube videos, in play order
+        self.now_playing: Optional[Track] = None
+        self.queue_generation = 0  # Bumped whenever the queue is cleared, to stop in-flight playlist ingestion
+        self.is_starting = False   # play_next is opening a track; others wait for it instead of racing
+
+        self.yt_prefetch_tasks: Dict[str, asyncio.Future] = {}
+
+        # Plays the current track and the preloaded next one, see start_playback
+        self.mixer: Optional[GuildMixer] = None
+        self.preload_task: Optional[asyncio.Task] = None
+        self.crossfade = CROSSFADE_SECONDS
+
+        # Radio: when the queue runs out, similar library tracks keep playing
+        self.radio = False
+        self.radio_pick: Optional[int] = None  # The queued radio track, which tracks queued by users go ahead of
+        self.history = RecentTracks(RADIO_HISTORY)
+
+        # Playback clock for the current track (monotonic time)
+        self.track_started_at: float = 0.0
+        self.track_paused_at: Optional[float] = None
+        self.track_offset: float = 0.0
+        # (source, track, position) restored from a snapshot, waiting for !restore
+        self.resume_point: Optional[Tuple[str, Track, float]] = None
+        # Position the next track starts at, set by !seek before it restarts the current one
+        self.pending_seek: Optional[float] = None
+
+    def start_clock(self, offset: float = 0.0):
+        self.track_started_at = time.monotonic()
+        self.track_paused_at = None
+        self.track_offset = offset
+
+    def pause_clock(self):
+        if self.track_paused_at is None:
+            self.track_paused_at = time.monotonic()
+
+    def resume_clock(self):
+        if self.track_paused_at is not None:
+            self.track_started_at += time.monotonic() - self.track_paused_at
+            self.track_paused_at = None
+
+    @property
+    def position(self) -> float:
+        """Seconds into the current track."""
+        if not self.track_started_at:
+            return 0.0
+        now = self.track_paused_at if self.track_paused_at is not None else time.monotonic()
+        return self.track_offset + now - self.track_started_at
+
+    def now_playing_point(self) -> Optional[Tuple[str, Track, float]]:
+        """(source, track, position) of the current track, if any."""
+        if self.now_playing is None:
+            return None
+        return (track_kind(self.now_playing), self.now_playing, self.position)
+
+    def snapshot(self) -> Optional[Dict]:
+        """JSON-serializable queue state, or None if there is nothing worth restoring."""
+        point = self.now_playing_point() or self.resume_point
+        if point:
+            source, track, position = point
+            now_playing = [source, track.to_entry() if source == 'yt' else track, round(position, 1)]
+        else:
+            now_playing = None
+
+        if not now_playing and not self.queue:
+            return None
+        return {
+            'text_channel_id': self.text_channel_id,
+            'now_playing': now_playing,
+            'queue': self.queue.to_snapshot(),
+            'radio': self.radio,
+        }
+
+    def restore(self, snapshot: Dict):
+        self.text_channel_id = snapshot.get('text_channel_id')
+        self.radio = snapshot.get('radio', False)
+        self.queue = TrackQueue.from_snapshot(snapshot['queue'], library.track_ids_under, library.artist_key)
+        now_playing = snapshot.get('now_playing')
+        if now_playing:
+            source, track, position = now_playing
+            if source == 'yt':
+                track = YouTubeTrack.from_entry(track)
+            self.resume_point = (source, track, position)
 
 guild_states: Dict[int, GuildState] = {}
 
 def get_guild_state(guild_id: int) -> GuildState:
     if guild_id not in guild_states:
-        guild_states[guild_id] = GuildState()
+        guild_states[guild_id] = GuildState(guild_id)
     return guild_states[guild_id]
 
 # ---------------------------------------------
@@ -58,7 +238,11 @@ def get_guild_state(guild_id: int) -> GuildState:
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True 
-bot = commands.Bot(command_prefix="!", intents=intents)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS or None)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
 
 @bot.event
 async def on_ready():
@@ -66,11 +250,90 @@ async def on_ready():
     print('------')
     print(f'Guilds: {[guild.name for guild in bot.guilds]}')
     print('------')
+    # on_ready fires again after reconnects, only start maintenance once
+    global library_task, normalize_task, metadata_task, similarity_task, state_task, metrics_runner
+    if library_task is None:
+        ready = metrics.process_age()
+        metrics.record_ready(ready if ready is not None else time.monotonic() - STARTED_AT)
+        logger.info(f"Ready {metrics.ready_seconds():.2f}s after start.")
+
+        # Neither holds up playback: yt-dlp and the slash commands are only needed later
+        startup_tasks = [asyncio.create_task(warm_up())]
+        if IS_PRIMARY:
+            startup_tasks.append(asyncio.create_task(sync_command_tree()))
+        for task in startup_tasks:
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+
+        library_task = asyncio.create_task(maintain_library())
+        normalize_task = asyncio.create_task(maintain_normalization())
+        if IS_PRIMARY:
+            metadata_task = asyncio.create_task(maintain_metadata())
+        similarity_task = asyncio.create_task(maintain_similarity())
+        state_task = asyncio.create_task(persist_guild_states())
+        if AUDIO_RELAY:
+            try:
+                # Each shard process buffers in its own directory
+                await audio_relay.start(instance='shards-' + '-'.join(map(str, SHARD_IDS)) if SHARD_IDS else 'main')
+            except OSError as e:
+                logger.error(f"Could not start the audio relay, streaming directly: {e}")
+        if DOWNLOAD_CACHE_ENABLED:
+            try:
+                await download_cache.start()
+            except OSError as e:
+                logger.error(f"Could not start the YouTube download cache: {e}")
+        if METRICS_PORT:
+            port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+            try:
+                metrics_runner = await metrics.start_server(METRICS_HOST, port)
+            except OSError as e:
+                logger.error(f"Could not serve metrics on port {port}: {e}")
+
+def command_tree_hash() -> str:
+    """Fingerprint of the slash command definitions, to tell whether Discord needs them again."""
+    payload = []
+    for command in bot.tree.get_commands():
+        try:
+            payload.append(command.to_dict(bot.tree))
+        except TypeError:
+            payload.append(command.to_dict())  # discord.py < 2.4
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_command_hashes() -> Dict[str, str]:
+    try:
+        with open(COMMAND_SYNC_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_command_hashes(hashes: Dict[str, str]):
+    tmp_path = COMMAND_SYNC_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(hashes, f)
+    os.replace(tmp_path, COMMAND_SYNC_PATH)
+
+async def sync_command_tree():
+    """Syncs slash commands with Discord, only if they changed since the last sync (it is rate limited)."""
+    digest = command_tree_hash()
+    application = str(bot.application_id)
+    hashes = await io_pool.run(Priority.BACKGROUND, None, load_command_hashes)
+    if hashes.get(application) == digest:
+        logger.info("Slash commands unchanged, skipping sync.")
+        return
     try:
         synced = await bot.tree.sync()
         logger.info(f"Synced {len(synced)} command(s).")
     except Exception as e:
-        logger.error("Error syncing commands:", exc_info=e)
+        return logger.error("Error syncing commands:", exc_info=e)
+    hashes[application] = digest
+    await io_pool.run(Priority.BACKGROUND, None, save_command_hashes, hashes)
+
+@bot.event
+async def on_command(ctx):
+    metrics.COMMANDS_TOTAL.inc(ctx.command.qualified_name)
+    # Time from the user sending the message to its handler starting
+    received = (discord.utils.utcnow() - ctx.message.created_at).total_seconds()
+    metrics.STAGE_SECONDS.observe(max(0.0, received), 'command_receipt')
 
 @bot.event
 async def on_voice_state_update(member, before, after):
@@ -84,13 +347,10 @@ async def on_voice_state_update(member, before, after):
             non_bot_members = [m for m in vc.channel.members if not m.bot]
             if len(non_bot_members) == 0:
                 guild_state = get_guild_state(member.guild.id)
-                guild_state.yt_queue.clear()
-                guild_state.dj_queue.clear()
-                guild_state.yt_now_playing = None
-                guild_state.is_playing_dj = False
-                guild_state.is_paused_dj = False # Added missing reset
-                guild_state.is_switching_sources = False
-                
+                clear_queue(guild_state)
+                guild_state.now_playing = None
+                guild_state.resume_point = None
+
                 await vc.disconnect()
                 logger.info(f"Disconnected from {before.channel.name} due to inactivity.")
 
@@ -98,57 +358,250 @@ async def on_voice_state_update(member, before, after):
 async def commands_slash(interaction: discord.Interaction):
     response = (
         "```DJ Commands:\n"
-        "!dj_play [song]:  Play a specified local song (name or subdirectory path)\n"
-        "!dj_play:         Shuffle play all local songs\n"
-        "!dj_pause:        Pause current song\n"
-        "!dj_resume:       Resume paused song\n"
-        "!dj_skip:         Skip current song\n"
-        "!dj_list:         List all available music\n"
-        "!dj_stop:         Stop music playback and disconnect\n"
+        "!dj_play [song]:  Queue a specified local song (name or subdirectory path)\n"
+        "!dj_play:         Queue all local songs, shuffled\n"
+        "!dj_artist <name>: Queue every local song by an artist, shuffled\n"
+        "!dj_album <name>: Queue a local album, shuffled\n"
+        "!dj_list [folder]: Browse the music library page by page\n"
         "\nYouTube Commands:\n"
-        "!yt_play [song]:  Play a specified YouTube video or playlist (name or URL)\n"
-        "!yt_pause:        Pause current video\n"
-        "!yt_resume:       Resume paused video\n"
-        "!yt_skip:         Skip current video\n"
-        "!yt_queue:        Show the YouTube queue\n"
-        "!yt_clear:        Clear the YouTube queue\n"
-        "!yt_stop:         Stop YouTube playback and disconnect```"
+        "!yt_play [song]:  Queue a specified YouTube video or playlist (name or URL)\n"
+        "!yt_clear:        Remove the YouTube videos from the queue\n"
+        "\nGeneral Commands:\n"
+        "!pause / !resume: Pause or resume the current track\n"
+        "!skip:            Skip the current track\n"
+        "!queue:           Browse the queue page by page\n"
+        "!clear:           Clear the queue\n"
+        "!radio [on|off]:  Keep playing similar local songs when the queue runs out\n"
+        "!stop:            Stop playback and disconnect\n"
+        "!seek [position]: Jump to a position in the current track (1:30, +15, -15)\n"
+        "!restore [pos]:   Resume the queue saved before a restart\n"
+        "!crossfade [sec]: Show or set the overlap between tracks (0 = gapless)\n"
+        "!stats:           Show playback latency and load statistics```"
     )
     await interaction.response.send_message(response)
 
 # ---------------------------------------------
 # HELPER FUNCTIONS
 # ---------------------------------------------
+async def maintain_library():
+    """Loads the persisted library index, then keeps it fresh with incremental rescans."""
+    try:
+        await io_pool.run(Priority.BACKGROUND, None, library.load)
+    except Exception as e:
+        logger.error("Error loading library index:", exc_info=e)
+    if library.track_count:
+        library_loaded.set()
+
+    while True:
+        try:
+            if IS_PRIMARY:
+                await io_pool.run(Priority.BACKGROUND, None, library.refresh)
+            # Other shard processes pick up the primary's rescans from disk
+            elif await io_pool.run(Priority.BACKGROUND, None, library.reload):
+                logger.info(f"Reloaded library index: {library.track_count} tracks.")
+        except Exception as e:
+            logger.error("Error refreshing library index:", exc_info=e)
+        # Even if still empty (e.g. the primary has not scanned yet): commands report that themselves
+        library_loaded.set()
+        await asyncio.sleep(LIBRARY_RESCAN_INTERVAL)
+
+async def maintain_normalization():
+    """Measures loudness (and transcodes) new library files in a background process pool."""
+    try:
+        await io_pool.run(Priority.BACKGROUND, None, normalizer.load)
+    except Exception as e:
+        logger.error("Error loading loudness measurements:", exc_info=e)
+    while not IS_PRIMARY:
+        # Only the primary process transcodes; the rest pick up its results
+        await asyncio.sleep(LIBRARY_RESCAN_INTERVAL)
+        try:
+            await io_pool.run(Priority.BACKGROUND, None, normalizer.load)
+        except Exception as e:
+            logger.error("Error reloading loudness measurements:", exc_info=e)
+    while True:
+        await library_loaded.wait()
+        try:
+            all_songs = await io_pool.run(Priority.BACKGROUND, None, get_all_songs, MUSIC_DIRECTORY)
+            # An empty library more likely means an unmounted share than deleted music
+            if all_songs:
+                await io_pool.run(Priority.BACKGROUND, None, normalizer.prune, all_songs)
+            # Runs for as long as the backlog lasts, so it gets its own thread rather than an io_pool slot
+            processed = await asyncio.to_thread(normalizer.process, all_songs, NORMALIZE_WORKERS)
+            if processed:
+                logger.info(f"Normalized {processed} new files.")
+        except Exception as e:
+            logger.error("Error normalizing library:", exc_info=e)
+        await asyncio.sleep(LIBRARY_RESCAN_INTERVAL)
+
+async def maintain_metadata():
+    """Reads tags, durations and seek indexes of new or changed library files in a process pool."""
+    while True:
+        await library_loaded.wait()
+        try:
+            pending = await io_pool.run(Priority.BACKGROUND, None, library.tracks_needing_ingest)
+            # Like normalization, a long backlog gets its own thread rather than an io_pool slot
+            ingested = await asyncio.to_thread(
+                metadata.ingest_files, pending, NORMALIZE_WORKERS, library.store_metadata)
+            if ingested:
+                logger.info(f"Read tags of {ingested} files.")
+        except Exception as e:
+            logger.error("Error reading library metadata:", exc_info=e)
+        await asyncio.sleep(LIBRARY_RESCAN_INTERVAL)
+
+async def maintain_similarity():
+    """Keeps the radio's similarity index in step with the library's tags and loudness measurements."""
+    try:
+        await io_pool.run(Priority.BACKGROUND, None, similarity.load)
+    except Exception as e:
+        logger.error("Error loading similarity index:", exc_info=e)
+    while True:
+        await library_loaded.wait()
+        try:
+            if IS_PRIMARY:
+                features = await io_pool.run(Priority.BACKGROUND, None, library.similarity_features,
+                                             lambda path: getattr(normalizer.lookup(path, verify=False), 'gain_db', None))
+                # Comparing every track with every other can take a while, so not on an io_pool slot
+                indexed = await asyncio.to_thread(similarity.update, features)
+                if indexed:
+                    logger.info(f"Built similarity index for {indexed} tracks.")
+            # Other shard processes pick up the primary's index from disk
+            elif await io_pool.run(Priority.BACKGROUND, None, similarity.reload):
+                logger.info("Reloaded similarity index.")
+        except Exception as e:
+            logger.error("Error updating similarity index:", exc_info=e)
+        await asyncio.sleep(LIBRARY_RESCAN_INTERVAL)
+
+async def restore_guild_states() -> Dict[int, str]:
+    """Restores queues saved before the last shutdown and offers to resume them."""
+    try:
+        saved = await io_pool.run(Priority.BACKGROUND, None, state_store.load_all)
+    except Exception as e:
+        logger.error("Error loading guild snapshots:", exc_info=e)
+        return {}
+    # DJ queues reference library directories, which must be indexed to be rebuilt
+    await library_loaded.wait()
+
+    for guild_id, encoded in saved.items():
+        guild = bot.get_guild(guild_id)
+        guild_state = get_guild_state(guild_id)
+        if guild is None or guild_state.snapshot() is not None:
+            continue
+        try:
+            guild_state.restore(json.loads(encoded))
+        except Exception as e:
+            logger.warning(f"Could not restore state for guild {guild_id}: {e}")
+            continue
+
+        channel = guild.get_channel(guild_state.text_channel_id) if guild_state.text_channel_id else None
+        queued = len(guild_state.queue)
+        if channel is None or not (guild_state.resume_point or queued):
+            continue
+        msg = "I was restarted. "
+        if guild_state.resume_point:
+            _, track, position = guild_state.resume_point
+            title = describe_track(track)[0]
+            msg += f"**{title}** was playing at {format_position(position)}"
+            msg += f" with {queued} more queued. " if queued else ". "
+        else:
+            msg += f"{queued} songs were queued. "
+        msg += "Use `!restore` to pick up where we left off."
+        try:
+            await channel.send(msg)
+        except discord.HTTPException as e:
+            logger.warning(f"Could not send restore offer to guild {guild_id}: {e}")
+    logger.info(f"Restored {len(saved)} guild snapshot(s).")
+    return saved
+
+async def persist_guild_states():
+    """Write-behind task: periodically saves changed guild snapshots off the event loop."""
+    last_written: Dict[int, Optional[str]] = dict(await restore_guild_states())
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        changes = {}
+        for guild_id, guild_state in list(guild_states.items()):
+            snapshot = guild_state.snapshot()
+            encoded = json.dumps(snapshot) if snapshot else None
+            if last_written.get(guild_id) != encoded:
+                changes[guild_id] = encoded
+        if not changes:
+            continue
+        try:
+            await io_pool.run(Priority.BACKGROUND, None, state_store.save_many, changes)
+            last_written.update(changes)
+        except Exception as e:
+            logger.error("Error saving guild snapshots:", exc_info=e)
+
+def parse_position(text: str, current: float) -> Optional[float]:
+    """Parses '90', '1:30' or '1:02:03' as an absolute position, '+15' / '-15' relative to current."""
+    text = text.strip()
+    if not text:
+        return None
+    sign = text[0] if text[0] in '+-' else ''
+    try:
+        seconds = 0.0
+        for part in text.lstrip('+-').split(':'):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        return None
+    if sign == '+':
+        return current + seconds
+    if sign == '-':
+        return max(0.0, current - seconds)
+    return seconds
+
+def format_position(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+def format_total_duration(track_ids: Sequence[int]) -> str:
+    """', 1:23:45' for a set of tracks, counting only those whose length is known."""
+    total, unknown = library.total_duration(track_ids)
+    if not total:
+        return ""
+    minutes, seconds = divmod(int(total), 60)
+    hours, minutes = divmod(minutes, 60)
+    text = f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+    return f", {'at least ' if unknown else ''}{text}"
+
 def find_song_paths(target_name, search_path):
-    matches = []
-    target_lower = target_name.lower()
-    for root, dirs, files in os.walk(search_path):
-        for file in files:
-            _, ext = os.path.splitext(file)
-            if ext.lower() in ALLOWED_EXTENSIONS:
-                fname_no_ext = os.path.splitext(file)[0]
-                if fname_no_ext.lower() == target_lower:
-                    matches.append(os.path.join(root, file))
-    return matches
+    return library.find_by_name(target_name, search_path)
 
 def get_all_songs(search_path):
-    all_songs = []
-    for root, dirs, files in os.walk(search_path):
-        for file in files:
-            _, ext = os.path.splitext(file)
-            if ext.lower() in ALLOWED_EXTENSIONS:
-                all_songs.append(os.path.join(root, file))
-    return all_songs
+    return library.songs_under(search_path)
 
-async def find_song_paths_async(target_name: str, search_path: str) -> List[str]:
-    def _search():
-        return find_song_paths(target_name, search_path)
-    return await asyncio.to_thread(_search)
+async def library_ready(ctx) -> bool:
+    """Waits for the first library load, and tells the user if the library holds no tracks."""
+    await library_loaded.wait()
+    if library.track_count:
+        return True
+    await ctx.send("The music library is empty or still being indexed, try again shortly!")
+    return False
 
-async def get_all_songs_async(search_path: str) -> List[str]:
-    def _get_all():
-        return get_all_songs(search_path)
-    return await asyncio.to_thread(_get_all)
+async def find_song_paths_async(target_name: str, search_path: str) -> List[str]:
+    await library_loaded.wait()
+    return find_song_paths(target_name, search_path)
+
+async def get_track_ids_async(search_path: str) -> Sequence[int]:
+    await library_loaded.wait()
+    return library.track_ids_under(search_path)
+
+async def choose_search_result(ctx, query: str, candidates: List[str]) -> Optional[str]:
+    """Lists ranked candidates and waits for the user to pick one by number."""
+    msg = f"Found **{len(candidates)}** songs matching '{query}':\n```"
+    for i, path in enumerate(candidates):
+        msg += f"{i+1}. {os.path.relpath(path, MUSIC_DIRECTORY)}\n"
+    msg += "```\nReply with a number to play it (or use a specific path)"
+    await ctx.send(msg)
+
+    def check(m):
+        return (m.author == ctx.author and m.channel == ctx.channel
+                and m.content.strip().isdigit() and 1 <= int(m.content.strip()) <= len(candidates))
+    try:
+        reply = await bot.wait_for('message', check=check, timeout=SEARCH_SELECTION_TIMEOUT)
+    except asyncio.TimeoutError:
+        await ctx.send("Selection timed out")
+        return None
+    return candidates[int(reply.content.strip()) - 1]
 
 async def get_or_move_voice_client(ctx, voice_channel):
     if ctx.voice_client is None:
@@ -158,59 +611,354 @@ async def get_or_move_voice_client(ctx, voice_channel):
     return ctx.voice_client
 
 # ---------------------------------------------
-# DJ SYSTEM (LOCAL)
+# PLAYBACK PIPELINE
 # ---------------------------------------------
-async def after_dj_playback(ctx, vc, error):
+# One scheduler serves the whole queue: library tracks and YouTube videos are
+# opened, preloaded and announced the same way, and the mixer identifies each
+# by the queued Track itself (a library ID or a YouTubeTrack).
+
+class TrackUnavailable(Exception):
+    """A queued track that cannot be played; the message says why."""
+
+def describe_track(track: Track) -> Tuple[str, Optional[float]]:
+    """(title, duration) for display."""
+    if isinstance(track, YouTubeTrack):
+        return track.title, track.duration
+    return library.display_name(track), library.duration(track)
+
+def track_active(vc, guild_state: GuildState) -> bool:
+    """True while a track is playing or paused (the mixer may also be holding silence between tracks)."""
+    return ((vc.is_playing() or vc.is_paused()) and guild_state.mixer is not None
+            and guild_state.mixer.current_tag is not None)
+
+def start_playback(ctx, vc, audio_source: discord.AudioSource, track: Track, duration: Optional[float]):
+    """
+    Plays audio_source now on the guild's mixer, starting the mixer on the
+    voice client if it is not running. Track ends come back to the event loop
+    through after_track.
+    """
     guild_state = get_guild_state(ctx.guild.id)
-    if error:
-        logger.error(f"Error in DJ playback: {error}")
-        await ctx.send("An error occurred during playback.")
+    source = metrics.InstrumentedSource(audio_source, ctx.guild.id)
+    mixer = guild_state.mixer
+    if mixer is not None and (vc.is_playing() or vc.is_paused()):
+        mixer.crossfade = guild_state.crossfade
+        return mixer.play_now(source, track, duration)
 
-    if not vc.is_connected() or guild_state.is_switching_sources:
-        return
+    def on_advance(finished, started, offset, error):
+        asyncio.run_coroutine_threadsafe(after_track(ctx, vc, finished, started, offset, error), bot.loop)
 
-    if guild_state.dj_queue:
-        await play_next_dj_song(ctx, vc)
-    else:
-        guild_state.is_playing_dj = False
-        await ctx.send("DJ queue finished")
+    def after(error):
+        asyncio.run_coroutine_threadsafe(after_mixer_stopped(ctx, mixer, error), bot.loop)
 
-async def play_next_dj_song(ctx, vc):
-    if not vc.is_connected() or vc.is_playing() or vc.is_paused():
-        return
+    mixer = GuildMixer(on_advance, guild_state.crossfade)
+    mixer.play_now(source, track, duration)
+    guild_state.mixer = mixer
+    vc.play(mixer, after=after)
 
+async def after_mixer_stopped(ctx, mixer: GuildMixer, error):
+    """The voice player released the mixer: stopped, disconnected, or idle after the queue finished."""
+    if error:
+        logger.error(f"Error in voice player: {error}")
     guild_state = get_guild_state(ctx.guild.id)
-    if not guild_state.dj_queue:
-        return await after_dj_playback(ctx, vc, None)
+    if guild_state.mixer is mixer:
+        guild_state.mixer = None
+        cancel_preload(guild_state)
+
+async def open_track(guild_state: GuildState, track: Track, start_at: float, priority: Priority,
+                     on_wait: Optional[Callable[[], None]] = None) -> Tuple[discord.AudioSource, Optional[float]]:
+    """
+    Spawns FFmpeg for track, starting start_at seconds in, once the governor
+    admits it (on_wait is called if that takes a while). Returns the source
+    and the seconds it will play.
+    """
+    cached_path = download_cache.lookup(track.url) if isinstance(track, YouTubeTrack) else None
+    if cached_path:
+        # Downloaded earlier: no extraction and no network stream
+        slot = await ffmpeg_governor.acquire(guild_state.guild_id, priority, on_wait)
+        try:
+            source = create_cached_audio_source(cached_path, start_at)
+        except BaseException:
+            slot.release()
+            raise
+        duration = track.duration
+    elif isinstance(track, YouTubeTrack):
+        # Joins an in-flight prefetch for this video (bumped to this priority) if there is one
+        stream_url = await get_stream_url(track.url, priority, guild_state.guild_id)
+        if not stream_url:
+            raise ValueError("Could not extract stream URL")
+        slot = await ffmpeg_governor.acquire(guild_state.guild_id, priority, on_wait)
+        try:
+            source = create_youtube_audio_source(stream_url, start_at)
+        except BaseException:
+            slot.release()
+            raise
+        duration = track.duration
+    else:
+        file_path = library.path_of(track)
+        if file_path is None:
+            raise TrackUnavailable("Song was removed from the library")
+        if not os.path.exists(file_path):
+            raise TrackUnavailable(f"File not found: {file_path}")
+        if not library.is_playable(track):
+            raise TrackUnavailable(f"**{os.path.basename(file_path)}** holds no readable audio")
+        seek_point = None
+        if start_at:
+            seek_point = await io_pool.run(priority, None, library.seek_point, track, start_at)
+        slot = await ffmpeg_governor.acquire(guild_state.guild_id, priority, on_wait)
+        try:
+            source = create_normalized_audio_source(file_path, start_at, seek_point, slot.degraded)
+        except BaseException:
+            slot.release()
+            raise
+        duration = library.duration(track)
+    return slot.attach(source), duration and max(0.0, duration - start_at)
+
+async def play_next(ctx, vc, start_at: float = 0.0, resumed: bool = False):
+    """
+    Starts the first playable track in the queue, if nothing is playing.
+    resumed marks the first track as one picked up again (by !restore)
+    rather than played anew.
+    """
+    guild_state = get_guild_state(ctx.guild.id)
+    if not vc.is_connected() or track_active(vc, guild_state) or guild_state.is_starting:
+        return
 
-    file_path = guild_state.dj_queue.pop(0)
-    
-    if not os.path.exists(file_path):
-        await ctx.send(f"File not found: {file_path}, skipping!")
-        return await after_dj_playback(ctx, vc, None)
+    # Seeks and restores continue a track whose play was already counted
+    resumed = resumed or start_at > 0 or guild_state.pending_seek is not None
+    if guild_state.pending_seek is not None:
+        start_at, guild_state.pending_seek = guild_state.pending_seek, None
+    guild_state.is_starting = True
+    radio_picks = 0
+    try:
+        while True:
+            if not guild_state.queue:
+                if radio_picks >= RADIO_MAX_PICKS or not top_up_radio(guild_state):
+                    break
+                radio_picks += 1
+            track = guild_state.queue.popleft()
+            try:
+                audio_source, duration = await open_track(guild_state, track, start_at, Priority.PLAYBACK,
+                                                          lambda: notify_busy(ctx))
+            except TrackUnavailable as e:
+                await ctx.send(f"{e}, skipping!")
+            except FFmpegBusy:
+                pass  # Withdrawn from the wait for a slot: the queue was cleared, and the track with it
+            except Exception as e:
+                title = describe_track(track)[0]
+                logger.error(f"Error playing {title}: {e}", exc_info=True)
+                await ctx.send(f"Failed to play **{title}**, skipping!")
+                if isinstance(track, YouTubeTrack):
+                    invalidate_stream_url(track.url)
+                    download_cache.discard(track.url)
+            else:
+                if not vc.is_connected():
+                    return audio_source.cleanup()
+                start_playback(ctx, vc, audio_source, track, duration)
+                return await announce_track(ctx, guild_state, track, start_at,
+                                            resumed_from=start_at, fresh=not resumed)
+            start_at, resumed = 0.0, False
+    finally:
+        guild_state.is_starting = False
+
+    guild_state.now_playing = None
+    if guild_state.mixer:
+        guild_state.mixer.finish()
+    await ctx.send("Queue finished")
+
+def notify_busy(ctx):
+    """Tells a server whose track is waiting for an FFmpeg slot that it will start by itself."""
+    task = asyncio.create_task(ctx.send("Too many tracks are playing right now, "
+                                        "this one starts as soon as another ends."))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def after_track(ctx, vc, finished: Track, started: Optional[Track], offset: float, error):
+    """
+    Runs on the event loop when the mixer finished a track. If it already
+    moved on to the preloaded track, only the bookkeeping is left; otherwise
+    the next track is started from the queue.
+    """
+    guild_state = get_guild_state(ctx.guild.id)
+    if error:
+        logger.error(f"Error during playback: {error}")
+        await ctx.send("An error occurred during playback.")
+        # The cached stream URL may be the cause (e.g. revoked early), don't reuse it
+        if isinstance(finished, YouTubeTrack):
+            invalidate_stream_url(finished.url)
+            download_cache.discard(finished.url)
+
+    if started is None:
+        guild_state.now_playing = None
+        return await play_next(ctx, vc)
+
+    # The queue can change while a preloaded track is waiting; it is only kept if it is still next
+    if guild_state.queue.peek() != started:
+        if guild_state.mixer:
+            guild_state.mixer.skip()
+        return
+    guild_state.queue.popleft()
+    await announce_track(ctx, guild_state, started, offset)
+
+async def announce_track(ctx, guild_state: GuildState, track: Track, start_at: float,
+                         resumed_from: float = 0.0, fresh: bool = True):
+    """
+    Records track as now playing, posts it, and plans the look-ahead for the
+    tracks after it. fresh is False when a seek or restore continues a track.
+    """
+    guild_state.now_playing = track
+    guild_state.start_clock(start_at)
+    if isinstance(track, int):
+        guild_state.history.add(track)
+    elif fresh:
+        download_cache.record_play(track.url, track.duration)
+    if track == guild_state.radio_pick:
+        guild_state.radio_pick = None
+    schedule_prefetch(guild_state)
+    await ctx.send(f"Now playing: **{describe_track(track)[0]}**"
+                   + (f" from {format_position(resumed_from)}" if resumed_from else ""))
+
+async def start_if_idle(ctx, vc, guild_state: GuildState):
+    """Called after adding to the queue: starts playback, or refreshes the look-ahead for what is now upcoming."""
+    if track_active(vc, guild_state):
+        schedule_prefetch(guild_state)
+    else:
+        await play_next(ctx, vc)
+
+def clear_queue(guild_state: GuildState):
+    """Empties the queue, abandoning any playlist still being ingested into it."""
+    guild_state.queue.clear()
+    guild_state.queue_generation += 1
+    guild_state.radio_pick = None
+    ffmpeg_governor.withdraw(guild_state.guild_id)
+    reset_prefetch(guild_state)
+
+def top_up_radio(guild_state: GuildState) -> bool:
+    """With radio on and nothing queued, queues a library track similar to the last one played."""
+    if not guild_state.radio or guild_state.queue:
+        return False
+    history = guild_state.history
+    track = similarity.pick(history.last(), history)
+    if track is None:
+        # Not indexed yet, or all its neighbors were played recently: any track not played recently
+        for _ in range(RADIO_RANDOM_TRIES):
+            track = library.random_track()
+            if track is None or track not in history:
+                break
+    if track is None:
+        return False
+    guild_state.queue.append(track)
+    guild_state.radio_pick = track
+    return True
+
+def withdraw_radio_pick(guild_state: GuildState):
+    """Tracks queued by users go ahead of a radio pick that is still only waiting to play next."""
+    pick, guild_state.radio_pick = guild_state.radio_pick, None
+    if pick is not None and len(guild_state.queue) == 1 and guild_state.queue.peek() == pick:
+        guild_state.queue.clear()
+
+def reset_prefetch(guild_state: GuildState):
+    """Drops all look-ahead work, e.g. when the queue is cleared or playback stops."""
+    for future in guild_state.yt_prefetch_tasks.values():
+        future.cancel()
+    guild_state.yt_prefetch_tasks.clear()
+    schedule_preload(guild_state)
+
+def schedule_prefetch(guild_state: GuildState):
+    """
+    Reconciles the look-ahead stage with the current queue: tops it up from
+    the radio, resolves stream URLs for the YouTube videos among the next
+    YT_PREFETCH_COUNT entries and has the mixer preload the next track. Work
+    for entries that are no longer upcoming (skipped, cleared, reordered) is
+    discarded.
+    """
+    if guild_state.now_playing is not None:
+        top_up_radio(guild_state)
+    upcoming = [t.url for t in itertools.islice(guild_state.queue, YT_PREFETCH_COUNT)
+                if isinstance(t, YouTubeTrack) and not download_cache.has(t.url)]
+
+    for url in list(guild_state.yt_prefetch_tasks):
+        if url not in upcoming:
+            guild_state.yt_prefetch_tasks.pop(url).cancel()
+    for url in upcoming:
+        if url not in guild_state.yt_prefetch_tasks:
+            guild_state.yt_prefetch_tasks[url] = asyncio.ensure_future(
+                get_stream_url(url, Priority.PREFETCH, guild_state.guild_id))
+
+    mixer = guild_state.mixer
+    # Replanned only when the upcoming track changed, so a waiting preload keeps its timer
+    if mixer and (guild_state.preload_task is None or upcoming_track(guild_state) != mixer.next_tag):
+        schedule_preload(guild_state)
+
+def cancel_preload(guild_state: GuildState):
+    if guild_state.preload_task:
+        guild_state.preload_task.cancel()
+        guild_state.preload_task = None
+
+def upcoming_track(guild_state: GuildState) -> Optional[Track]:
+    """The track that follows the current one, if a track is playing."""
+    mixer = guild_state.mixer
+    if mixer is None or mixer.current_tag is None:
+        return None
+    return guild_state.queue.peek()
+
+def schedule_preload(guild_state: GuildState):
+    """
+    Reconciles the mixer's preloaded track with the queue. The next track's
+    FFmpeg process is spawned PRELOAD_LEAD seconds (plus the crossfade) before
+    the current one ends, or straight away if its length is unknown.
+    """
+    cancel_preload(guild_state)
+    mixer = guild_state.mixer
+    if mixer is None:
+        return
+    track = upcoming_track(guild_state)
+    if track is not None and mixer.next_tag is not None and mixer.next_tag == track:
+        return
+    if mixer.next_tag is not None:
+        mixer.clear_next()
+    if track is None:
+        return
+    remaining = mixer.remaining()
+    delay = max(0.0, remaining - PRELOAD_LEAD - guild_state.crossfade) if remaining is not None else 0.0
+    guild_state.preload_task = asyncio.create_task(preload_track(guild_state, mixer, track, delay))
 
+async def preload_track(guild_state: GuildState, mixer: GuildMixer, track: Track, delay: float):
+    await asyncio.sleep(delay)
+    source = None
     try:
-        audio_source = create_normalized_audio_source(file_path)
-        display_name = os.path.basename(file_path)
-        
-        vc.play(
-            audio_source,
-            after=lambda e: asyncio.run_coroutine_threadsafe(after_dj_playback(ctx, vc, e), bot.loop)
-        )
-        guild_state.is_playing_dj = True
-        guild_state.is_paused_dj = False
-        await ctx.send(f"Now playing: **{display_name}**")
-        
+        audio_source, duration = await open_track(guild_state, track, 0.0, Priority.PREFETCH)
+        source = metrics.InstrumentedSource(audio_source, guild_state.guild_id)
+        # Reading the first frame waits out FFmpeg's start-up here rather than on the voice thread
+        first_frame = await asyncio.to_thread(source.read)
+        # The queue may have moved on meanwhile, e.g. the current track ended before this was ready
+        if not first_frame or guild_state.mixer is not mixer or upcoming_track(guild_state) != track:
+            return
+        mixer.set_next(source, track, duration, first_frame)
+        # Until it plays, a track about to start elsewhere may take its FFmpeg slot
+        audio_source.slot.allow_preemption(lambda preloaded=source: mixer.drop_next(preloaded))
+        source = None
+        logger.info(f"Preloaded next track for guild {guild_state.guild_id}")
+    except asyncio.CancelledError:
+        raise
+    except (TrackUnavailable, FFmpegBusy):
+        pass  # Reported, or retried, by play_next when the track comes up
     except Exception as e:
-        logger.error(f"Error playing file: {e}", exc_info=True)
-        await ctx.send("Failed to play the local file.")
-        await after_dj_playback(ctx, vc, e)
+        logger.warning(f"Preloading {describe_track(track)[0]} failed: {e}")
+    finally:
+        if source is not None:
+            source.cleanup()
 
+# ---------------------------------------------
+# DJ SYSTEM (LOCAL)
+# ---------------------------------------------
 @bot.command()
 async def dj_play(ctx, *, filename: Optional[str] = None):
     if not ctx.author.voice:
         return await ctx.send("You need to be in a voice channel!")
 
+    if not await library_ready(ctx):
+        return
+
     guild_state = get_guild_state(ctx.guild.id)
     voice_channel = ctx.author.voice.channel
     vc = await get_or_move_voice_client(ctx, voice_channel)
@@ -218,187 +966,104 @@ async def dj_play(ctx, *, filename: Optional[str] = None):
     found_path = None
     display_name = None
     is_directory_play = False
-    directory_files = []
+    directory_tracks: Sequence[int] = ()
 
     if filename:
         base_dir = os.path.abspath(MUSIC_DIRECTORY)
         target_dir = os.path.abspath(os.path.join(base_dir, filename))
 
         # Replaced vulnerable string matching with strict os.path.commonpath
-        if os.path.commonpath([base_dir, target_dir]) == base_dir and os.path.isdir(target_dir):
-            directory_files = await get_all_songs_async(target_dir)
-            if not directory_files:
+        if os.path.commonpath([base_dir, target_dir]) == base_dir and library.is_directory(target_dir):
+            directory_tracks = await get_track_ids_async(target_dir)
+            if not directory_tracks:
                 return await ctx.send(f"No audio files found in directory **'{filename}'**!")
-            
-            random.shuffle(directory_files)
             is_directory_play = True
         else:
-            matches = await find_song_paths_async(filename, MUSIC_DIRECTORY)
-            if not matches:
-                return await ctx.send(f"Could not find song or directory **'{filename}'**!")
-            elif len(matches) > 1:
-                msg = f"Found **{len(matches)}** songs named '{filename}':\n```"
-                for match in matches:
-                    msg += f"- {os.path.relpath(match, MUSIC_DIRECTORY)}\n"
-                msg += "```\nPlease use a specific path"
-                return await ctx.send(msg)
-            else:
-                found_path = matches[0]
-                display_name = os.path.basename(found_path)
-
-    guild_state.yt_queue.clear()
-    guild_state.yt_now_playing = None
-    guild_state.dj_queue.clear()
-
+            found_path = library.resolve(filename)
+            if not found_path:
+                matches = await find_song_paths_async(filename, MUSIC_DIRECTORY)
+                candidates = matches if matches else library.search(filename, SEARCH_RESULT_LIMIT)
+                if not candidates:
+                    return await ctx.send(f"Could not find song or directory **'{filename}'**!")
+                elif len(candidates) > 1:
+                    found_path = await choose_search_result(ctx, filename, candidates)
+                    if not found_path:
+                        return
+                else:
+                    found_path = candidates[0]
+            display_name = os.path.basename(found_path)
+            track_id = library.track_id(found_path)
+            if track_id is not None:
+                display_name = library.display_name(track_id)
+
+    guild_state.text_channel_id = ctx.channel.id
+    withdraw_radio_pick(guild_state)
+    # Added behind whatever is queued, so library and YouTube tracks can be interleaved
     if is_directory_play:
-        guild_state.dj_queue.extend(directory_files)
-        await ctx.send(f"Queued {len(directory_files)} songs from directory **'{filename}'** (Shuffled)")
+        guild_state.queue.extend_shuffled(directory_tracks, target_dir, library.artist_key)
+        await ctx.send(f"Queued {len(directory_tracks)} songs{format_total_duration(directory_tracks)} "
+                       f"from directory **'{filename}'** (Shuffled)")
     elif found_path:
-        guild_state.dj_queue.append(found_path)
+        track_id = library.track_id(found_path)
+        if track_id is None:
+            return await ctx.send(f"Could not find song or directory **'{filename}'**!")
+        guild_state.queue.append(track_id)
         await ctx.send(f"Queued up: **{display_name}**")
     else:
-        audio_files = await get_all_songs_async(MUSIC_DIRECTORY)
-        if not audio_files:
+        all_tracks = await get_track_ids_async(MUSIC_DIRECTORY)
+        if not all_tracks:
             return await ctx.send(f"No audio files found in {MUSIC_DIRECTORY}!")
-        random.shuffle(audio_files)
-        guild_state.dj_queue.extend(audio_files)
-        await ctx.send(f"Queued {len(audio_files)} songs from the playlist")
-
-    if vc.is_playing() or vc.is_paused():
-        guild_state.is_switching_sources = True 
-        vc.stop()
-        await asyncio.sleep(0.1)
-        guild_state.is_switching_sources = False
-        
-    if guild_state.dj_queue:
-        await play_next_dj_song(ctx, vc)
-
-async def generate_dj_list(search_path: str) -> List[str]:
-    def _generate():
-        lines = []
-        for root, dirs, files in os.walk(search_path):
-            level = root.replace(search_path, '').count(os.sep)
-            indent = ' ' * 4 * level
-            folder_name = os.path.basename(root)
-            lines.append(f"{folder_name}/" if level == 0 else f"{indent}{folder_name}/")
-            
-            sub_indent = ' ' * 4 * (level + 1)
-            for f in files:
-                _, ext = os.path.splitext(f)
-                if ext.lower() in ALLOWED_EXTENSIONS:
-                    lines.append(f"{sub_indent}- {f}")
-        return lines
-    return await asyncio.to_thread(_generate)
+        # Shuffled lazily: the queue shares the library's ID list instead of copying it
+        guild_state.queue.extend_shuffled(all_tracks, MUSIC_DIRECTORY, library.artist_key)
+        await ctx.send(f"Queued {len(all_tracks)} songs{format_total_duration(all_tracks)} from the playlist")
 
-@bot.command()
-async def dj_list(ctx: commands.Context):
-    if not os.path.exists(MUSIC_DIRECTORY):
-        return await ctx.send(f"Error: Directory `{MUSIC_DIRECTORY}` does not exist!")
-
-    await ctx.send(f"**Listing files in:** `{MUSIC_DIRECTORY}`")
-    lines = await generate_dj_list(MUSIC_DIRECTORY)
-
-    if not lines or len(lines) == 1: 
-        return await ctx.send("Directory is empty or contains no valid audio files!")
+    await start_if_idle(ctx, vc, guild_state)
 
-    messages = []
-    chunk = "```text\n"
-    for line in lines:
-        if len(chunk) + len(line) + 10 > 1900:
-            chunk += "```"
-            messages.append(chunk)
-            chunk = "```text\n"
-        chunk += line + "\n"
-    chunk += "```"
-    messages.append(chunk)
+async def play_tagged_tracks(ctx, kind: str, name: str, lookup):
+    """Shared by !dj_artist and !dj_album: queues every track carrying a tag."""
+    if not ctx.author.voice:
+        return await ctx.send("You need to be in a voice channel!")
+    if not await library_ready(ctx):
+        return
+    tagged_as, track_ids = lookup(name)
+    if not track_ids:
+        return await ctx.send(f"No songs tagged with {kind} **'{name}'** (tags of new files may still be loading)")
 
-    for msg in messages: 
-        await ctx.send(msg)
+    guild_state = get_guild_state(ctx.guild.id)
+    vc = await get_or_move_voice_client(ctx, ctx.author.voice.channel)
+    guild_state.text_channel_id = ctx.channel.id
+    withdraw_radio_pick(guild_state)
+    guild_state.queue.extend_shuffled(track_ids)
+    await ctx.send(f"Queued {len(track_ids)} songs{format_total_duration(track_ids)} "
+                   f"by {kind} **{tagged_as}** (Shuffled)")
+    await start_if_idle(ctx, vc, guild_state)
 
 @bot.command()
-async def dj_skip(ctx):
-    if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-        await ctx.send("Skipping song...")
-        ctx.voice_client.stop()
-    else:
-        await ctx.send("Nothing is playing!")
+async def dj_artist(ctx, *, name: str):
+    await play_tagged_tracks(ctx, 'artist', name, library.tracks_by_artist)
 
 @bot.command()
-async def dj_stop(ctx):
-    guild_state = get_guild_state(ctx.guild.id)
-    if ctx.voice_client:
-        guild_state.dj_queue.clear()
-        guild_state.is_playing_dj = False
-        ctx.voice_client.stop()
-        await ctx.voice_client.disconnect()
-        await ctx.send("Disconnected")
+async def dj_album(ctx, *, name: str):
+    await play_tagged_tracks(ctx, 'album', name, library.tracks_by_album)
 
 @bot.command()
-async def dj_pause(ctx):
-    guild_state = get_guild_state(ctx.guild.id)
-    if ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.pause()
-        guild_state.is_paused_dj = True
-        await ctx.send("Paused")
+async def dj_list(ctx: commands.Context, *, folder: Optional[str] = None):
+    if not os.path.exists(MUSIC_DIRECTORY):
+        return await ctx.send(f"Error: Directory `{MUSIC_DIRECTORY}` does not exist!")
 
-@bot.command()
-async def dj_resume(ctx):
-    guild_state = get_guild_state(ctx.guild.id)
-    if ctx.voice_client and ctx.voice_client.is_paused():
-        ctx.voice_client.resume()
-        guild_state.is_paused_dj = False
-        await ctx.send("Resumed")
+    await library_loaded.wait()
+    base_dir = os.path.abspath(MUSIC_DIRECTORY)
+    start = os.path.abspath(os.path.join(base_dir, folder)) if folder else base_dir
+    if os.path.commonpath([base_dir, start]) != base_dir or not library.is_directory(start):
+        return await ctx.send(f"Could not find directory **'{folder}'**!")
+    if not library.track_count:
+        return await ctx.send("Directory is empty or contains no valid audio files!")
+
+    await LibraryBrowser(library, base_dir, start).send(ctx)
 
 # ---------------------------------------------
 # YOUTUBE SYSTEM
 # ---------------------------------------------
-async def after_youtube_playback(ctx, vc, error):
-    guild_state = get_guild_state(ctx.guild.id)
-    guild_state.yt_now_playing = None 
-    if error:
-        logger.error(f"Error during YouTube playback: {error}")
-        await ctx.send("An error occurred during playback.")
-
-    if not vc.is_connected() or guild_state.is_switching_sources:
-        return
-
-    if guild_state.yt_queue:
-        await play_next_youtube(ctx, vc)
-    else:
-        await ctx.send("YouTube queue finished.")
-
-async def play_next_youtube(ctx, vc):
-    if not vc.is_connected() or vc.is_playing() or vc.is_paused():
-        return
-
-    guild_state = get_guild_state(ctx.guild.id)
-    if not guild_state.yt_queue:
-        return await after_youtube_playback(ctx, vc, None)
-
-    current_song = guild_state.yt_queue.pop(0)
-    guild_state.yt_now_playing = current_song
-
-    try:
-        video_webpage_url = current_song.get('url')
-        if not video_webpage_url: raise ValueError("Missing video URL!")
-
-        loop = asyncio.get_event_loop()
-        stream_url = await loop.run_in_executor(None, get_stream_url, video_webpage_url)
-        
-        if not stream_url:
-            raise ValueError("Could not extract stream URL")
-
-        audio_source = create_youtube_audio_source(stream_url)
-        vc.play(
-            audio_source,
-            after=lambda e: asyncio.run_coroutine_threadsafe(after_youtube_playback(ctx, vc, e), bot.loop)
-        )
-        await ctx.send(f"Now playing: **{current_song['title']}**")
-    except Exception as e:
-        logger.error(f"Error playing YouTube video: {e}")
-        await ctx.send(f"Failed to play **{current_song.get('title')}**, skipping!")
-        await after_youtube_playback(ctx, vc, e)
-
 @bot.command()
 async def yt_play(ctx, *, url: str):
     if not ctx.author.voice:
@@ -406,104 +1071,307 @@ async def yt_play(ctx, *, url: str):
     
     guild_state = get_guild_state(ctx.guild.id)
     vc = await get_or_move_voice_client(ctx, ctx.author.voice.channel)
-
-    if guild_state.is_playing_dj or guild_state.is_paused_dj or guild_state.dj_queue:
-        guild_state.is_switching_sources = True
-        guild_state.dj_queue.clear()
-        guild_state.is_playing_dj = False
-        vc.stop() 
-        await ctx.send("Switching to YouTube")
+    guild_state.text_channel_id = ctx.channel.id
 
     async def process_and_play():
         msg = await ctx.send("Processing request")
+        generation = guild_state.queue_generation
+        items_added = 0
+        first_title = None
         try:
-            loop = asyncio.get_event_loop()
-            video_list = await loop.run_in_executor(None, get_youtube_info, url)
-            
-            if not video_list:
-                guild_state.is_switching_sources = False
-                return await msg.edit(content="Failed to get video information!")
-
-            items_added = 0
-            for v in video_list:
-                if len(guild_state.yt_queue) >= MAX_QUEUE_SIZE:
+            async for page in get_youtube_info(url, guild_id=ctx.guild.id):
+                # The queue was cleared or replaced while this request was still streaming in
+                if guild_state.queue_generation != generation:
+                    return
+
+                capacity_reached = False
+                for v in page:
+                    if guild_state.queue.video_count >= MAX_QUEUE_SIZE:
+                        capacity_reached = True
+                        break
+                    
+                    if v and v.get('url'):
+                        if not items_added:
+                            withdraw_radio_pick(guild_state)
+                        guild_state.queue.append(YouTubeTrack.from_entry(v))
+                        items_added += 1
+                        first_title = first_title or v.get('title', 'Unknown')
+
+                if items_added:
+                    # Start on the first page instead of waiting for the whole playlist
+                    await start_if_idle(ctx, vc, guild_state)
+
+                if capacity_reached:
                     await ctx.send(f"Queue capacity of {MAX_QUEUE_SIZE} reached. Some videos were omitted.")
                     break
-                
-                if v and v.get('url'):
-                    guild_state.yt_queue.append({
-                        'title': v.get('title', 'Unknown'),
-                        'url': v.get('url'), 
-                        'duration': v.get('duration')
-                    })
-                    items_added += 1
+                await msg.edit(content=f"Processing request: added **{items_added}** videos so far")
 
             if items_added == 0:
-                guild_state.is_switching_sources = False # Added missing reset to prevent queue deadlock
-                return await msg.edit(content="No playable videos found!")
+                return await msg.edit(content="Failed to get video information!")
             
-            txt = f"Added **{video_list[0]['title']}**" if items_added == 1 else f"Added **{items_added}** videos"
+            txt = f"Added **{first_title}**" if items_added == 1 else f"Added **{items_added}** videos"
             await msg.edit(content=txt)
 
-            guild_state.is_switching_sources = False
-
-            if not vc.is_playing() and not vc.is_paused():
-                await play_next_youtube(ctx, vc)
-
         except Exception as e:
             logger.error(f"Error during extraction: {e}", exc_info=True)
             await msg.edit(content="An error occurred while processing the request.")
-            guild_state.is_switching_sources = False
 
     task = asyncio.create_task(process_and_play())
     background_tasks.add(task)
     task.add_done_callback(background_tasks.discard)
 
 @bot.command()
-async def yt_skip(ctx):
-    if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
+async def yt_clear(ctx):
+    guild_state = get_guild_state(ctx.guild.id)
+    removed = guild_state.queue.remove_videos()
+    guild_state.queue_generation += 1  # Also stops playlists still being added
+    schedule_prefetch(guild_state)
+    await ctx.send(f"Removed {removed} YouTube videos from the queue")
+
+# ---------------------------------------------
+# PLAYBACK CONTROLS
+# ---------------------------------------------
+# Shared by both sources; the dj_/yt_ names are kept as aliases
+
+@bot.command(aliases=['dj_skip', 'yt_skip'])
+async def skip(ctx):
+    guild_state = get_guild_state(ctx.guild.id)
+    if ctx.voice_client and track_active(ctx.voice_client, guild_state):
         await ctx.send("Skipping...")
-        ctx.voice_client.stop()
+        # Moves straight on to the preloaded track, if the mixer has one
+        guild_state.mixer.skip()
     else:
         await ctx.send("Nothing is playing!")
 
-@bot.command()
-async def yt_stop(ctx):
+@bot.command(aliases=['dj_pause', 'yt_pause'])
+async def pause(ctx):
+    if ctx.voice_client and ctx.voice_client.is_playing():
+        ctx.voice_client.pause()
+        get_guild_state(ctx.guild.id).pause_clock()
+        await ctx.send("Paused")
+
+@bot.command(aliases=['dj_resume', 'yt_resume'])
+async def resume(ctx):
+    if ctx.voice_client and ctx.voice_client.is_paused():
+        ctx.voice_client.resume()
+        get_guild_state(ctx.guild.id).resume_clock()
+        await ctx.send("Resumed")
+
+@bot.command(aliases=['dj_stop', 'yt_stop'])
+async def stop(ctx):
     guild_state = get_guild_state(ctx.guild.id)
     if ctx.voice_client:
-        guild_state.yt_queue.clear()
-        guild_state.yt_now_playing = None
+        clear_queue(guild_state)
+        guild_state.now_playing = None
+        guild_state.resume_point = None
         ctx.voice_client.stop()
         await ctx.voice_client.disconnect()
         await ctx.send("Disconnected")
 
+@bot.command(name='queue', aliases=['yt_queue'])
+async def show_queue(ctx):
+    guild_state = get_guild_state(ctx.guild.id)
+    if not guild_state.queue and guild_state.now_playing is None:
+        return await ctx.send("Queue is empty!")
+    # Reads the guild's current queue on every page turn, so it stays live
+    await QueueBrowser(lambda: guild_state.queue, lambda: guild_state.now_playing, describe_track).send(ctx)
+
 @bot.command()
-async def yt_queue(ctx):
+async def clear(ctx):
     guild_state = get_guild_state(ctx.guild.id)
-    if not guild_state.yt_queue:
-        return await ctx.send("YouTube queue is empty!")
-    
-    lines = [f"{i+1}. {v['title']}" for i, v in enumerate(guild_state.yt_queue[:10])]
-    resp = "**YouTube Queue:**\n" + "\n".join(lines)
-    if len(guild_state.yt_queue) > 10: resp += f"\n...and {len(guild_state.yt_queue)-10} more"
-    await ctx.send(resp)
+    clear_queue(guild_state)
+    schedule_prefetch(guild_state)  # With radio on, picks the next track afresh
+    await ctx.send("Queue cleared")
 
 @bot.command()
-async def yt_clear(ctx):
-    get_guild_state(ctx.guild.id).yt_queue.clear()
-    await ctx.send("YouTube queue cleared")
+async def radio(ctx, mode: Optional[str] = None):
+    guild_state = get_guild_state(ctx.guild.id)
+    if mode is not None and mode.lower() not in ('on', 'off'):
+        return await ctx.send("Use !radio, !radio on or !radio off")
+    guild_state.radio = mode.lower() == 'on' if mode else not guild_state.radio
+    if not guild_state.radio:
+        withdraw_radio_pick(guild_state)
+        schedule_prefetch(guild_state)
+        return await ctx.send("Radio off: playback stops when the queue runs out")
+
+    await ctx.send("Radio on: similar local songs keep playing when the queue runs out")
+    vc = ctx.voice_client
+    if vc and track_active(vc, guild_state):
+        schedule_prefetch(guild_state)
+    elif ctx.author.voice:
+        if not await library_ready(ctx):
+            return
+        vc = await get_or_move_voice_client(ctx, ctx.author.voice.channel)
+        guild_state.text_channel_id = ctx.channel.id
+        await play_next(ctx, vc)
 
+# ---------------------------------------------
+# SESSION RESTORE
+# ---------------------------------------------
 @bot.command()
-async def yt_pause(ctx):
-    if ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.pause()
-        await ctx.send("YouTube paused")
+async def restore(ctx, position: Optional[str] = None):
+    guild_state = get_guild_state(ctx.guild.id)
+    if not guild_state.resume_point and not guild_state.queue:
+        return await ctx.send("Nothing to restore!")
+    if not ctx.author.voice:
+        return await ctx.send("You need to be in a voice channel!")
+
+    vc = await get_or_move_voice_client(ctx, ctx.author.voice.channel)
+    if track_active(vc, guild_state):
+        return await ctx.send("Already playing!")
+    guild_state.text_channel_id = ctx.channel.id
+
+    start_at = parse_position(position, 0.0) if position else None
+    if position and start_at is None:
+        return await ctx.send("Invalid position! Use seconds or m:ss")
+
+    _, track, position = guild_state.resume_point or (None, None, 0.0)
+    guild_state.resume_point = None
+    if start_at is not None:
+        position = start_at
+    if track is not None:
+        guild_state.queue.appendleft(track)
+
+    await ctx.send("Resuming queue" + (f" at {format_position(position)}" if position else ""))
+    await play_next(ctx, vc, start_at=position, resumed=track is not None)
 
 @bot.command()
-async def yt_resume(ctx):
-    if ctx.voice_client and ctx.voice_client.is_paused():
-        ctx.voice_client.resume()
-        await ctx.send("YouTube resumed")
+async def seek(ctx, *, position: str):
+    guild_state = get_guild_state(ctx.guild.id)
+    vc = ctx.voice_client
+    current = guild_state.now_playing_point()
+    if not vc or not current or not track_active(vc, guild_state):
+        return await ctx.send("Nothing is playing!")
+
+    _, track, _ = current
+    target = parse_position(position, guild_state.position)
+    if target is None:
+        return await ctx.send("Invalid position! Use seconds, m:ss, or +/- seconds")
+    duration = describe_track(track)[1]
+    if duration and target >= duration:
+        return await ctx.send(f"Track is only {format_position(duration)} long!")
+
+    # Restart the current track at the new position: with the preloaded track
+    # dropped, the mixer hands the skip back to play_next, which plays it next
+    guild_state.queue.appendleft(track)
+    guild_state.pending_seek = target
+    cancel_preload(guild_state)
+    guild_state.mixer.clear_next()
+    guild_state.mixer.skip()
+
+@bot.command()
+async def crossfade(ctx, seconds: Optional[str] = None):
+    guild_state = get_guild_state(ctx.guild.id)
+    if seconds is None:
+        current = f"{guild_state.crossfade:g}s" if guild_state.crossfade else "off"
+        return await ctx.send(f"Crossfade is {current}")
+    try:
+        value = float(seconds)
+    except ValueError:
+        return await ctx.send("Invalid duration! Use seconds, e.g. !crossfade 4")
+    if not 0 <= value <= MAX_CROSSFADE_SECONDS:
+        return await ctx.send(f"Crossfade must be between 0 and {MAX_CROSSFADE_SECONDS} seconds!")
+
+    guild_state.crossfade = value
+    if guild_state.mixer:
+        guild_state.mixer.crossfade = value
+        schedule_preload(guild_state)  # A longer fade needs the next track earlier
+    await ctx.send(f"Crossfade set to {value:g}s" if value else "Crossfade off, tracks play back to back")
+
+# ---------------------------------------------
+# METRICS
+# ---------------------------------------------
+metrics.register(metrics.Gauge(
+    'musicbot_executor_queue_depth', 'Jobs waiting for a worker', ['pool'],
+    lambda: {(pool.name,): pool.queue_depth for pool in (extraction_pool, io_pool)}))
+metrics.register(metrics.Gauge(
+    'musicbot_executor_running', 'Jobs currently running', ['pool'],
+    lambda: {(pool.name,): pool.running for pool in (extraction_pool, io_pool)}))
+metrics.register(metrics.Gauge(
+    'musicbot_relay_streams', 'Audio relay state', ['state'],
+    lambda: {(name,): value for name, value in audio_relay.stats.items()}))
+metrics.register(metrics.Gauge(
+    'musicbot_voice_clients', 'Connected voice clients by state', ['state'],
+    lambda: {('playing',): sum(vc.is_playing() for vc in bot.voice_clients),
+             ('connected',): len(bot.voice_clients)}))
+
+@bot.command()
+async def stats(ctx):
+    lines = ["Stage              count     p50      p95"]
+    for (stage,), (count, p50, p95) in sorted(metrics.STAGE_SECONDS.summary().items()):
+        lines.append(f"{stage:<18} {count:>5} {p50 * 1000:>6.0f}ms {p95 * 1000:>6.0f}ms")
+    for _, (count, p50, p95) in metrics.TRACK_GAP_SECONDS.summary().items():
+        lines.append(f"{'track_gap':<18} {count:>5} {p50 * 1000:>6.0f}ms {p95 * 1000:>6.0f}ms")
+
+    lines.append("")
+    for pool in (extraction_pool, io_pool):
+        lines.append(f"{pool.name} pool: {pool.running} running, {pool.queue_depth} queued")
+    lookups = {source: metrics.STREAM_URL_LOOKUPS.value(source) for source in ('memory', 'shared', 'extracted')}
+    lines.append("Stream URLs: " + ", ".join(f"{int(n)} {source}" for source, n in lookups.items()))
+    guild_key = (str(ctx.guild.id),)
+    cpu = metrics.FFMPEG_CPU_SECONDS.value(ctx.guild.id) + metrics.live_ffmpeg_cpu().get(guild_key, 0.0)
+    lines.append(f"FFmpeg CPU time in this server: {cpu:.1f}s")
+    lines.append(f"FFmpeg processes: {ffmpeg_governor.total}/{ffmpeg_governor.max_processes}"
+                 f" ({ffmpeg_governor.live(ctx.guild.id)} in this server)"
+                 + (f", {ffmpeg_governor.waiting} tracks waiting" if ffmpeg_governor.waiting else "")
+                 + (", degraded under load" if ffmpeg_governor.under_pressure else ""))
+    lines.append(f"Voice connections: {len(bot.voice_clients)}")
+    if download_cache.running:
+        hits = int(DOWNLOAD_CACHE_LOOKUPS.value('hit'))
+        lines.append(f"Download cache: {download_cache.files} tracks, {download_cache.size_bytes / 1048576:.0f} MiB, "
+                     f"{hits} plays from disk")
+    if metrics.ready_seconds() is not None:
+        lines.append(f"Ready {metrics.ready_seconds():.2f}s after start")
+    if audio_relay.running:
+        relay_stats = audio_relay.stats
+        lines.append(f"Relay: {relay_stats['streams']} streams, {relay_stats['readers']} listeners, "
+                     f"{relay_stats['buffered_bytes'] / 1048576:.0f} MiB buffered")
+    await ctx.send("```" + "\n".join(lines) + "```")
+
+# ---------------------------------------------
+# SHARD PROCESS LAUNCHER
+# ---------------------------------------------
+def shard_process_env(shard_ids: List[int]) -> Dict[str, str]:
+    env = dict(os.environ)
+    env['SHARD_COUNT'] = str(SHARD_COUNT)
+    env['SHARD_IDS'] = ','.join(map(str, shard_ids))
+    return env
+
+def run_shard_processes():
+    """Starts one bot process per group of shards and restarts any that crash."""
+    groups = [list(range(SHARD_COUNT))[i::SHARD_PROCESSES] for i in range(SHARD_PROCESSES)]
+    groups = [g for g in groups if g]
+    delays = [SHARD_RESTART_DELAY] * len(groups)
+    procs = [subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=shard_process_env(g))
+             for g in groups]
+    logger.info(f"Launched {len(procs)} shard processes for {SHARD_COUNT} shards.")
+    try:
+        while True:
+            time.sleep(1)
+            for i, proc in enumerate(procs):
+                code = proc.poll()
+                if code is None:
+                    continue
+                logger.warning(f"Shard process for shards {groups[i]} exited with code {code}, "
+                               f"restarting in {delays[i]}s.")
+                time.sleep(delays[i])
+                delays[i] = min(delays[i] * 2, 300)
+                procs[i] = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                            env=shard_process_env(groups[i]))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
 
 if __name__ == "__main__":
-    bot.run(BOT_TOKEN)
+    if SHARD_COUNT and SHARD_PROCESSES > 1 and not SHARD_IDS:
+        logging.basicConfig(level=logging.INFO)
+        run_shard_processes()
+    else:
+        bot.run(BOT_TOKEN)
@@ -0,0 +1,138 @@
+import os
+import json
+import logging
+import subprocess
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from executors import run_in_processes
+from governor import lower_priority
+from seek_index import BYTE_SEEK_EXTENSIONS, SeekIndex, build_seek_points
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None  # Optional: tags are read with ffprobe instead (slower, one process per file)
+
+logger = logging.getLogger(__name__)
+
+PROBE_TIMEOUT = 120  # Seconds allowed per file
+BATCH_SIZE = 200     # Results written to the database per transaction
+
+# Codec names for mutagen file types whose stream info does not name one
+MUTAGEN_CODECS = {
+    'EasyMP3': 'mp3', 'MP3': 'mp3', 'FLAC': 'flac', 'OggVorbis': 'vorbis', 'OggOpus': 'opus',
+    'OggFLAC': 'flac', 'WAVE': 'pcm', 'AIFF': 'pcm',
+}
+
+class TrackTags(NamedTuple):
+    title: Optional[str]
+    artist: Optional[str]
+    album: Optional[str]
+    codec: Optional[str]  # None if the file holds no readable audio
+
+UNREADABLE = TrackTags(None, None, None, None)
+
+def _read_mutagen(path: str) -> Optional[Tuple[TrackTags, Optional[float]]]:
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception:
+        return None
+    if audio is None or audio.info is None:
+        return None
+    tags = audio.tags or {}
+
+    def first(key: str) -> Optional[str]:
+        try:
+            values = tags.get(key)
+        except (KeyError, ValueError):
+            return None
+        return (str(values[0]).strip() or None) if values else None
+
+    codec = getattr(audio.info, 'codec', None) or MUTAGEN_CODECS.get(type(audio).__name__, type(audio).__name__.lower())
+    return (TrackTags(first('title'), first('artist') or first('albumartist'), first('album'), codec),
+            getattr(audio.info, 'length', None))
+
+def _probe(path: str, tags: bool, packets: bool) -> Dict:
+    entries = ['format=duration']
+    if tags:
+        entries += ['stream=codec_name', 'format_tags=title,artist,album_artist,album']
+    if packets:
+        entries.append('packet=pts_time,pos')
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', ':'.join(entries),
+           '-of', 'json', path]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT, check=True)
+    return json.loads(result.stdout or '{}')
+
+def _packet_positions(info: Dict):
+    for packet in info.get('packets', []):
+        try:
+            yield float(packet['pts_time']), int(packet['pos'])
+        except (KeyError, ValueError):
+            continue  # 'N/A' timestamps or positions
+
+def ingest_file(path: str) -> Tuple[SeekIndex, TrackTags]:
+    """
+    Process pool entry point: reads a file's tags, duration and codec (with
+    mutagen when it is installed, otherwise ffprobe) and, for raw MP3, the
+    packet offsets its seek index is built from.
+    """
+    stat = os.stat(path)
+    byte_seek = os.path.splitext(path)[1].lower() in BYTE_SEEK_EXTENSIONS
+    read = _read_mutagen(path) if mutagen else None
+    tags, duration = read if read else (None, None)
+
+    points = b''
+    if tags is None or byte_seek:
+        info = _probe(path, tags=tags is None, packets=byte_seek)
+        if tags is None:
+            fmt = info.get('format', {})
+            probe_tags = {k.lower(): v for k, v in fmt.get('tags', {}).items()}
+            streams = info.get('streams', [])
+            tags = TrackTags(probe_tags.get('title'), probe_tags.get('artist') or probe_tags.get('album_artist'),
+                             probe_tags.get('album'), streams[0].get('codec_name') if streams else None)
+            try:
+                duration = float(fmt['duration'])
+            except (KeyError, ValueError):
+                duration = None
+        if byte_seek:
+            points = build_seek_points(_packet_positions(info))
+    return SeekIndex(stat.st_mtime, duration, points, stat.st_size), tags
+
+def ingest_files(items: Sequence[Tuple[int, str]], workers: int,
+                 store: Callable[[List[Tuple[int, SeekIndex, TrackTags]]], None]) -> int:
+    """
+    Ingests (track ID, path) items in a process pool, handing results to
+    store in batches. Returns the number of files read successfully.
+    """
+    if not items:
+        return 0
+    logger.info(f"Reading tags of {len(items)} files with {workers} workers"
+                f"{'' if mutagen else ' (mutagen not installed, using ffprobe)'}.")
+    done = 0
+    batch: List[Tuple[int, SeekIndex, TrackTags]] = []
+    jobs = (((track_id, path), (path,)) for track_id, path in items)
+    for (track_id, path), future in run_in_processes(ingest_file, jobs, workers, lower_priority):
+        try:
+            index, tags = future.result()
+            done += 1
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"Could not read {path}: {e.stderr.strip() if e.stderr else e}")
+            # Recorded as unreadable so the file is skipped at play time and not retried every pass
+            try:
+                stat = os.stat(path)
+                index = SeekIndex(stat.st_mtime, None, b'', stat.st_size)
+            except OSError:
+                index = SeekIndex(0.0, None, b'')
+            tags = UNREADABLE
+        except Exception as e:
+            # Timeouts, a missing ffprobe, files removed meanwhile: retried on the next pass
+            logger.warning(f"Could not read {path}: {e}")
+            continue
+        batch.append((track_id, index, tags))
+
+        if len(batch) >= BATCH_SIZE:
+            store(batch)
+            batch = []
+    if batch:
+        store(batch)
+    return done
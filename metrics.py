@@ -0,0 +1,269 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import discord
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from cache hits to slow playlist extractions
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_SAMPLES = 512  # Observations kept per series for the percentiles shown by !stats
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(names: Sequence[str], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        key = tuple(str(l) for l in labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(tuple(str(l) for l in labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Gauge:
+    """A gauge whose values are read from a callback at scrape time."""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str],
+                 collect: Callable[[], Dict[LabelValues, float]]):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.warning(f"Could not collect {self.name}: {e}")
+            return lines
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class _Series:
+    __slots__ = ('buckets', 'count', 'sum', 'recent')
+
+    def __init__(self, n_buckets: int):
+        self.buckets = [0] * n_buckets
+        self.count = 0
+        self.sum = 0.0
+        self.recent: Deque[float] = deque(maxlen=RECENT_SAMPLES)
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.bounds = tuple(buckets)
+        self._series: Dict[LabelValues, _Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        key = tuple(str(l) for l in labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self.bounds))
+            i = bisect.bisect_left(self.bounds, value)
+            if i < len(self.bounds):
+                series.buckets[i] += 1
+            series.count += 1
+            series.sum += value
+            series.recent.append(value)
+
+    def summary(self) -> Dict[LabelValues, Tuple[int, float, float]]:
+        """Returns (count, p50, p95) of recent observations for every series."""
+        result = {}
+        with self._lock:
+            for key, series in self._series.items():
+                recent = sorted(series.recent)
+                if recent:
+                    result[key] = (series.count, recent[len(recent) // 2],
+                                   recent[min(len(recent) - 1, int(len(recent) * 0.95))])
+        return result
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.bounds, series.buckets):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {series.count}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series.count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series.sum}")
+        return lines
+
+# ---------------------------------------------
+# REGISTRY
+# ---------------------------------------------
+registry: List = []
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+STAGE_SECONDS = register(Histogram(
+    'musicbot_stage_seconds', 'Time spent in each stage between a command and audible playback', ['stage']))
+TRACK_GAP_SECONDS = register(Histogram(
+    'musicbot_track_gap_seconds', 'Silence between the end of a track and the first frame of the next'))
+COMMANDS_TOTAL = register(Counter('musicbot_commands_total', 'Commands invoked', ['command']))
+STREAM_URL_LOOKUPS = register(Counter(
+    'musicbot_stream_url_lookups_total', 'Stream URL lookups by where they were answered', ['source']))
+FFMPEG_CPU_SECONDS = register(Counter(
+    'musicbot_ffmpeg_cpu_seconds_total', 'CPU time used by finished FFmpeg processes', ['guild']))
+
+_ready_seconds: Optional[float] = None
+
+def record_ready(seconds: float):
+    """Records how long the process took from starting to being connected and ready."""
+    global _ready_seconds
+    _ready_seconds = seconds
+
+def ready_seconds() -> Optional[float]:
+    return _ready_seconds
+
+register(Gauge('musicbot_ready_seconds', 'Time from process start to the bot being ready', [],
+               lambda: {(): _ready_seconds} if _ready_seconds is not None else {}))
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Times the enclosed block as one stage of the playback pipeline."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, name)
+
+# ---------------------------------------------
+# FFMPEG
+# ---------------------------------------------
+_CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+_live_sources: Dict[int, 'InstrumentedSource'] = {}  # id(source) -> source
+_live_lock = threading.Lock()
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """User + system CPU time of a process, from /proc (Linux only)."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+def process_age() -> Optional[float]:
+    """Seconds since this process started, from /proc (Linux only)."""
+    try:
+        with open('/proc/self/stat') as f:
+            started_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - started_ticks / _CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+class InstrumentedSource(discord.AudioSource):
+    """
+    Wraps each track's source to measure time to the first frame and the
+    FFmpeg process's CPU time. Gaps between tracks are measured by the mixer.
+    """
+
+    def __init__(self, source: discord.AudioSource, guild_id: int):
+        self.source = source
+        self.guild_id = guild_id
+        self._created = time.perf_counter()
+        self._first_frame = False
+        with _live_lock:
+            _live_sources[id(self)] = self
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if not self._first_frame and data:
+            self._first_frame = True
+            STAGE_SECONDS.observe(time.perf_counter() - self._created, 'first_frame')
+        return data
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cpu_seconds(self) -> Optional[float]:
+        process = getattr(self.source, '_process', None)
+        return process_cpu_seconds(process.pid) if process is not None else None
+
+    def cleanup(self):
+        with _live_lock:
+            live = _live_sources.pop(id(self), None)
+        if live is not None:
+            # Sample before FFmpeg is killed, afterwards /proc has nothing left to report
+            cpu = self.cpu_seconds()
+            if cpu:
+                FFMPEG_CPU_SECONDS.inc(self.guild_id, amount=cpu)
+        self.source.cleanup()
+
+def live_ffmpeg_cpu() -> Dict[LabelValues, float]:
+    with _live_lock:
+        sources = list(_live_sources.values())
+    usage: Dict[LabelValues, float] = {}
+    for source in sources:
+        cpu = source.cpu_seconds()
+        if cpu is not None:
+            key = (str(source.guild_id),)
+            usage[key] = usage.get(key, 0.0) + cpu
+    return usage
+
+register(Gauge('musicbot_ffmpeg_live_cpu_seconds', 'CPU time used so far by running FFmpeg processes',
+               ['guild'], live_ffmpeg_cpu))
+
+# ---------------------------------------------
+# HTTP ENDPOINT
+# ---------------------------------------------
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """Serves the registry in Prometheus text format at http://host:port/metrics."""
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
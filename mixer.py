@@ -0,0 +1,257 @@
+import time
+import audioop
+import logging
+import threading
+from typing import Callable, List, Optional, Tuple
+
+import discord
+
+from metrics import TRACK_GAP_SECONDS
+
+logger = logging.getLogger(__name__)
+
+FRAME_SIZE = 3840          # 20ms of 48kHz stereo 16-bit PCM, the frame size the voice player sends
+FRAMES_PER_SECOND = 50
+SILENCE = b'\0' * FRAME_SIZE
+MIXER_IDLE_TIMEOUT = 30    # Seconds of silence held between tracks before the voice player is released
+
+# (finished tag, started tag or None, seconds the started track has already played, error)
+AdvanceCallback = Callable[[object, Optional[object], float, Optional[Exception]], None]
+
+class MixerTrack:
+    """One source on the mixer, with what is known about how long it has left."""
+    __slots__ = ('source', 'tag', 'frames_left', 'played', 'pending', 'decoder')
+
+    def __init__(self, source: discord.AudioSource, tag: object, duration: Optional[float],
+                 first_frame: Optional[bytes] = None):
+        self.source = source
+        self.tag = tag
+        self.frames_left = int(duration * FRAMES_PER_SECOND) if duration else None
+        self.played = 0
+        self.pending = first_frame  # Read ahead while the track was preloaded
+        self.decoder: Optional[discord.opus.Decoder] = None
+
+    def read(self) -> bytes:
+        if self.pending is not None:
+            data, self.pending = self.pending, None
+        else:
+            data = self.source.read()
+        if data:
+            self.played += 1
+            if self.frames_left is not None:
+                self.frames_left -= 1
+        return data
+
+    def read_pcm(self) -> bytes:
+        """Reads a frame as PCM, decoding Opus packets (only needed while crossfading)."""
+        data = self.read()
+        if data and self.source.is_opus():
+            if self.decoder is None:
+                self.decoder = discord.opus.Decoder()
+            data = self.decoder.decode(data)
+        if data and len(data) != FRAME_SIZE:
+            data = data[:FRAME_SIZE].ljust(FRAME_SIZE, b'\0')
+        return data
+
+class GuildMixer(discord.AudioSource):
+    """
+    A long-lived source for one voice connection that plays a current track
+    and moves on to a preloaded next one within the same frame, so
+    transitions need neither an FFmpeg spawn nor a trip through the event
+    loop. With a crossfade set, the two tracks overlap for its duration.
+
+    Frames are passed through in whichever format the track produces: Opus
+    packets stay Opus (the voice player asks is_opus() for every frame) and
+    are only decoded while two tracks are mixed. Between tracks with nothing
+    preloaded, silence is held for up to MIXER_IDLE_TIMEOUT so the next track
+    can start on the same player.
+
+    on_advance is called on the voice player thread whenever a track ends.
+    """
+
+    def __init__(self, on_advance: AdvanceCallback, crossfade: float = 0.0):
+        self.on_advance = on_advance
+        self.crossfade = crossfade
+        self._lock = threading.Lock()
+        self._current: Optional[MixerTrack] = None
+        self._next: Optional[MixerTrack] = None
+        self._fade_step: Optional[int] = None
+        self._fade_total = 0
+        self._skip = False
+        self._finished = False
+        self._opus = False  # False until the first frame, so the voice client creates an encoder
+        self._idle_since: Optional[float] = None
+        self._ended_at: Optional[float] = None
+
+    # ---------------------------------------------
+    # CONTROL (event loop)
+    # ---------------------------------------------
+    @property
+    def current_tag(self) -> Optional[object]:
+        current = self._current
+        return current.tag if current else None
+
+    @property
+    def next_tag(self) -> Optional[object]:
+        upcoming = self._next
+        return upcoming.tag if upcoming else None
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left of the current track, if its duration is known."""
+        current = self._current
+        if current is None or current.frames_left is None:
+            return None
+        return max(0.0, current.frames_left / FRAMES_PER_SECOND)
+
+    def play_now(self, source: discord.AudioSource, tag: object, duration: Optional[float] = None):
+        """Replaces the current track (and any crossfade in progress) with source."""
+        with self._lock:
+            replaced = self._current
+            self._current = MixerTrack(source, tag, duration)
+            self._fade_step = None
+            self._skip = False
+            self._finished = False
+        if replaced:
+            replaced.source.cleanup()
+
+    def set_next(self, source: discord.AudioSource, tag: object, duration: Optional[float] = None,
+                 first_frame: Optional[bytes] = None):
+        """Preloads the track that follows the current one."""
+        with self._lock:
+            replaced = self._next
+            self._next = MixerTrack(source, tag, duration, first_frame)
+            self._fade_step = None
+        if replaced:
+            replaced.source.cleanup()
+
+    def clear_next(self):
+        with self._lock:
+            replaced, self._next = self._next, None
+            self._fade_step = None
+        if replaced:
+            replaced.source.cleanup()
+
+    def drop_next(self, source: discord.AudioSource) -> bool:
+        """Discards the preloaded track if it is still source and not yet audible. Returns True if it was."""
+        with self._lock:
+            upcoming = self._next
+            if upcoming is None or upcoming.source is not source or self._fade_step is not None:
+                return False
+            self._next = None
+        upcoming.source.cleanup()
+        return True
+
+    def skip(self):
+        """Ends the current track at the next frame, moving on to the preloaded one if there is one."""
+        self._skip = True
+
+    def finish(self):
+        """Releases the voice player once the current track (if any) has ended."""
+        self._finished = True
+
+    # ---------------------------------------------
+    # PLAYBACK (voice player thread)
+    # ---------------------------------------------
+    def is_opus(self) -> bool:
+        return self._opus
+
+    def read(self) -> bytes:
+        events: List[Tuple[object, Optional[object], float, Optional[Exception]]] = []
+        discarded: List[discord.AudioSource] = []
+        with self._lock:
+            data = self._mix(events, discarded)
+        # FFmpeg is killed and the event loop notified outside the lock
+        for source in discarded:
+            source.cleanup()
+        for event in events:
+            try:
+                self.on_advance(*event)
+            except Exception:
+                logger.exception("Error in mixer advance callback")
+        return data
+
+    def _mix(self, events, discarded) -> bytes:
+        if self._skip:
+            self._skip = False
+            if self._current:
+                self._end_current(events, discarded, None)
+
+        while self._current is not None:
+            if self._fade_step is not None:
+                return self._crossfade_frame(events, discarded)
+            current = self._current
+            error = None
+            try:
+                data = current.read()
+            except Exception as e:
+                data, error = b'', e
+            if data:
+                fade_frames = int(self.crossfade * FRAMES_PER_SECOND)
+                if (self._next is not None and fade_frames and current.frames_left is not None
+                        and current.frames_left <= fade_frames):
+                    self._fade_step, self._fade_total = 0, max(1, current.frames_left)
+                self._delivered(current.source.is_opus())
+                return data
+            self._end_current(events, discarded, error)
+
+        if self._finished:
+            return b''
+        now = time.monotonic()
+        if self._idle_since is None:
+            self._idle_since = now
+        elif now - self._idle_since > MIXER_IDLE_TIMEOUT:
+            return b''
+        self._opus = False
+        return SILENCE
+
+    def _crossfade_frame(self, events, discarded) -> bytes:
+        current, incoming = self._current, self._next
+        outgoing_frame = current.read_pcm()
+        incoming_frame = incoming.read_pcm()
+        if not incoming_frame:
+            # The next track failed before it was heard: drop it and let the current one finish alone
+            discarded.append(incoming.source)
+            self._next, self._fade_step = None, None
+            if outgoing_frame:
+                self._delivered(False)
+                return outgoing_frame
+            self._end_current(events, discarded, None)
+            return self._mix(events, discarded)
+        if not outgoing_frame:
+            # Shorter than its duration said: the incoming track simply continues at full volume
+            self._end_current(events, discarded, None)
+            self._delivered(False)
+            return incoming_frame
+
+        self._fade_step += 1
+        gain = self._fade_step / self._fade_total
+        data = audioop.add(audioop.mul(outgoing_frame, 2, 1.0 - gain), audioop.mul(incoming_frame, 2, gain), 2)
+        if self._fade_step >= self._fade_total:
+            self._end_current(events, discarded, None)
+        self._delivered(False)
+        return data
+
+    def _end_current(self, events, discarded, error: Optional[Exception]):
+        finished = self._current
+        discarded.append(finished.source)
+        self._current, self._next = self._next, None
+        self._fade_step = None
+        self._ended_at = time.perf_counter()
+        started = self._current
+        events.append((finished.tag, started.tag if started else None,
+                       started.played / FRAMES_PER_SECOND if started else 0.0, error))
+
+    def _delivered(self, opus: bool):
+        self._opus = opus
+        self._idle_since = None
+        if self._ended_at is not None:
+            TRACK_GAP_SECONDS.observe(time.perf_counter() - self._ended_at)
+            self._ended_at = None
+
+    def cleanup(self):
+        with self._lock:
+            tracks = [t for t in (self._current, self._next) if t]
+            self._current = self._next = None
+            self._finished = True
+        for track in tracks:
+            track.source.cleanup()
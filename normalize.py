@@ -0,0 +1,222 @@
+import os
+import re
+import json
+import math
+import sqlite3
+import hashlib
+import logging
+import threading
+import subprocess
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from executors import run_in_processes
+from governor import FFMPEG_THREADS, lower_priority
+
+logger = logging.getLogger(__name__)
+
+# --- Loudness Targets (EBU R128) ---
+TARGET_LOUDNESS = -16.0  # Integrated loudness, LUFS
+TRUE_PEAK_LIMIT = -1.0   # Max true peak after gain, dBTP
+MAX_GAIN = 20.0          # Never boost quiet tracks more than this, dB
+
+OPUS_BITRATE = '128k'
+ANALYZE_TIMEOUT = 600    # Seconds allowed per file for measuring or transcoding
+BATCH_SIZE = 50          # Results written to the database per transaction
+
+LOUDNORM_JSON_REGEX = re.compile(r'\{[^{}]*"input_i"[^{}]*\}', re.S)
+
+class Rendition(NamedTuple):
+    gain_db: float
+    opus_path: Optional[str]
+    # The measured file's mtime and size; None for measurements stored before they were recorded
+    mtime: Optional[float] = None
+    size: Optional[int] = None
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return self.mtime is None or (self.mtime == stat.st_mtime and self.size == stat.st_size)
+
+def measure_loudness(path: str) -> float:
+    """Measures a file with FFmpeg's loudnorm filter and returns the gain (dB) to reach the target."""
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-threads', str(FFMPEG_THREADS), '-i', path, '-vn',
+           '-af', 'loudnorm=print_format=json', '-f', 'null', '-']
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=ANALYZE_TIMEOUT)
+    match = LOUDNORM_JSON_REGEX.search(result.stderr)
+    if not match:
+        raise RuntimeError(f"ffmpeg produced no loudness stats (exit code {result.returncode})")
+
+    stats = json.loads(match.group(0))
+    integrated, true_peak = float(stats['input_i']), float(stats['input_tp'])
+    if not math.isfinite(integrated):
+        return 0.0  # Silence
+    gain = TARGET_LOUDNESS - integrated
+    if math.isfinite(true_peak):
+        gain = min(gain, TRUE_PEAK_LIMIT - true_peak)
+    return round(min(gain, MAX_GAIN), 2)
+
+def transcode_to_opus(path: str, opus_path: str, gain_db: float):
+    """Writes a gain-adjusted 48 kHz stereo Opus copy of path."""
+    tmp_path = opus_path + '.part'
+    cmd = ['ffmpeg', '-hide_banner', '-nostats', '-loglevel', 'error', '-y', '-i', path, '-vn',
+           '-af', f'volume={gain_db}dB', '-ac', '2', '-ar', '48000', '-threads', str(FFMPEG_THREADS),
+           '-c:a', 'libopus', '-b:a', OPUS_BITRATE, '-f', 'opus', tmp_path]
+    subprocess.run(cmd, check=True, capture_output=True, timeout=ANALYZE_TIMEOUT)
+    os.replace(tmp_path, opus_path)
+
+def analyze_file(path: str, opus_path: Optional[str]) -> Rendition:
+    """Process pool entry point: measures one file and optionally transcodes it."""
+    stat = os.stat(path)  # Before reading, so a change while measuring is picked up next pass
+    gain_db = measure_loudness(path)
+    if opus_path:
+        transcode_to_opus(path, opus_path, gain_db)
+    return Rendition(gain_db, opus_path, stat.st_mtime, stat.st_size)
+
+class NormalizationCache:
+    """
+    Per-file loudness gains (and optional pre-normalized Opus renditions),
+    computed once per version of a file (by mtime and size) in a background
+    process pool and kept in cache_dir. Lookups at play time are answered
+    from memory, after one stat() to check the file was not replaced.
+    """
+
+    def __init__(self, cache_dir: str, transcode: bool = True):
+        self.cache_dir = cache_dir
+        self.transcode = transcode
+        self.db_path = os.path.join(cache_dir, 'loudness.db')
+        self._entries: Dict[str, Rendition] = {}
+        self._failed: set = set()  # (path, mtime, size) of file versions that could not be measured
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS renditions ("
+                     "path TEXT PRIMARY KEY, gain_db REAL NOT NULL, opus_path TEXT, mtime REAL, size INTEGER)")
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(renditions)")}
+        for column, kind in (('mtime', 'REAL'), ('size', 'INTEGER')):
+            if column not in columns:  # Databases from older versions
+                conn.execute(f"ALTER TABLE renditions ADD COLUMN {column} {kind}")
+        return conn
+
+    def load(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT path, gain_db, opus_path, mtime, size FROM renditions").fetchall()
+        finally:
+            conn.close()
+        with self._lock:
+            self._entries = {path: Rendition(*fields) for path, *fields in rows}
+        logger.info(f"Loaded {len(rows)} loudness measurements.")
+
+    def lookup(self, path: str, verify: bool = True) -> Optional[Rendition]:
+        """
+        The rendition of path, or None if there is none for the file as it
+        is now. verify=False skips the stat() and may return the measurement
+        of a file replaced since the last pass.
+        """
+        rendition = self._entries.get(path)
+        if rendition is None or not verify:
+            return rendition
+        try:
+            return rendition if rendition.matches(os.stat(path)) else None
+        except OSError:
+            return None
+
+    def _opus_path(self, path: str) -> str:
+        digest = hashlib.sha1(path.encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + '.opus')
+
+    def process(self, paths: Iterable[str], workers: int) -> int:
+        """
+        Analyzes every path that has no rendition for its current mtime and
+        size yet, in a process pool. Returns the number of files processed.
+        """
+        pending, unstamped = [], []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            rendition = self._entries.get(path)
+            if rendition is not None and rendition.matches(stat):
+                if rendition.mtime is None:
+                    unstamped.append((stat.st_mtime, stat.st_size, path))
+            elif (path, stat.st_mtime, stat.st_size) not in self._failed:
+                pending.append((path, stat))
+        if unstamped:
+            self._stamp(unstamped)
+        if not pending:
+            return 0
+        logger.info(f"Normalizing {len(pending)} files with {workers} workers.")
+
+        def jobs():
+            for path, stat in pending:
+                opus_path = None
+                if self.transcode:
+                    opus_path = self._opus_path(path)
+                    os.makedirs(os.path.dirname(opus_path), exist_ok=True)
+                yield (path, stat), (path, opus_path)
+
+        done = 0
+        batch: List[tuple] = []
+        conn = self._connect()
+        try:
+            for (path, stat), future in run_in_processes(analyze_file, jobs(), workers, lower_priority):
+                try:
+                    rendition = future.result()
+                except Exception as e:
+                    logger.warning(f"Could not normalize {path}: {e}")
+                    self._failed.add((path, stat.st_mtime, stat.st_size))
+                    continue
+                with self._lock:
+                    self._entries[path] = rendition
+                batch.append((path, *rendition))
+                done += 1
+
+                if len(batch) >= BATCH_SIZE:
+                    with conn:
+                        conn.executemany("INSERT OR REPLACE INTO renditions VALUES (?, ?, ?, ?, ?)", batch)
+                    batch.clear()
+            if batch:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO renditions VALUES (?, ?, ?, ?, ?)", batch)
+        finally:
+            conn.close()
+        return done
+
+    def _stamp(self, rows: List[tuple]):
+        """Records current file stats for measurements stored before stats were, trusting them once."""
+        with self._lock:
+            for mtime, size, path in rows:
+                rendition = self._entries.get(path)
+                if rendition is not None:
+                    self._entries[path] = rendition._replace(mtime=mtime, size=size)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("UPDATE renditions SET mtime = ?, size = ? WHERE path = ?", rows)
+        finally:
+            conn.close()
+
+    def prune(self, valid_paths: Iterable[str]) -> int:
+        """Forgets renditions (and deletes Opus files) of tracks no longer in the library."""
+        valid = set(valid_paths)
+        with self._lock:
+            stale = {p: r for p, r in self._entries.items() if p not in valid}
+            for path in stale:
+                del self._entries[path]
+        if not stale:
+            return 0
+
+        for rendition in stale.values():
+            if rendition.opus_path:
+                try:
+                    os.remove(rendition.opus_path)
+                except OSError:
+                    pass
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("DELETE FROM renditions WHERE path = ?", ((p,) for p in stale))
+        finally:
+            conn.close()
+        return len(stale)
@@ -0,0 +1,273 @@
+import random
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Union
+
+SPREAD_WINDOW = 16  # Upcoming tracks searched for one by an artist that was not just played
+SPREAD_MEMORY = 3   # Artists the next track of a spread shuffle should differ from
+
+# Groups tracks for artist-spread shuffling (artist, or whatever stands in for it)
+SpreadKey = Callable[[int], Optional[str]]
+
+class YouTubeTrack:
+    __slots__ = ('title', 'url', 'duration')
+
+    def __init__(self, title: str, url: str, duration: Optional[float] = None):
+        self.title = title
+        self.url = url
+        self.duration = duration
+
+    @classmethod
+    def from_entry(cls, entry: Dict) -> 'YouTubeTrack':
+        """Builds a track from a get_youtube_info entry."""
+        return cls(entry.get('title', 'Unknown'), entry['url'], entry.get('duration'))
+
+    def to_entry(self) -> Dict:
+        return {'title': self.title, 'url': self.url, 'duration': self.duration}
+
+class LazyShuffle:
+    """
+    Pseudo-random permutation of range(n), computed one element at a time.
+
+    A small Feistel network permutes [0, 2**bits) and cycle-walking restricts
+    it to [0, n), so shuffling a library of any size costs O(1) memory
+    instead of a materialized, shuffled copy.
+    """
+    __slots__ = ('n', '_half_bits', '_mask', '_keys')
+
+    ROUNDS = 4
+
+    def __init__(self, n: int, seed: Optional[int] = None):
+        self.n = n
+        bits = max(2, (n - 1).bit_length())
+        bits += bits % 2
+        self._half_bits = bits // 2
+        self._mask = (1 << self._half_bits) - 1
+        rng = random.Random(seed)
+        self._keys = tuple(rng.getrandbits(32) for _ in range(self.ROUNDS))
+
+    def _round(self, value: int, key: int) -> int:
+        value = ((value ^ key) * 0x9E3779B1) & 0xFFFFFFFF
+        value ^= value >> 15
+        return value & self._mask
+
+    def _encrypt(self, x: int) -> int:
+        left, right = x >> self._half_bits, x & self._mask
+        for key in self._keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self._half_bits) | right
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self.n:
+            raise IndexError(i)
+        x = i
+        while True:
+            x = self._encrypt(x)
+            if x < self.n:
+                return x
+
+class ShuffledSegment:
+    """
+    A lazily shuffled, partially consumed view over a shared sequence of track IDs.
+    The permutation is fully determined by its seed, so a segment can be persisted
+    as (source, seed, position) and rebuilt later (with its swaps and recent
+    artists, if spread).
+
+    With a spread_key, tracks by the same artist are kept apart: whenever a
+    track is popped, the next one is swapped with the nearest track within
+    SPREAD_WINDOW whose artist was not among the last few. Only those swaps
+    are stored, so the segment still never materializes the shuffled order.
+    """
+    __slots__ = ('ids', 'source', 'seed', 'order', 'position', 'spread_key', 'swaps', '_recent_keys')
+
+    def __init__(self, ids: Sequence[int], source: Optional[str] = None,
+                 seed: Optional[int] = None, position: int = 0,
+                 spread_key: Optional[SpreadKey] = None, swaps: Optional[Dict[int, int]] = None,
+                 recent_keys: Iterable[Optional[str]] = ()):
+        self.ids = ids
+        self.source = source
+        self.seed = random.getrandbits(64) if seed is None else seed
+        self.order = LazyShuffle(len(ids), self.seed)
+        self.position = min(position, len(ids))
+        self.spread_key = spread_key
+        self.swaps: Dict[int, int] = dict(swaps) if swaps else {}  # Position -> permutation index
+        self._recent_keys: Deque[Optional[str]] = deque(recent_keys, maxlen=SPREAD_MEMORY)
+
+    def __len__(self) -> int:
+        return len(self.ids) - self.position
+
+    def _index(self, position: int) -> int:
+        return self.swaps.get(position, position)
+
+    def __getitem__(self, i: int) -> int:
+        return self.ids[self.order[self._index(self.position + i)]]
+
+    def pop(self) -> int:
+        track_id = self[0]
+        self.swaps.pop(self.position, None)
+        self.position += 1
+        if self.spread_key is not None:
+            self._recent_keys.append(self.spread_key(track_id))
+            self._spread()
+        return track_id
+
+    def _spread(self):
+        """Settles the next track, so peeking at it and popping it agree."""
+        for offset in range(min(SPREAD_WINDOW, len(self))):
+            if self.spread_key(self[offset]) not in self._recent_keys:
+                if offset:
+                    head, other = self.position, self.position + offset
+                    self.swaps[head], self.swaps[other] = self._index(other), self._index(head)
+                return
+
+# A queued track: a library track ID or a YouTube video
+Track = Union[int, YouTubeTrack]
+
+def track_kind(track: Track) -> str:
+    return 'yt' if isinstance(track, YouTubeTrack) else 'dj'
+
+class TrackQueue:
+    """
+    A guild's play queue, holding library tracks and YouTube videos in one
+    order. Whole directories are enqueued as segments that reference the
+    library's shared ID snapshot, so a guild queueing the entire library
+    holds a few objects rather than a copy of every track.
+    """
+    __slots__ = ('_segments', '_length', 'video_count')
+
+    def __init__(self):
+        self._segments: Deque[Union[int, YouTubeTrack, ShuffledSegment]] = deque()
+        self._length = 0
+        self.video_count = 0  # YouTube entries, which the queue size limit applies to
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[Track]:
+        for segment in self._segments:
+            if isinstance(segment, ShuffledSegment):
+                for i in range(len(segment)):
+                    yield segment[i]
+            else:
+                yield segment
+
+    def window(self, start: int, stop: int) -> Iterator[Track]:
+        """The tracks at positions start to stop, skipping whole segments before them unread."""
+        position = 0
+        for segment in self._segments:
+            if position >= stop:
+                return
+            size = len(segment) if isinstance(segment, ShuffledSegment) else 1
+            if position + size > start:
+                if isinstance(segment, ShuffledSegment):
+                    for i in range(max(0, start - position), min(size, stop - position)):
+                        yield segment[i]
+                else:
+                    yield segment
+            position += size
+
+    def peek(self) -> Optional[Track]:
+        return next(iter(self), None)
+
+    def append(self, track: Track):
+        self._segments.append(track)
+        self._added(track, 1)
+
+    def appendleft(self, track: Track):
+        self._segments.appendleft(track)
+        self._added(track, 1)
+
+    def extend(self, tracks: Iterable[Track]):
+        for track in tracks:
+            self.append(track)
+
+    def _added(self, track: Track, count: int):
+        self._length += count
+        if isinstance(track, YouTubeTrack):
+            self.video_count += count
+
+    def extend_shuffled(self, ids: Sequence[int], source: Optional[str] = None,
+                        spread_key: Optional[SpreadKey] = None):
+        """
+        Queues library ids in a lazily shuffled order. source names where ids
+        came from (for snapshots); spread_key keeps tracks by one artist apart.
+        """
+        if ids:
+            self._add_segment(ShuffledSegment(ids, source, spread_key=spread_key))
+
+    def _add_segment(self, segment: ShuffledSegment):
+        if len(segment):
+            self._segments.append(segment)
+            self._length += len(segment)
+
+    def popleft(self) -> Track:
+        if not self._segments:
+            raise IndexError("pop from an empty TrackQueue")
+        head = self._segments[0]
+        if not isinstance(head, ShuffledSegment):
+            self._added(head, -1)
+            return self._segments.popleft()
+        self._length -= 1
+        track_id = head.pop()
+        if not len(head):
+            self._segments.popleft()
+        return track_id
+
+    def remove_videos(self) -> int:
+        """Drops every YouTube entry, keeping the library tracks in order. Returns how many were removed."""
+        removed = self.video_count
+        if removed:
+            self._segments = deque(s for s in self._segments if not isinstance(s, YouTubeTrack))
+            self._length -= removed
+            self.video_count = 0
+        return removed
+
+    def clear(self):
+        self._segments.clear()
+        self._length = 0
+        self.video_count = 0
+
+    def to_snapshot(self) -> List:
+        """
+        Compact, JSON-serializable form of the queue: library tracks as IDs,
+        shuffled directories as {source, seed, position}, videos as {video}.
+        """
+        snapshot = []
+        for segment in self._segments:
+            if isinstance(segment, int):
+                snapshot.append(segment)
+            elif isinstance(segment, YouTubeTrack):
+                snapshot.append({'video': segment.to_entry()})
+            elif segment.source is not None:
+                item = {'source': segment.source, 'seed': segment.seed, 'position': segment.position}
+                if segment.spread_key is not None:
+                    item['spread'] = True
+                    item['swaps'] = [[p, i] for p, i in segment.swaps.items()]
+                    item['recent'] = list(segment._recent_keys)
+                snapshot.append(item)
+            else:
+                snapshot.extend(segment[i] for i in range(len(segment)))
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot: List, resolve_source: Callable[[str], Sequence[int]],
+                      spread_key: Optional[SpreadKey] = None) -> 'TrackQueue':
+        """
+        Rebuilds a queue; resolve_source maps a segment's source back to its
+        track IDs, spread_key is used again for segments that were spread.
+        """
+        queue = cls()
+        for item in snapshot:
+            if isinstance(item, int):
+                queue.append(item)
+            elif 'video' in item:
+                queue.append(YouTubeTrack.from_entry(item['video']))
+            else:
+                ids = resolve_source(item['source'])
+                spread = spread_key if item.get('spread') else None
+                swaps = {p: i for p, i in item.get('swaps', [])}
+                queue._add_segment(ShuffledSegment(ids, item['source'], item['seed'], item['position'],
+                                                   spread, swaps, item.get('recent', ())))
+        return queue
@@ -0,0 +1,333 @@
+import os
+import re
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import aiohttp
+from aiohttp import web
+
+from executors import Priority, io_pool
+
+logger = logging.getLogger(__name__)
+
+# --- Relay Configuration ---
+RELAY_CACHE_DIR = "relay_cache"
+RELAY_CACHE_BYTES = 1024 * 1024 * 1024  # Disk used by buffered streams before idle ones are evicted
+RELAY_MAX_STREAMS = 256                 # Registered streams kept, buffered or not
+RELAY_CHUNK_SIZE = 10 * 1024 * 1024     # Upstream range request size (googlevideo throttles unranged reads)
+RELAY_READ_SIZE = 64 * 1024
+RELAY_MAX_RETRIES = 5                   # Upstream reconnects per stream before giving up
+RELAY_IDLE_TIMEOUT = 60                 # Seconds an unfinished download continues with no listeners
+RELAY_SEEK_AHEAD = 4 * 1024 * 1024      # Reads this far past the buffer go straight upstream
+
+RANGE_REGEX = re.compile(r'bytes=(\d+)-(\d*)')
+
+def relay_key(stream_url: str) -> str:
+    """Identifies a stream independent of the signature/expiry parts of its URL."""
+    query = parse_qs(urlparse(stream_url).query)
+    video, itag = query.get('id', [''])[0], query.get('itag', [''])[0]
+    raw = f"{video}-{itag}" if video else stream_url
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+class RelayStream:
+    """
+    One upstream download, written sequentially to a file that any number of
+    readers follow. Readers block on `changed` until the bytes they need arrive.
+    """
+
+    def __init__(self, key: str, stream_url: str, path: str):
+        self.key = key
+        self.stream_url = stream_url
+        self.path = path
+        self.total: Optional[int] = None
+        self.written = 0
+        self.content_type = 'application/octet-stream'
+        self.complete = False
+        self.failed = False
+        self.readers = 0
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+        self.idle_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def done(self) -> bool:
+        return self.complete or self.failed
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def wait_for(self, offset: int):
+        """Waits until byte offset has been written, the size is known, or the download ended."""
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.written > offset or self.done
+                                        or (self.total is not None and offset >= self.total))
+
+class AudioRelay:
+    """
+    Local HTTP relay between FFmpeg and the YouTube CDN.
+
+    Each stream is fetched from upstream once, in large range requests that
+    resume where they left off after a dropped connection, and buffered on
+    disk. Every FFmpeg process playing it reads from localhost with range
+    support, so guilds playing the same video share one upstream connection,
+    seeks inside the buffer never leave the host, and upstream stalls are
+    absorbed by the read-ahead.
+    """
+
+    def __init__(self, cache_dir: str = RELAY_CACHE_DIR, max_bytes: int = RELAY_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.port: Optional[int] = None
+        self._streams: "OrderedDict[str, RelayStream]" = OrderedDict()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def running(self) -> bool:
+        return self.port is not None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0, instance: str = 'main'):
+        """
+        Starts the local server. instance names this process's own buffer
+        directory, stable across restarts, so shard processes sharing a
+        working directory never touch each other's buffers.
+        """
+        self.cache_dir = os.path.join(self.cache_dir, instance)
+        await io_pool.run(Priority.BACKGROUND, None, self._clear_buffers)
+
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=15))
+        app = web.Application()
+        app.router.add_get('/stream/{key}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.port = self._runner.addresses[0][1]
+        logger.info(f"Audio relay listening on {host}:{self.port}")
+
+    def _clear_buffers(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name in os.listdir(self.cache_dir):  # Buffers do not survive a restart
+            os.remove(os.path.join(self.cache_dir, name))
+
+    def url_for(self, stream_url: str) -> str:
+        """Registers stream_url and returns the local URL FFmpeg should read instead."""
+        key = relay_key(stream_url)
+        stream = self._streams.get(key)
+        if stream is None or stream.failed:
+            self._streams[key] = RelayStream(key, stream_url, os.path.join(self.cache_dir, key))
+            self._evict()
+        else:
+            # A fresher URL for the same stream, used if the download has to reconnect
+            stream.stream_url = stream_url
+            self._streams.move_to_end(key)
+        return f"http://127.0.0.1:{self.port}/stream/{key}"
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'streams': len(self._streams),
+                'downloading': sum(1 for s in self._streams.values() if s.task and not s.done),
+                'readers': sum(s.readers for s in self._streams.values()),
+                'buffered_bytes': sum(s.written for s in self._streams.values())}
+
+    # ---------------------------------------------
+    # UPSTREAM
+    # ---------------------------------------------
+    def _ensure_download(self, stream: RelayStream):
+        if stream.task is None:
+            stream.task = asyncio.create_task(self._download(stream))
+
+    async def _download(self, stream: RelayStream):
+        retries = 0
+        try:
+            with open(stream.path, 'wb') as f:
+                while stream.total is None or stream.written < stream.total:
+                    end = stream.written + RELAY_CHUNK_SIZE - 1
+                    headers = {'Range': f'bytes={stream.written}-{end}'}
+                    try:
+                        async with self._session.get(stream.stream_url, headers=headers) as resp:
+                            if resp.status not in (200, 206):
+                                raise aiohttp.ClientResponseError(
+                                    resp.request_info, resp.history, status=resp.status)
+                            if resp.status == 200 and stream.written:
+                                raise RuntimeError("upstream does not support resuming with ranges")
+                            if stream.total is None:
+                                stream.total = self._total_size(resp)
+                                stream.content_type = resp.headers.get('Content-Type', stream.content_type)
+                            received = 0
+                            async for data in resp.content.iter_chunked(RELAY_READ_SIZE):
+                                await io_pool.run(Priority.PLAYBACK, None, self._append, f, data)
+                                stream.written += len(data)
+                                received += len(data)
+                                await stream.notify()
+                            if stream.total is None or resp.status == 200:
+                                break  # Upstream ignored the range and sent everything
+                            if not received:
+                                raise aiohttp.ClientPayloadError("Empty range response")
+                        retries = 0
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        status = getattr(e, 'status', None)
+                        retries += 1
+                        if retries > RELAY_MAX_RETRIES or status in (403, 404, 410):
+                            raise
+                        logger.warning(f"Relay upstream dropped for {stream.key} at {stream.written} bytes "
+                                       f"({e}), reconnecting")
+                        await asyncio.sleep(min(2 ** retries, 10) / 4)
+            stream.complete = True
+            if stream.total is None:
+                stream.total = stream.written
+        except asyncio.CancelledError:
+            stream.failed = True
+            raise
+        except Exception as e:
+            logger.error(f"Relay download failed for {stream.key}: {e}")
+            stream.failed = True
+        finally:
+            await stream.notify()
+            self._evict()
+
+    @staticmethod
+    def _append(f, data: bytes):
+        f.write(data)
+        f.flush()  # Readers open the file separately
+
+    @staticmethod
+    def _total_size(resp: aiohttp.ClientResponse) -> Optional[int]:
+        content_range = resp.headers.get('Content-Range', '')
+        if '/' in content_range and not content_range.endswith('*'):
+            return int(content_range.rsplit('/', 1)[1])
+        if resp.status == 200 and resp.content_length is not None:
+            return resp.content_length
+        return None
+
+    def _evict(self):
+        """Drops least recently used streams nobody is reading until the cache fits."""
+        used = sum(s.written for s in self._streams.values())
+        for key in list(self._streams):
+            if used <= self.max_bytes and len(self._streams) <= RELAY_MAX_STREAMS:
+                break
+            stream = self._streams[key]
+            if stream.readers or (stream.task and not stream.done):
+                continue
+            used -= stream.written
+            self._drop(stream)
+
+    def _drop(self, stream: RelayStream):
+        if stream.task and not stream.task.done():
+            stream.task.cancel()
+        # A failed stream's replacement reuses its file, so only the registered stream owns it
+        if self._streams.get(stream.key) is stream:
+            del self._streams[stream.key]
+            try:
+                os.remove(stream.path)
+            except OSError:
+                pass
+
+    def _on_idle(self, stream: RelayStream):
+        """Stops a download nobody has listened to for a while, e.g. a skipped track."""
+        stream.idle_handle = None
+        if not stream.readers and not stream.done:
+            logger.info(f"Relay stream {stream.key} has no listeners, stopping download")
+            self._drop(stream)
+
+    # ---------------------------------------------
+    # LOCAL SERVER
+    # ---------------------------------------------
+    def _parse_range(self, request: web.Request) -> Tuple[int, Optional[int]]:
+        match = RANGE_REGEX.fullmatch(request.headers.get('Range', '').strip())
+        if not match:
+            return 0, None
+        return int(match.group(1)), int(match.group(2)) if match.group(2) else None
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        stream = self._streams.get(request.match_info['key'])
+        if stream is None or stream.failed:
+            raise web.HTTPNotFound()
+        start, end = self._parse_range(request)
+        self._streams.move_to_end(stream.key)
+        self._ensure_download(stream)
+
+        stream.readers += 1
+        if stream.idle_handle:
+            stream.idle_handle.cancel()
+            stream.idle_handle = None
+        try:
+            await stream.wait_for(0)
+            if stream.failed:
+                raise web.HTTPBadGateway()
+            if stream.total is not None and start >= stream.total:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{stream.total}'})
+            if start > stream.written + RELAY_SEEK_AHEAD:
+                return await self._proxy(request, stream, start, end)
+            return await self._serve(request, stream, start, end)
+        finally:
+            stream.readers -= 1
+            if not stream.readers and not stream.done:
+                stream.idle_handle = asyncio.get_running_loop().call_later(
+                    RELAY_IDLE_TIMEOUT, self._on_idle, stream)
+
+    async def _serve(self, request: web.Request, stream: RelayStream, start: int,
+                     end: Optional[int]) -> web.StreamResponse:
+        """Serves [start, end] from the buffer, following the download as it grows."""
+        if stream.total is not None:
+            end = stream.total - 1 if end is None else min(end, stream.total - 1)
+        resp = web.StreamResponse(status=206 if request.headers.get('Range') else 200)
+        resp.content_type = stream.content_type
+        resp.headers['Accept-Ranges'] = 'bytes'
+        if end is not None:
+            resp.content_length = end - start + 1
+            if resp.status == 206:
+                resp.headers['Content-Range'] = f'bytes {start}-{end}/{stream.total}'
+        await resp.prepare(request)
+
+        offset = start
+        # The file was just written, so these reads are usually served from the page cache
+        f = await io_pool.run(Priority.PLAYBACK, None, open, stream.path, 'rb')
+        try:
+            while end is None or offset <= end:
+                if offset >= stream.written:
+                    if stream.done:
+                        break
+                    await stream.wait_for(offset)
+                    continue
+                limit = stream.written - offset if end is None else min(stream.written, end + 1) - offset
+                data = await io_pool.run(Priority.PLAYBACK, None, os.pread,
+                                         f.fileno(), min(RELAY_READ_SIZE, limit), offset)
+                if not data:
+                    break
+                await resp.write(data)
+                offset += len(data)
+        finally:
+            f.close()
+        await resp.write_eof()
+        return resp
+
+    async def _proxy(self, request: web.Request, stream: RelayStream, start: int,
+                     end: Optional[int]) -> web.StreamResponse:
+        """Passes a far seek straight through to upstream rather than waiting for the buffer."""
+        headers = {'Range': f"bytes={start}-{'' if end is None else end}"}
+        async with self._session.get(stream.stream_url, headers=headers) as upstream:
+            resp = web.StreamResponse(status=upstream.status)
+            for name in ('Content-Type', 'Content-Length', 'Content-Range', 'Accept-Ranges'):
+                if name in upstream.headers:
+                    resp.headers[name] = upstream.headers[name]
+            await resp.prepare(request)
+            async for data in upstream.content.iter_chunked(RELAY_READ_SIZE):
+                await resp.write(data)
+        await resp.write_eof()
+        return resp
+
+    async def close(self):
+        for stream in list(self._streams.values()):
+            self._drop(stream)
+        if self._runner:
+            await self._runner.cleanup()
+        if self._session:
+            await self._session.close()
+        self.port = None
+
+audio_relay = AudioRelay()
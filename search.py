@@ -0,0 +1,245 @@
+import re
+import sys
+import heapq
+import bisect
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+TOKEN_REGEX = re.compile(r"[^\W_]+", re.UNICODE)
+
+# Relative weight of a hit in each field of a document
+TITLE_WEIGHT = 3.0
+TAG_WEIGHT = 2.0      # artist / album
+CONTEXT_WEIGHT = 1.0  # containing folder names
+
+# Per-token match quality multipliers
+EXACT_MATCH = 1.0
+PREFIX_MATCH = 0.8
+FUZZY_MIN_SIMILARITY = 0.35
+MAX_EXPANSIONS = 32  # Max vocabulary terms a single query token may expand to
+MAX_CANDIDATES = 1000  # Best matches of the most selective query token that are scored against the rest
+MAX_SCANNED_CANDIDATES = 4 * MAX_CANDIDATES  # Total considered, in growing batches, while too few match the rest
+
+def tokenize(text: str) -> List[str]:
+    return [sys.intern(t) for t in TOKEN_REGEX.findall(text.lower())]
+
+def trigrams(token: str) -> Set[str]:
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class SearchIndex:
+    """
+    Inverted token index with prefix and trigram-based fuzzy matching.
+
+    Documents are track IDs with three text fields (title, tags, context).
+    Query tokens are expanded against the vocabulary (exact, prefix, then
+    fuzzy via a trigram index over the vocabulary, not the documents), so
+    query cost depends on vocabulary size rather than library size.
+    Matching documents are then gathered from the most selective token only,
+    best first and MAX_CANDIDATES at a time, and looked up in the other
+    tokens' postings until enough match, so common words do not make every
+    query walk most of the library. Documents outside the best
+    MAX_SCANNED_CANDIDATES of the most selective token are never returned.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings: Dict[str, Dict[int, float]] = {}
+        self._docs: Dict[int, Tuple[str, ...]] = {}
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._sorted_vocab: Optional[List[str]] = None
+        self._expansions: Dict[str, List[Tuple[str, float]]] = {}
+        self._ranked: Dict[str, List[Tuple[float, List[int]]]] = {}  # term -> its postings grouped by weight
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, doc_id: int, title: str, tags: Iterable[str] = (), context: Iterable[str] = ()):
+        """Indexes a document, replacing any previous version of it."""
+        weights: Dict[str, float] = {}
+        for text, weight in [(title, TITLE_WEIGHT)] + [(t, TAG_WEIGHT) for t in tags if t] + \
+                            [(c, CONTEXT_WEIGHT) for c in context if c]:
+            for token in tokenize(text):
+                if weights.get(token, 0.0) < weight:
+                    weights[token] = weight
+
+        with self._lock:
+            self.remove(doc_id)
+            self._docs[doc_id] = tuple(weights)
+            for token, weight in weights.items():
+                self._ranked.pop(token, None)
+                posting = self._postings.get(token)
+                if posting is None:
+                    posting = self._postings[token] = {}
+                    for tri in trigrams(token):
+                        self._trigrams[tri].add(token)
+                    self._invalidate_vocab()
+                posting[doc_id] = weight
+
+    def remove(self, doc_id: int):
+        with self._lock:
+            for token in self._docs.pop(doc_id, ()):
+                self._ranked.pop(token, None)
+                posting = self._postings.get(token)
+                if posting is None:
+                    continue
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self._postings[token]
+                    for tri in trigrams(token):
+                        bucket = self._trigrams.get(tri)
+                        if bucket is not None:
+                            bucket.discard(token)
+                            if not bucket:
+                                del self._trigrams[tri]
+                    self._invalidate_vocab()
+
+    def _invalidate_vocab(self):
+        self._sorted_vocab = None
+        self._expansions.clear()
+
+    def _expand(self, token: str) -> List[Tuple[str, float]]:
+        """Maps a query token to (vocabulary term, match quality) pairs."""
+        cached = self._expansions.get(token)
+        if cached is not None:
+            return cached
+
+        matches: Dict[str, float] = {}
+        if token in self._postings:
+            matches[token] = EXACT_MATCH
+
+        if self._sorted_vocab is None:
+            self._sorted_vocab = sorted(self._postings)
+        vocab = self._sorted_vocab
+        i = bisect.bisect_left(vocab, token)
+        while i < len(vocab) and vocab[i].startswith(token) and len(matches) < MAX_EXPANSIONS:
+            if vocab[i] != token:
+                matches[vocab[i]] = PREFIX_MATCH
+            i += 1
+
+        if len(token) >= 3 and len(matches) < MAX_EXPANSIONS:
+            query_tris = trigrams(token)
+            overlap: Dict[str, int] = defaultdict(int)
+            for tri in query_tris:
+                for term in self._trigrams.get(tri, ()):
+                    overlap[term] += 1
+            scored = []
+            for term, shared in overlap.items():
+                if term in matches:
+                    continue
+                # A term of n characters has n + 1 padded trigrams
+                similarity = shared / (len(query_tris) + len(term) + 1 - shared)
+                if similarity >= FUZZY_MIN_SIMILARITY:
+                    scored.append((similarity * PREFIX_MATCH, term))
+            for similarity, term in heapq.nlargest(MAX_EXPANSIONS - len(matches), scored):
+                matches[term] = similarity
+
+        result = list(matches.items())
+        self._expansions[token] = result
+        return result
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """
+        Returns up to limit (doc_id, score) pairs, best first.
+        Every query token must match a document for it to be returned.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self._lock:
+            expanded: List[Tuple[int, List[Tuple[str, float]]]] = []
+            for token in dict.fromkeys(tokens):
+                terms = self._expand(token)
+                if not terms:
+                    return []
+                expanded.append((sum(len(self._postings[term]) for term, _ in terms), terms))
+            # The most selective token supplies the candidates
+            expanded.sort(key=lambda item: item[0])
+            return self._rank(expanded, limit)
+
+    def _rank(self, expanded: List[Tuple[int, List[Tuple[str, float]]]], limit: int) -> List[Tuple[int, float]]:
+        size, terms = expanded[0]
+        batches = [self._hits(terms)] if size <= MAX_CANDIDATES else self._best_hits(terms)
+        scores: Dict[int, float] = {}
+        for batch in batches:
+            for size, terms in expanded[1:]:
+                batch = self._intersect(batch, size, terms)
+                if not batch:
+                    break
+            scores.update(batch)
+            if len(scores) >= limit:
+                break
+
+        # Prefer documents with fewer unmatched tokens (i.e. tighter matches)
+        query_len = len(expanded)
+        return heapq.nlargest(
+            limit,
+            ((d, s / query_len - 0.01 * (len(self._docs[d]) - query_len)) for d, s in scores.items()),
+            key=lambda item: item[1])
+
+    def _hits(self, terms: List[Tuple[str, float]]) -> Dict[int, float]:
+        """Every document matching one of terms, with its best score."""
+        hits: Dict[int, float] = {}
+        for term, quality in terms:
+            for doc_id, weight in self._postings[term].items():
+                score = weight * quality
+                if hits.get(doc_id, 0.0) < score:
+                    hits[doc_id] = score
+        return hits
+
+    def _ranked_posting(self, term: str) -> List[Tuple[float, List[int]]]:
+        """A term's documents grouped by field weight (only a few distinct values), highest first."""
+        ranked = self._ranked.get(term)
+        if ranked is None:
+            groups: Dict[float, List[int]] = defaultdict(list)
+            for doc_id, weight in self._postings[term].items():
+                groups[weight].append(doc_id)
+            ranked = self._ranked[term] = sorted(groups.items(), reverse=True)
+        return ranked
+
+    def _best_hits(self, terms: List[Tuple[str, float]]) -> Iterator[Dict[int, float]]:
+        """
+        The documents matching one of terms with their best score, best first,
+        in batches doubling from MAX_CANDIDATES until MAX_SCANNED_CANDIDATES.
+        """
+        levels = sorted(((weight * quality, docs) for term, quality in terms
+                         for weight, docs in self._ranked_posting(term)),
+                        key=lambda level: level[0], reverse=True)
+        seen: Set[int] = set()
+        batch: Dict[int, float] = {}
+        batch_size = MAX_CANDIDATES
+        for score, docs in levels:
+            for doc_id in docs:
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                batch[doc_id] = score
+                if len(batch) < batch_size:
+                    continue
+                yield batch
+                if len(seen) >= MAX_SCANNED_CANDIDATES:
+                    return
+                batch = {}
+                batch_size = min(2 * batch_size, MAX_SCANNED_CANDIDATES - len(seen))
+        if batch:
+            yield batch
+
+    def _intersect(self, scores: Dict[int, float], size: int,
+                   terms: List[Tuple[str, float]]) -> Dict[int, float]:
+        """Adds the best score among terms to each document in scores, dropping those no term matches."""
+        if size <= len(scores) * len(terms):
+            hits = self._hits(terms)
+            return {d: s + hits[d] for d, s in scores.items() if d in hits}
+        postings = [(self._postings[term], quality) for term, quality in terms]
+        result: Dict[int, float] = {}
+        for doc_id, score in scores.items():
+            best = 0.0
+            for posting, quality in postings:
+                weight = posting.get(doc_id)
+                if weight is not None and weight * quality > best:
+                    best = weight * quality
+            if best:
+                result[doc_id] = score + best
+        return result
@@ -0,0 +1,36 @@
+import bisect
+from array import array
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+SEEK_INDEX_INTERVAL = 5.0  # Seconds between indexed seek points
+
+# Raw MP3 streams are the one format whose seeking FFmpeg can only estimate
+# (or decode through). Containers like FLAC, Ogg, M4A and WAV carry their own
+# seek tables, so only their duration is recorded.
+BYTE_SEEK_EXTENSIONS = {'.mp3'}
+
+class SeekIndex(NamedTuple):
+    mtime: float
+    duration: Optional[float]
+    points: bytes  # array('d') of interleaved (seconds, byte offset) pairs
+    size: Optional[int] = None  # File size when read; None for indexes stored before sizes were
+
+def build_seek_points(packets: Iterable[Tuple[float, int]]) -> bytes:
+    """Samples (seconds, byte offset) packet positions down to one every SEEK_INDEX_INTERVAL."""
+    points = array('d')
+    next_point = 0.0
+    for pts, pos in packets:
+        if pts >= next_point:
+            points.extend((pts, pos))
+            next_point = pts + SEEK_INDEX_INTERVAL
+    return points.tobytes()
+
+def find_seek_point(points: bytes, position: float) -> Optional[Tuple[float, int]]:
+    """Returns the last indexed (seconds, byte offset) at or before position."""
+    values = array('d')
+    values.frombytes(points)
+    times = values[0::2]
+    i = bisect.bisect_right(times, position) - 1
+    if i < 0:
+        return None
+    return times[i], int(values[2 * i + 1])
@@ -0,0 +1,308 @@
+import os
+import re
+import math
+import zlib
+import heapq
+import random
+import bisect
+import sqlite3
+import hashlib
+import logging
+import threading
+from array import array
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Optional: without it, neighbors are only scored among tracks sharing an artist, album or folder
+
+logger = logging.getLogger(__name__)
+
+NEIGHBOR_COUNT = 16         # Most similar tracks stored per track
+RADIO_CHOICES = 4           # A radio pick is one of this many closest unplayed neighbors
+FEATURE_DIMS = 256          # Size of the hashed feature vectors
+BLOCK_ELEMENTS = 1 << 24    # Similarity scores computed per matrix product (64 MiB of float32)
+GROUP_CANDIDATES = 64       # Without NumPy: tracks scored per shared group, nearest in path order
+GAIN_REBUILD_FRACTION = 0.1 # Share of tracks whose loudness became known (or unknown) that warrants a rebuild
+
+# What makes two tracks similar
+ARTIST_WEIGHT = 3.0
+ALBUM_WEIGHT = 2.0
+FOLDER_WEIGHT = 1.5         # Deepest folder; its parents count for proportionally less
+TITLE_WORD_WEIGHT = 0.3
+CODEC_WEIGHT = 0.2
+DURATION_WEIGHT = 0.5
+LOUDNESS_WEIGHT = 0.5
+
+WORD_REGEX = re.compile(r'[^\W\d_]{3,}')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS neighbors (
+    id INTEGER PRIMARY KEY,
+    neighbors BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+class TrackFeatures(NamedTuple):
+    track_id: int
+    folder: str               # Directory relative to the library root
+    artist: Optional[str]
+    album: Optional[str]
+    title: Optional[str]
+    codec: Optional[str]
+    duration: Optional[float]
+    gain_db: Optional[float]  # From the loudness pass, a cheap stand-in for how the track is mastered
+
+def feature_tokens(track: TrackFeatures) -> Dict[str, float]:
+    """The track's categorical features with their weights."""
+    tokens: Dict[str, float] = {}
+    if track.artist:
+        tokens['artist:' + track.artist.lower()] = ARTIST_WEIGHT
+    if track.album:
+        tokens['album:' + track.album.lower()] = ALBUM_WEIGHT
+    parts = [p for p in track.folder.lower().split(os.sep) if p]
+    for depth in range(len(parts)):
+        tokens['dir:' + '/'.join(parts[:depth + 1])] = FOLDER_WEIGHT * (depth + 1) / len(parts)
+    if track.title:
+        for word in WORD_REGEX.findall(track.title.lower()):
+            tokens['word:' + word] = TITLE_WORD_WEIGHT
+    if track.codec:
+        tokens['codec:' + track.codec] = CODEC_WEIGHT
+    return tokens
+
+def features_fingerprint(tracks: Sequence[TrackFeatures]) -> str:
+    """
+    Identifies the library the index was built from: a digest of every
+    feature but loudness, which the normalization pass keeps filling in,
+    plus how many tracks have a loudness yet.
+    """
+    digest = hashlib.sha1()
+    for track in tracks:
+        digest.update(repr(track._replace(gain_db=None)).encode())
+    gains = sum(1 for track in tracks if track.gain_db is not None)
+    return f"{digest.hexdigest()}:{gains}"
+
+def needs_rebuild(built: Optional[str], current: str, track_count: int) -> bool:
+    """Whether the index built from fingerprint built is out of date for the current one."""
+    if built is None:
+        return True
+    built_digest, _, built_gains = built.partition(':')
+    digest, _, gains = current.partition(':')
+    if built_digest != digest or not built_gains.isdigit():
+        return True
+    # Loudness arriving for a few tracks at a time is not worth a full rebuild
+    return abs(int(gains) - int(built_gains)) >= max(1, track_count * GAIN_REBUILD_FRACTION)
+
+# ---------------------------------------------
+# NEIGHBOR SEARCH
+# ---------------------------------------------
+def _feature_matrix(tracks: Sequence[TrackFeatures]) -> 'np.ndarray':
+    """Rows of hashed, L2-normalized feature vectors, with duration and loudness as standardized columns."""
+    matrix = np.zeros((len(tracks), FEATURE_DIMS + 2), dtype=np.float32)
+    for row, track in enumerate(tracks):
+        for token, weight in feature_tokens(track).items():
+            h = zlib.crc32(token.encode())
+            # Signed hashing keeps collisions from adding up to false similarity
+            matrix[row, h % FEATURE_DIMS] += weight if h & 0x80000000 else -weight
+
+    for column, values, weight in (
+            (FEATURE_DIMS, [math.log(t.duration) if t.duration else None for t in tracks], DURATION_WEIGHT),
+            (FEATURE_DIMS + 1, [t.gain_db for t in tracks], LOUDNESS_WEIGHT)):
+        known = np.array([v is not None for v in values])
+        if known.sum() < 2:
+            continue
+        data = np.array([v if v is not None else 0.0 for v in values], dtype=np.float32)
+        mean, std = data[known].mean(), data[known].std() or 1.0
+        # Unknown values stay at 0, the mean, so they neither attract nor repel
+        matrix[known, column] = weight * (data[known] - mean) / std
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _neighbors_numpy(tracks: Sequence[TrackFeatures], k: int) -> Dict[int, array]:
+    """Exact cosine nearest neighbors, a block of rows against the whole library at a time."""
+    matrix = _feature_matrix(tracks)
+    ids = np.array([t.track_id for t in tracks], dtype=np.int64)
+    n = len(tracks)
+    rows_per_block = max(1, BLOCK_ELEMENTS // n)
+    result: Dict[int, array] = {}
+    for start in range(0, n, rows_per_block):
+        block = matrix[start:start + rows_per_block]
+        scores = block @ matrix.T
+        scores[np.arange(len(block)), np.arange(start, start + len(block))] = -np.inf  # Not itself
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        for i, row in enumerate(top):
+            result[int(ids[start + i])] = array('q', ids[row].tolist())
+    return result
+
+def _neighbors_grouped(tracks: Sequence[TrackFeatures], k: int) -> Dict[int, array]:
+    """
+    Fallback without NumPy: scores each track only against the tracks it
+    shares an artist, album or folder with (those nearest in path order for
+    large groups), by the cosine of their categorical features.
+    """
+    tokens = [feature_tokens(t) for t in tracks]
+    norms = [math.sqrt(sum(w * w for w in t.values())) or 1.0 for t in tokens]
+    groups: Dict[str, List[int]] = {}
+    for row, track_tokens in enumerate(tokens):
+        for token in track_tokens:
+            if token.startswith(('artist:', 'album:', 'dir:')):
+                groups.setdefault(token, []).append(row)
+
+    result: Dict[int, array] = {}
+    half = GROUP_CANDIDATES // 2
+    for row, track_tokens in enumerate(tokens):
+        candidates = set()
+        for token in track_tokens:
+            members = groups.get(token)
+            if members:
+                i = bisect.bisect_left(members, row)
+                candidates.update(members[max(0, i - half):i + half + 1])
+        candidates.discard(row)
+        scores = []
+        for other in candidates:
+            other_tokens = tokens[other]
+            dot = sum(w * other_tokens[t] for t, w in track_tokens.items() if t in other_tokens)
+            scores.append((dot / (norms[row] * norms[other]), other))
+        result[tracks[row].track_id] = array('q', (tracks[o].track_id for _, o in heapq.nlargest(k, scores)))
+    return result
+
+def build_neighbors(tracks: Sequence[TrackFeatures], k: int = NEIGHBOR_COUNT) -> Dict[int, array]:
+    """Returns the k most similar other tracks of every track, most similar first."""
+    k = min(k, len(tracks) - 1)
+    if k <= 0:
+        return {}
+    if np is not None:
+        return _neighbors_numpy(tracks, k)
+    return _neighbors_grouped(tracks, k)
+
+# ---------------------------------------------
+# INDEX
+# ---------------------------------------------
+class RecentTracks:
+    """A guild's last few played tracks, with constant-time membership tests."""
+    __slots__ = ('_order', '_counts')
+
+    def __init__(self, size: int):
+        self._order: Deque[int] = deque(maxlen=size)
+        self._counts: Dict[int, int] = {}
+
+    def add(self, track_id: int):
+        if len(self._order) == self._order.maxlen:
+            evicted = self._order[0]
+            if self._counts[evicted] == 1:
+                del self._counts[evicted]
+            else:
+                self._counts[evicted] -= 1
+        self._order.append(track_id)
+        self._counts[track_id] = self._counts.get(track_id, 0) + 1
+
+    def last(self) -> Optional[int]:
+        return self._order[-1] if self._order else None
+
+    def __contains__(self, track_id) -> bool:
+        return track_id in self._counts
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+class SimilarityIndex:
+    """
+    The nearest neighbors of every library track, computed offline from
+    tags, folders, durations and loudness, and persisted to SQLite. Radio
+    picks are answered from memory in constant time per track.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._neighbors: Dict[int, array] = {}
+        self.fingerprint: Optional[str] = None  # Of the features the loaded index was built from
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    @staticmethod
+    def _read_fingerprint(conn: sqlite3.Connection) -> Optional[str]:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        return row[0] if row else None
+
+    def load(self):
+        conn = self._connect()
+        try:
+            with conn:
+                fingerprint = self._read_fingerprint(conn)
+                rows = conn.execute("SELECT id, neighbors FROM neighbors").fetchall()
+        finally:
+            conn.close()
+        neighbors = {}
+        for track_id, blob in rows:
+            ids = array('q')
+            ids.frombytes(blob)
+            neighbors[track_id] = ids
+        with self._lock:
+            self._neighbors = neighbors
+            self.fingerprint = fingerprint
+        if neighbors:
+            logger.info(f"Loaded similarity index for {len(neighbors)} tracks.")
+
+    def reload(self) -> bool:
+        """Loads the index another process built since, if any. Returns True if it did."""
+        conn = self._connect()
+        try:
+            stored = self._read_fingerprint(conn)
+        finally:
+            conn.close()
+        if stored == self.fingerprint:
+            return False
+        self.load()
+        return True
+
+    def update(self, tracks: Sequence[TrackFeatures]) -> int:
+        """Rebuilds the index if the library's features changed since it was built. Returns tracks indexed."""
+        fingerprint = features_fingerprint(tracks)
+        if not needs_rebuild(self.fingerprint, fingerprint, len(tracks)):
+            return 0
+        logger.info(f"Building similarity index for {len(tracks)} tracks"
+                    f"{'' if np is not None else ' (NumPy not installed, comparing within groups only)'}.")
+        neighbors = build_neighbors(tracks)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM neighbors")
+                conn.executemany("INSERT INTO neighbors (id, neighbors) VALUES (?, ?)",
+                                 ((t, ids.tobytes()) for t, ids in neighbors.items()))
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fingerprint', ?)", (fingerprint,))
+        finally:
+            conn.close()
+        with self._lock:
+            self._neighbors = neighbors
+            self.fingerprint = fingerprint
+        return len(neighbors)
+
+    def neighbors(self, track_id: int) -> Sequence[int]:
+        return self._neighbors.get(track_id, ())
+
+    def pick(self, seed: Optional[int], recent: RecentTracks) -> Optional[int]:
+        """A track similar to seed that was not played recently, or None if the index has none."""
+        if seed is None:
+            return None
+        choices = []
+        for track_id in self._neighbors.get(seed, ()):
+            if track_id not in recent:
+                choices.append(track_id)
+                if len(choices) == RADIO_CHOICES:
+                    break
+        return random.choice(choices) if choices else None
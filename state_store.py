@@ -0,0 +1,50 @@
+import time
+import sqlite3
+import logging
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAX_AGE = 7 * 24 * 3600  # Older snapshots are not worth offering to resume
+
+class GuildStateStore:
+    """
+    On-disk store of per-guild queue snapshots (JSON text), written in
+    batches by a write-behind task so the event loop never waits on disk.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS guild_snapshots ("
+                     "guild_id INTEGER PRIMARY KEY, snapshot TEXT NOT NULL, updated_at REAL NOT NULL)")
+        return conn
+
+    def load_all(self) -> Dict[int, str]:
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM guild_snapshots WHERE updated_at < ?",
+                             (time.time() - SNAPSHOT_MAX_AGE,))
+            rows = conn.execute("SELECT guild_id, snapshot FROM guild_snapshots").fetchall()
+        finally:
+            conn.close()
+        return dict(rows)
+
+    def save_many(self, snapshots: Dict[int, Optional[str]]):
+        """Writes changed snapshots in one transaction; None deletes a guild's snapshot."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO guild_snapshots (guild_id, snapshot, updated_at) VALUES (?, ?, ?)",
+                    ((g, s, now) for g, s in snapshots.items() if s is not None))
+                conn.executemany(
+                    "DELETE FROM guild_snapshots WHERE guild_id = ?",
+                    ((g,) for g, s in snapshots.items() if s is None))
+        finally:
+            conn.close()
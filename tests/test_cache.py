@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from cache import PersistentCache, SingleFlight
+
+def test_values_expire(tmp_path):
+    cache = PersistentCache(str(tmp_path / 'cache.db'), 'entries')
+    cache.put('fresh', {'a': 1}, ttl=60)
+    cache.put('stale', [1, 2], ttl=-1)
+    assert cache.get('fresh') == {'a': 1}
+    assert cache.get('stale') is None
+    cache.delete('fresh')
+    assert cache.get('fresh') is None
+
+def test_leases_are_exclusive_across_instances(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    first, second = PersistentCache(path, 'entries'), PersistentCache(path, 'entries')
+    assert first.try_lease('key', ttl=60)
+    assert not second.try_lease('key', ttl=60)
+    first.release_lease('key')
+    assert second.try_lease('key', ttl=60)
+
+def test_expired_leases_can_be_taken_over(tmp_path):
+    cache = PersistentCache(str(tmp_path / 'cache.db'), 'entries')
+    assert cache.try_lease('key', ttl=-1)
+    assert cache.try_lease('key', ttl=60)
+
+def test_concurrent_calls_share_one_execution():
+    async def main():
+        flight, calls = SingleFlight(), []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'done'
+        results = await asyncio.gather(*(flight.do('key', work) for _ in range(5)))
+        assert results == ['done'] * 5 and len(calls) == 1
+    asyncio.run(main())
+
+def test_work_survives_until_every_caller_is_cancelled():
+    async def main():
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            return 'done'
+        first = asyncio.create_task(flight.do('key', work))
+        second = asyncio.create_task(flight.do('key', work))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'done'
+    asyncio.run(main())
+
+def test_caller_after_cancellation_starts_afresh():
+    async def main():
+        flight, calls = SingleFlight(), []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.02)
+            return len(calls)
+        cancelled = asyncio.create_task(flight.do('key', work))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)  # The shared work is cancelled, its done callback has not run
+        assert await flight.do('key', work) == 2
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+    asyncio.run(main())
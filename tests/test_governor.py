@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import governor
+from executors import Priority
+from governor import FFmpegBusy, FFmpegGovernor
+
+def make_governor(max_processes: int, guild_limit: int = 3) -> FFmpegGovernor:
+    return FFmpegGovernor(max_processes, guild_limit, degrade_load=float('inf'))
+
+def test_limits_per_guild_and_overall():
+    gov = make_governor(4, guild_limit=2)
+    first = gov.try_acquire(1, Priority.PLAYBACK)
+    assert gov.try_acquire(1, Priority.PLAYBACK) is not None
+    assert gov.try_acquire(1, Priority.PLAYBACK) is None
+    first.release()
+    first.release()  # Releasing twice frees one slot only
+    assert gov.total == 1 and gov.live(1) == 1
+
+def test_preloads_leave_headroom(monkeypatch):
+    monkeypatch.setattr(governor, 'PRELOAD_HEADROOM', 1)
+    gov = make_governor(2)
+    assert gov.try_acquire(1, Priority.PREFETCH) is not None
+    assert gov.try_acquire(2, Priority.PREFETCH) is None
+    assert gov.try_acquire(2, Priority.PLAYBACK) is not None
+
+def test_non_playback_requests_are_refused():
+    async def main():
+        gov = make_governor(1)
+        await gov.acquire(1, Priority.PLAYBACK)
+        with pytest.raises(FFmpegBusy):
+            await gov.acquire(2, Priority.PREFETCH)
+    asyncio.run(main())
+
+def test_released_slots_go_to_waiters_in_order():
+    async def main():
+        gov = make_governor(1)
+        held = await gov.acquire(1, Priority.PLAYBACK)
+        admitted = []
+
+        async def play(guild_id):
+            slot = await gov.acquire(guild_id, Priority.PLAYBACK)
+            admitted.append(guild_id)
+            return slot
+        waiters = [asyncio.create_task(play(guild_id)) for guild_id in (2, 3, 4)]
+        await asyncio.sleep(0)
+        assert gov.waiting == 3
+
+        held.release()
+        # The slot is already spoken for: the guild that released it cannot take it back
+        assert gov.try_acquire(1, Priority.PLAYBACK) is None
+        for waiter in waiters:
+            (await waiter).release()
+        assert admitted == [2, 3, 4] and gov.total == 0 and gov.waiting == 0
+    asyncio.run(main())
+
+def test_withdrawn_and_cancelled_waiters_give_up_their_turn():
+    async def main():
+        gov = make_governor(1)
+        held = await gov.acquire(1, Priority.PLAYBACK)
+        withdrawn = asyncio.create_task(gov.acquire(2, Priority.PLAYBACK))
+        cancelled = asyncio.create_task(gov.acquire(3, Priority.PLAYBACK))
+        waiting = asyncio.create_task(gov.acquire(4, Priority.PLAYBACK))
+        await asyncio.sleep(0)
+
+        gov.withdraw(2)
+        with pytest.raises(FFmpegBusy):
+            await withdrawn
+        held.release()  # Granted to guild 3 just as it is cancelled: passed on to guild 4
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        slot = await asyncio.wait_for(waiting, 1)
+        assert slot.guild_id == 4 and gov.total == 1
+    asyncio.run(main())
+
+def test_playback_preempts_a_preload():
+    async def main():
+        gov = make_governor(1)
+        preload = gov.try_acquire(1, Priority.PLAYBACK)
+        stopped = []
+
+        def stop():
+            stopped.append(True)
+            preload.release()
+            return True
+        preload.allow_preemption(stop)
+        slot = await gov.acquire(2, Priority.PLAYBACK)
+        assert stopped and slot.guild_id == 2 and gov.total == 1
+    asyncio.run(main())
+
+def test_preloads_that_started_playing_are_kept():
+    async def main():
+        gov = make_governor(1)
+        playing = gov.try_acquire(1, Priority.PLAYBACK)
+        playing.allow_preemption(lambda: False)
+        waiter = asyncio.create_task(gov.acquire(2, Priority.PLAYBACK))
+        await asyncio.sleep(0.01)
+        assert not waiter.done() and gov.live(1) == 1
+        playing.release()
+        assert (await waiter).guild_id == 2
+    asyncio.run(main())
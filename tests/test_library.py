@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from library import LibraryIndex
+from metadata import TrackTags
+from seek_index import SeekIndex
+
+@pytest.fixture
+def music(tmp_path):
+    root = tmp_path / 'music'
+    for rel in ('a/one.mp3', 'a/two.flac', 'b/c/three.mp3', 'notes.txt'):
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'audio')
+    return root
+
+def make_index(music, tmp_path) -> LibraryIndex:
+    return LibraryIndex(str(music), ['.mp3', '.flac'], str(tmp_path / 'library.db'))
+
+def ingest(index: LibraryIndex):
+    rows = []
+    for track_id, path in index.tracks_needing_ingest():
+        stat = os.stat(path)
+        rows.append((track_id, SeekIndex(stat.st_mtime, 1.0, b'', stat.st_size),
+                     TrackTags(os.path.basename(path), 'Artist', 'Album', 'mp3')))
+    index.store_metadata(rows)
+    return len(rows)
+
+def test_refresh_indexes_and_removes_files(music, tmp_path):
+    index = make_index(music, tmp_path)
+    assert index.refresh() == (3, 0)
+    assert index.refresh() == (0, 0)
+    assert [os.path.basename(p) for p in index.songs_under(str(music / 'a'))] == ['one.mp3', 'two.flac']
+
+    (music / 'a' / 'one.mp3').unlink()
+    (music / 'a' / 'four.mp3').write_bytes(b'audio')
+    assert index.refresh() == (1, 1)
+    assert index.find_by_name('four') == [str(music / 'a' / 'four.mp3')]
+    assert index.find_by_name('one') == []
+
+def test_load_restores_the_persisted_index(music, tmp_path):
+    index = make_index(music, tmp_path)
+    index.refresh()
+    ingest(index)
+    loaded = make_index(music, tmp_path)
+    loaded.load()
+    assert loaded.generation == index.generation
+    assert sorted(loaded.songs_under(str(music))) == sorted(index.songs_under(str(music)))
+    assert loaded.tracks_by_artist('artist')[1] == index.tracks_by_artist('artist')[1]
+    assert loaded.tracks_needing_ingest() == []
+
+def test_files_changed_in_place_are_read_again(music, tmp_path):
+    index = make_index(music, tmp_path)
+    index.refresh()
+    assert ingest(index) == 3
+    assert index.tracks_needing_ingest() == []
+
+    path = music / 'a' / 'one.mp3'
+    dir_stat = os.stat(music / 'a')
+    path.write_bytes(b'retagged audio')
+    os.utime(music / 'a', ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    index.refresh()
+    assert index.tracks_needing_ingest() == [(index.track_id(str(path)), str(path))]
+
+def test_reload_picks_up_another_process_refresh(music, tmp_path):
+    primary, other = make_index(music, tmp_path), make_index(music, tmp_path)
+    primary.refresh()
+    other.load()
+    assert not other.reload()
+    (music / 'b' / 'five.mp3').write_bytes(b'audio')
+    primary.refresh()
+    assert other.reload()
+    assert other.track_count == 4
@@ -0,0 +1,58 @@
+import json
+
+from queues import LazyShuffle, ShuffledSegment, TrackQueue, YouTubeTrack
+
+def test_lazy_shuffle_is_a_permutation():
+    for n in (1, 2, 3, 17, 1000, 4097):
+        order = LazyShuffle(n, seed=42)
+        assert sorted(order[i] for i in range(n)) == list(range(n))
+
+def test_lazy_shuffle_is_determined_by_its_seed():
+    first = [LazyShuffle(500, seed=7)[i] for i in range(500)]
+    assert first == [LazyShuffle(500, seed=7)[i] for i in range(500)]
+    assert first != [LazyShuffle(500, seed=8)[i] for i in range(500)]
+
+def test_segment_pops_every_track_once():
+    ids = list(range(100, 200))
+    segment = ShuffledSegment(ids, seed=3)
+    popped = [segment.pop() for _ in range(len(ids))]
+    assert sorted(popped) == ids
+    assert len(segment) == 0
+
+def test_spread_keeps_artists_apart():
+    ids = list(range(60))
+    artist = lambda track_id: f"artist{track_id % 5}"
+    segment = ShuffledSegment(ids, seed=11, spread_key=artist)
+    popped = [segment.pop() for _ in range(30)]
+    # Each track's artist differs from the SPREAD_MEMORY (3) before it
+    assert all(len({artist(t) for t in popped[i:i + 4]}) == 4 for i in range(1, len(popped) - 3))
+    assert len(set(popped)) == len(popped)
+
+def test_queue_mixes_tracks_videos_and_segments():
+    queue = TrackQueue()
+    queue.append(5)
+    queue.extend_shuffled(list(range(10)), source='dir')
+    queue.append(YouTubeTrack('Song', 'https://youtu.be/x'))
+    assert len(queue) == 12 and queue.video_count == 1
+    assert queue.popleft() == 5
+    tracks = list(queue)
+    assert sorted(tracks[:10]) == list(range(10))
+    assert tracks[10].url == 'https://youtu.be/x'
+    assert list(queue.window(3, 11)) == tracks[3:11]
+    assert queue.remove_videos() == 1 and len(queue) == 10
+
+def test_snapshot_round_trip_continues_the_same_order():
+    sources = {'dir': list(range(500))}
+    artist = lambda track_id: f"artist{track_id % 7}"
+    queue = TrackQueue()
+    queue.extend_shuffled(sources['dir'], source='dir', spread_key=artist)
+    queue.append(YouTubeTrack('Song', 'https://youtu.be/x', 120.0))
+    for _ in range(200):
+        queue.popleft()
+
+    snapshot = json.loads(json.dumps(queue.to_snapshot()))
+    restored = TrackQueue.from_snapshot(snapshot, sources.__getitem__, artist)
+    expected = [queue.popleft() for _ in range(len(queue))]
+    actual = [restored.popleft() for _ in range(len(restored))]
+    assert actual[:-1] == expected[:-1]
+    assert actual[-1].to_entry() == expected[-1].to_entry()
@@ -0,0 +1,43 @@
+import search
+from search import SearchIndex
+
+def make_index() -> SearchIndex:
+    index = SearchIndex()
+    index.add(1, 'River Dream', tags=('Blue Band', 'Night Album'), context=('rock',))
+    index.add(2, 'Dream On', tags=('Other Band',), context=('rock',))
+    index.add(3, 'Night River', context=('ambient',))
+    index.add(4, 'Unrelated', tags=('River Dream Band',))
+    return index
+
+def ids(results):
+    return [doc_id for doc_id, _ in results]
+
+def test_every_token_must_match():
+    assert set(ids(make_index().search('river dream'))) == {1, 4}
+    assert make_index().search('river xyzzy') == []
+
+def test_title_matches_rank_above_tag_matches():
+    assert ids(make_index().search('river dream'))[0] == 1
+
+def test_prefix_and_fuzzy_matches():
+    index = make_index()
+    assert 1 in ids(index.search('riv dre'))
+    assert 1 in ids(index.search('rivr drem'))
+
+def test_removed_and_replaced_documents():
+    index = make_index()
+    index.remove(1)
+    assert 1 not in ids(index.search('river'))
+    index.add(3, 'Something Else')
+    assert ids(index.search('night river')) == []
+
+def test_common_tokens_still_find_rare_combinations(monkeypatch):
+    monkeypatch.setattr(search, 'MAX_CANDIDATES', 10)
+    monkeypatch.setattr(search, 'MAX_SCANNED_CANDIDATES', 40)
+    index = SearchIndex()
+    for doc_id in range(200):
+        index.add(doc_id, 'alpha' if doc_id % 2 else 'beta')
+        if doc_id == 25:
+            # Past the first batch of candidates, within the ones scanned
+            index.add(1000, 'alpha beta')
+    assert ids(index.search('alpha beta')) == [1000]
@@ -0,0 +1,160 @@
+import os
+from typing import Callable, List, Optional, Tuple
+
+import discord
+
+from library import LibraryIndex
+from queues import Track, TrackQueue
+
+PAGE_SIZE = 20            # Entries rendered per page
+VIEW_TIMEOUT = 300        # Seconds before pagination buttons stop responding
+MAX_NAME_LENGTH = 80      # Keeps a full page well inside Discord's 2000 character limit
+MAX_TOTALLED_ENTRIES = 1000  # Longer queues are shown without a total duration
+
+def _truncate(name: str, length: int = MAX_NAME_LENGTH) -> str:
+    return name if len(name) <= length else name[:length - 1] + '…'
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class PagedView(discord.ui.View):
+    """
+    A message showing one page of a longer listing, with buttons to move
+    between pages. Only the visible page is ever rendered, and each button
+    press edits the message in place (one API call).
+    """
+
+    def __init__(self):
+        super().__init__(timeout=VIEW_TIMEOUT)
+        self.page = 0
+        self.message: Optional[discord.Message] = None
+
+    def page_count(self) -> int:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        raise NotImplementedError
+
+    def update_items(self):
+        """Brings the buttons in line with the current page."""
+        self.page = max(0, min(self.page, self.page_count() - 1))
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count() - 1
+
+    async def send(self, ctx):
+        self.update_items()
+        self.message = await ctx.send(self.render(), view=self)
+
+    async def refresh(self, interaction: discord.Interaction):
+        self.update_items()
+        await interaction.response.edit_message(content=self.render(), view=self)
+
+    @discord.ui.button(label='◀', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        await self.refresh(interaction)
+
+    @discord.ui.button(label='▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        await self.refresh(interaction)
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+class LibraryBrowser(PagedView):
+    """Pages through one library folder at a time; subfolders can be opened from a menu."""
+
+    def __init__(self, library: LibraryIndex, root: str, start: str):
+        super().__init__()
+        self.library = library
+        self.root = os.path.abspath(root)
+        self.path = os.path.abspath(start)
+        self.folder_menu = discord.ui.Select(placeholder='Open a folder…')
+        self.folder_menu.callback = self.open_folder
+        self.menu_folders: List[str] = []  # Menu values are indexes into this, as names may exceed 100 characters
+
+    def _listing(self):
+        return self.library.dir_page(self.path, self.page * PAGE_SIZE, PAGE_SIZE) or ([], [], 0)
+
+    def page_count(self) -> int:
+        total = self._listing()[2]
+        return max(1, -(-total // PAGE_SIZE))
+
+    def update_items(self):
+        super().update_items()
+        self.up.disabled = self.path == self.root
+        self.menu_folders = self._listing()[0][:25]
+        self.remove_item(self.folder_menu)
+        if self.menu_folders:
+            self.folder_menu.options = [discord.SelectOption(label=_truncate(f, 100), value=str(i))
+                                        for i, f in enumerate(self.menu_folders)]
+            self.add_item(self.folder_menu)
+
+    def render(self) -> str:
+        folders, tracks, total = self._listing()
+        rel = os.path.relpath(self.path, self.root)
+        name = os.path.basename(self.root) if rel == '.' else rel
+        lines = [f"📁 {_truncate(f)}/" for f in folders] + [f"   {_truncate(t)}" for t in tracks]
+        if not lines:
+            lines = ["(empty)"]
+        return (f"**{_truncate(name, 200)}** ({total} entries, page {self.page + 1}/{self.page_count()})\n"
+                "```text\n" + "\n".join(lines) + "```")
+
+    @discord.ui.button(label='⬆ Up', style=discord.ButtonStyle.secondary)
+    async def up(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.path = os.path.dirname(self.path)
+        self.page = 0
+        await self.refresh(interaction)
+
+    async def open_folder(self, interaction: discord.Interaction):
+        index = int(self.folder_menu.values[0])
+        target = os.path.join(self.path, self.menu_folders[index]) if index < len(self.menu_folders) else None
+        if target and self.library.is_directory(target):
+            self.path = target
+            self.page = 0
+        await self.refresh(interaction)
+
+class QueueBrowser(PagedView):
+    """Pages through a live queue of library tracks and videos; each page is read from the queue when shown."""
+
+    def __init__(self, queue: Callable[[], TrackQueue], now_playing: Callable[[], Optional[Track]],
+                 describe: Callable[[Track], Tuple[str, Optional[float]]]):
+        super().__init__()
+        self.queue = queue
+        self.now_playing = now_playing
+        self.describe = describe  # (title, duration) of a track
+
+    def page_count(self) -> int:
+        return max(1, -(-len(self.queue()) // PAGE_SIZE))
+
+    def render(self) -> str:
+        queue = self.queue()
+        start = self.page * PAGE_SIZE
+        lines: List[str] = []
+        current = self.now_playing()
+        if current is not None:
+            lines.append(f"**Now playing:** {_truncate(self.describe(current)[0])}")
+        if not queue:
+            lines.append("Queue is empty!")
+            return "\n".join(lines)
+
+        # Shuffled library playlists can be huge; only small queues are totalled on every page turn
+        total = ""
+        if len(queue) <= MAX_TOTALLED_ENTRIES:
+            total_seconds = sum(self.describe(t)[1] or 0 for t in queue)
+            total = f", {_format_duration(total_seconds)}" if total_seconds else ""
+        lines.append(f"**Queue** ({len(queue)} tracks{total}, page {self.page + 1}/{self.page_count()})")
+        for i, track in enumerate(queue.window(start, start + PAGE_SIZE), start + 1):
+            title, duration = self.describe(track)
+            duration = f" [{_format_duration(duration)}]" if duration else ""
+            lines.append(f"{i}. {_truncate(title)}{duration}")
+        return "\n".join(lines)
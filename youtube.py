@@ -1,8 +1,18 @@
 import re
+import time
+import asyncio
 import discord
-import yt_dlp
 import logging
-from typing import List, Dict, Optional
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+from cache import PersistentCache, SingleFlight
+from executors import Priority, extraction_pool, io_pool
+from metrics import STREAM_URL_LOOKUPS, stage
+from relay import audio_relay
+from governor import THREAD_OPTIONS
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +24,7 @@ YOUTUBE_URL_REGEX = re.compile(
 
 # --- yt-dlp Configuration ---
 YDL_OPTS = {
-    'format': 'bestaudio/best',
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',  # Opus can be sent to Discord without re-encoding
     'quiet': True,
     'noplaylist': False,
     'extract_flat': 'in_playlist',  
@@ -26,21 +36,232 @@ YDL_OPTS = {
 # 1. reconnect flags: Fix choppiness/network dropouts
 # 2. -ac 2: Force Stereo (2 channels)
 # 3. -ar 48000: Force 48kHz sample rate (Discord Native). Prevents bad resampling artifacts.
+# 4. -threads: Decoder threads per process, see governor.FFMPEG_THREADS
 FFMPEG_OPTS = {
-    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -reconnect_on_network_error 1',
+    'before_options': '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -reconnect_on_network_error 1 '
+                      + THREAD_OPTIONS,
     'options': '-vn -ac 2 -ar 48000'
 }
 
+# Opus streams are remuxed as-is (FFmpegOpusAudio forces 48kHz stereo Opus output itself)
+FFMPEG_OPUS_OPTS = {
+    'before_options': FFMPEG_OPTS['before_options'],
+    'options': '-vn'
+}
+
+# YouTube audio-only itags carrying Opus in WebM
+OPUS_ITAGS = {'249', '250', '251'}
+
+# --- Stream URL Cache ---
+STREAM_CACHE_SIZE = 512
+STREAM_URL_DEFAULT_TTL = 1800   # Used when the stream URL carries no expire= parameter
+STREAM_URL_EXPIRY_MARGIN = 120  # Never hand out a URL this close to expiring
+
+EXPIRE_PATH_REGEX = re.compile(r'/expire/(\d+)')
+
+class StreamURLCache:
+    """
+    Thread-safe LRU cache of resolved stream URLs, keyed by video ID.
+    Entries expire shortly before the googlevideo URL itself does, leaving
+    enough headroom for the track to finish playing.
+    """
+
+    def __init__(self, max_size: int = STREAM_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stream_url, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return stream_url
+
+    def put(self, key: str, stream_url: str, expires_at: float):
+        if expires_at <= time.time():
+            return
+        with self._lock:
+            self._entries[key] = (stream_url, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+def stream_cache_deadline(stream_url: str, duration: Optional[float]) -> float:
+    """Returns the time until which a stream URL may be handed out for a track of the given duration."""
+    return stream_url_expiry(stream_url) - max(STREAM_URL_EXPIRY_MARGIN, duration or 0)
+
+def stream_url_expiry(stream_url: str) -> float:
+    """Returns the unix time at which a stream URL expires, based on its expire= parameter."""
+    parsed = urlparse(stream_url)
+    expire = parse_qs(parsed.query).get('expire')
+    if expire and expire[0].isdigit():
+        return float(expire[0])
+    match = EXPIRE_PATH_REGEX.search(parsed.path)
+    if match:
+        return float(match.group(1))
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+stream_url_cache = StreamURLCache()
+
+def video_cache_key(video_url: str) -> str:
+    """Returns the YouTube video ID for a URL, or the URL itself for other sites."""
+    match = YOUTUBE_URL_REGEX.match(video_url)
+    return match.group(6) if match else video_url
+
+# --- Metadata Cache ---
+METADATA_CACHE_PATH = 'youtube_cache.db'
+SEARCH_TTL = 24 * 3600         # search query -> top result
+VIDEO_TTL = 7 * 24 * 3600      # video ID -> title/duration
+PLAYLIST_TTL = 3600            # playlist URL -> entries (playlists change)
+PLAYLIST_PAGE_SIZE = 100       # Entries extracted per playlist page (YouTube's own page size)
+
+metadata_cache = PersistentCache(METADATA_CACHE_PATH, 'metadata')
+
+# Second tier behind stream_url_cache, shared by every bot process on this host
+shared_stream_cache = PersistentCache(METADATA_CACHE_PATH, 'stream_urls')
+
+# Identical lookups issued concurrently share a single extraction: within this
+# process via inflight, across processes via leases in the shared cache
+inflight = SingleFlight()
+SHARED_LEASE_TTL = 60        # Seconds another process may hold an extraction lease
+SHARED_POLL_INTERVAL = 0.25  # Seconds between checks for another process's result
+
+async def fetch_shared(cache: PersistentCache, key: str, priority: Priority,
+                       compute: Callable[[], Awaitable[Any]], store: Callable[[Any], None]) -> Any:
+    """
+    Computes a value for key while holding a lease in the shared cache, so other
+    processes asking for the same key wait for this result instead of repeating
+    the extraction. Returns the value another process stored if it wins the lease.
+    """
+    leased = await io_pool.run(priority, None, cache.try_lease, key, SHARED_LEASE_TTL)
+    if not leased:
+        deadline = time.monotonic() + SHARED_LEASE_TTL
+        while not leased and time.monotonic() < deadline:
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+            value = await io_pool.run(priority, None, cache.get, key)
+            if value is not None:
+                return value
+            # The holder may have given up without a result
+            leased = await io_pool.run(priority, None, cache.try_lease, key, SHARED_LEASE_TTL)
+
+    try:
+        value = await compute()
+        if value:
+            await io_pool.run(Priority.BACKGROUND, None, store, value)
+        return value
+    finally:
+        if leased:
+            io_pool.submit(Priority.BACKGROUND, None, cache.release_lease, key)
+
+def metadata_cache_key(url: str) -> Tuple[str, float]:
+    """Returns the metadata cache key for a get_youtube_info input, and its TTL."""
+    url = url.strip()
+    if not url.startswith('http') and not is_youtube_url(url):
+        return f"search:{url.lower()}", SEARCH_TTL
+    list_id = parse_qs(urlparse(url if '://' in url else f"https://{url}").query).get('list')
+    if list_id:
+        return f"playlist:{list_id[0]}", PLAYLIST_TTL
+    if is_youtube_url(url):
+        return f"video:{video_cache_key(url)}", VIDEO_TTL
+    return f"url:{url}", PLAYLIST_TTL
+
+def invalidate_stream_url(video_url: str):
+    """Drops a cached stream URL, e.g. after playback of it failed."""
+    cache_key = video_cache_key(video_url)
+    stream_url_cache.invalidate(cache_key)
+    io_pool.submit(Priority.BACKGROUND, None, shared_stream_cache.delete, cache_key)
+
 def is_youtube_url(url: str) -> bool:
     """Checks if the given string is a valid YouTube URL."""
     return YOUTUBE_URL_REGEX.match(url) is not None
 
-def get_youtube_info(url: str) -> Optional[List[Dict]]:
+async def get_youtube_info(url: str, priority: Optional[Priority] = None,
+                           guild_id: Optional[int] = None) -> AsyncIterator[List[Dict]]:
     """
     Retrieves video metadata using 'flat' extraction for playlists.
-    Returns dictionaries containing title, valid webpage URL, and duration.
+    Yields pages of dictionaries containing title, valid webpage URL, and duration,
+    so callers can start on the first entries while the rest are still extracted.
+    Searches and single videos produce one page; playlists are fetched in pages
+    of PLAYLIST_PAGE_SIZE. Each page is cached on disk, and concurrent identical
+    lookups share one extraction. After the first page, playlists are extracted
+    at background priority.
     """
-    with yt_dlp.YoutubeDL(YDL_OPTS) as ydl:
+    key, ttl = metadata_cache_key(url)
+    paged = key.startswith(('playlist:', 'url:'))
+    if priority is None:
+        priority = Priority.INTERACTIVE
+
+    page = 0
+    while True:
+        page_key = f"{key}#{page}" if paged else key
+        playlist_items = f"{page * PLAYLIST_PAGE_SIZE + 1}-{(page + 1) * PLAYLIST_PAGE_SIZE}" if paged else None
+
+        with stage('get_youtube_info'):
+            entries = await io_pool.run(Priority.INTERACTIVE, None, metadata_cache.get, page_key)
+            if entries is not None:
+                logger.info(f"Metadata cache hit for {page_key}")
+            else:
+                entries = await inflight.do(f"info:{page_key}", lambda: fetch_shared(
+                    metadata_cache, page_key, priority,
+                    lambda: extraction_pool.run(priority, guild_id, _extract_youtube_info, url, playlist_items),
+                    lambda e: store_youtube_info(page_key, e, ttl)))
+
+        if not entries:
+            return
+        yield entries
+        if not paged or len(entries) < PLAYLIST_PAGE_SIZE:
+            return
+        page += 1
+        priority = max(priority, Priority.BACKGROUND)
+
+def store_youtube_info(key: str, entries: List[Dict], ttl: float):
+    """Caches extracted entries under their lookup key and under each video ID."""
+    metadata_cache.put(key, entries, ttl)
+    if not key.startswith('video:'):
+        metadata_cache.put_many(
+            {f"video:{video_cache_key(e['url'])}": [e] for e in entries if is_youtube_url(e['url'])},
+            VIDEO_TTL)
+
+# --- Extraction Workers ---
+# yt-dlp takes seconds to import, so the bot process never loads it: only the
+# extraction workers do, on their first job (or in warm_up, ahead of time).
+
+def load_yt_dlp():
+    import yt_dlp
+    return yt_dlp
+
+def _warm_worker():
+    """Runs in the extraction pool: loads yt-dlp and its YouTube extractor."""
+    with load_yt_dlp().YoutubeDL(YDL_OPTS) as ydl:
+        ydl.get_info_extractor('Youtube')
+
+async def warm_up():
+    """Starts the extraction workers in the background, so the first request doesn't wait for them."""
+    started = time.perf_counter()
+    results = await asyncio.gather(*(extraction_pool.run(Priority.BACKGROUND, None, _warm_worker)
+                                     for _ in range(extraction_pool.max_workers)), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        logger.warning(f"Warming up the extraction workers failed: {errors[0]}")
+    else:
+        logger.info(f"Extraction workers ready in {time.perf_counter() - started:.2f}s.")
+
+def _extract_youtube_info(url: str, playlist_items: Optional[str] = None) -> Optional[List[Dict]]:
+    """Runs in the extraction pool. playlist_items limits playlists to a range, e.g. '1-100'."""
+    opts = dict(YDL_OPTS)
+    if playlist_items:
+        opts['playlist_items'] = playlist_items
+    with load_yt_dlp().YoutubeDL(opts) as ydl:
         try:
             logger.info(f"Extracting info for input: {url}")
             info = ydl.extract_info(url, download=False)
@@ -89,23 +310,87 @@ def get_youtube_info(url: str) -> Optional[List[Dict]]:
             logger.error(f"Error in get_youtube_info: {e}", exc_info=True)
             return None
 
-def get_stream_url(video_url: str) -> Optional[str]:
+async def get_stream_url(video_url: str, priority: Priority = Priority.PLAYBACK,
+                         guild_id: Optional[int] = None) -> Optional[str]:
     """
     Resolves the specific audio stream URL for a single video just before playback.
+    Results are served from the shared stream URL cache while still valid.
     """
+    cache_key = video_cache_key(video_url)
+    cached = stream_url_cache.get(cache_key)
+    if cached:
+        logger.debug(f"Stream URL cache hit for {cache_key}")
+        STREAM_URL_LOOKUPS.inc('memory')
+        return cached
+
+    flight_key = f"stream:{cache_key}"
+    # A prefetch for this video may already be queued at lower priority
+    extraction_pool.promote(flight_key, priority)
+    with stage('get_stream_url'):
+        resolved = await inflight.do(
+            flight_key, lambda: _resolve_stream_url(video_url, cache_key, flight_key, priority, guild_id))
+    if not resolved:
+        return None
+    stream_url, expires_at = resolved
+    stream_url_cache.put(cache_key, stream_url, expires_at)
+    return stream_url
+
+async def _resolve_stream_url(video_url: str, cache_key: str, flight_key: str, priority: Priority,
+                              guild_id: Optional[int]) -> Optional[List]:
+    """Returns [stream URL, cache deadline] from the shared cache, or by extracting it."""
+    shared = await io_pool.run(priority, None, shared_stream_cache.get, cache_key)
+    if shared:
+        STREAM_URL_LOOKUPS.inc('shared')
+        return shared
+
+    async def extract():
+        STREAM_URL_LOOKUPS.inc('extracted')
+        resolved = await extraction_pool.run(priority, guild_id, _extract_stream_url, video_url, key=flight_key)
+        if not resolved:
+            return None
+        stream_url, duration = resolved
+        return [stream_url, stream_cache_deadline(stream_url, duration)]
+
+    return await fetch_shared(
+        shared_stream_cache, cache_key, priority, extract,
+        lambda value: shared_stream_cache.put(cache_key, value, value[1] - time.time()))
+
+def _extract_stream_url(video_url: str) -> Optional[Tuple[str, Optional[float]]]:
+    """Runs in the extraction pool. Returns (stream URL, duration)."""
     stream_opts = dict(YDL_OPTS)
     stream_opts['extract_flat'] = False
     
-    with yt_dlp.YoutubeDL(stream_opts) as ydl:
+    with load_yt_dlp().YoutubeDL(stream_opts) as ydl:
         try:
             info = ydl.extract_info(video_url, download=False)
-            if not info:
+            if not info or not info.get('url'):
                 return None
-            return info.get('url') 
+            return info['url'], info.get('duration')
         except Exception as e:
             logger.error(f"Error resolving stream URL for {video_url}: {e}")
             return None
 
-def create_youtube_audio_source(stream_url: str) -> discord.FFmpegPCMAudio:
-    """Creates a discord.FFmpegPCMAudio source from a direct stream URL."""
-    return discord.FFmpegPCMAudio(stream_url, **FFMPEG_OPTS)
+def is_opus_stream(stream_url: str) -> bool:
+    """Checks whether a googlevideo stream URL points to an Opus/WebM audio format."""
+    query = parse_qs(urlparse(stream_url).query)
+    mime = query.get('mime', [''])[0]
+    itag = query.get('itag', [''])[0]
+    return mime == 'audio/webm' or itag in OPUS_ITAGS
+
+def create_youtube_audio_source(stream_url: str, start_at: float = 0.0) -> discord.AudioSource:
+    """
+    Creates an audio source from a direct stream URL, optionally starting start_at
+    seconds in. Opus streams are passed through to Discord as-is; anything else is
+    decoded to PCM and re-encoded. When the local relay is running, FFmpeg reads
+    through it instead of connecting to the CDN itself.
+    """
+    opus = is_opus_stream(stream_url)
+    opts = dict(FFMPEG_OPUS_OPTS if opus else FFMPEG_OPTS)
+    if start_at:
+        opts['before_options'] += f' -ss {start_at:.2f}'
+    if audio_relay.running:
+        stream_url = audio_relay.url_for(stream_url)
+    with stage('ffmpeg_spawn'):
+        if opus:
+            return discord.FFmpegOpusAudio(stream_url, codec='opus', **opts)
+        return discord.FFmpegPCMAudio(stream_url, **opts)